@@ -0,0 +1,192 @@
+# Times the setup end to end on synthetic data, see "Benchmarking" in the README.
+import os
+import sys
+import json
+import time
+import subprocess
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# the benchmark works in its own schemas, dropped and created again on every run
+BENCHMARK_SCHEMAS = {
+    'cdmDatabaseSchema': 'cdm',
+    'vocabDatabaseSchema': 'vocab',
+    'resultSchema': 'results',
+    'scratchSchema': 'scratch',
+    'webApiSchema': 'webapi',
+    'tempSchema': 'temp',
+}
+# settings that change how fast the setup runs, stored with every result
+TUNING_VARIABLES = [
+    'loadWorkers', 'chunkThresholdMb', 'chunkWorkers', 'bulkLoad', 'copyFormat', 'indexWorkers',
+    'constraintWorkers', 'maintenanceWorkers', 'statisticsTarget', 'achillesWorkers', 'maintenanceWorkMem',
+    'bulkLoadSettings', 'maintenanceSettings', 'analyticsSettings',
+]
+
+def configured_schemas() -> set:
+    # the schemas of the real setup in .env, which the benchmark must never drop
+    schemas = {os.getenv(variable, "").strip().lower() for variable in BENCHMARK_SCHEMAS}
+    schemas.update(schema.strip().lower() for schema in os.getenv("cdmSchemas", "").split(","))
+    return schemas - {""}
+
+def benchmark_schema_names(prefix: str, configured: set) -> dict:
+    """The benchmark schema of every schema variable, or ValueError when one could be a real schema."""
+    if not prefix.strip():
+        raise ValueError("benchmarkSchemaPrefix is empty, the benchmark would drop the schemas of the real setup")
+    names = {variable: prefix + schema for variable, schema in BENCHMARK_SCHEMAS.items()}
+    clashing = sorted(name for name in names.values() if name.lower() in configured)
+    if clashing:
+        raise ValueError(f"benchmark schema(s) {', '.join(clashing)} are configured in .env, "
+                         f"choose another benchmarkSchemaPrefix")
+    return names
+
+CONFIGURED_SCHEMAS = configured_schemas()
+try:
+    BENCHMARK_SCHEMA_NAMES = benchmark_schema_names(os.getenv("benchmarkSchemaPrefix", "bench_"), CONFIGURED_SCHEMAS)
+except ValueError as e:
+    sys.exit(f"Benchmark refused: {e}.")
+os.environ.update(BENCHMARK_SCHEMA_NAMES)
+folder = os.getenv("benchmarkFolder", "./benchmark_data")
+os.environ["cdmCsvFolder"] = os.path.join(folder, "cdm")
+os.environ["vocabCsvFolder"] = os.path.join(folder, "vocab")
+
+# imported after the schemas and folders are switched, the Config reads them on use
+from psycopg import sql
+from main import initialize_db_connector, run_database_ddl, load_initial_data, run_achilles_analysis
+from code_base.csv_loader import CSVLoader
+from code_base.metrics import RunMetrics
+from code_base.synthetic_cdm import SyntheticCDM
+
+def timed(stages: dict, name: str, step, *args, **kwargs):
+    started = time.perf_counter()
+    try:
+        return step(*args, **kwargs)
+    finally:
+        stages[name] = round(time.perf_counter() - started, 3)
+        print(f"Benchmark: {name} took {stages[name]:.1f}s.")
+
+def reset_schemas(db_conn):
+    # only the benchmark's own schemas are dropped, checked again right before
+    schemas = [os.environ[variable] for variable in BENCHMARK_SCHEMAS]
+    if schemas != list(BENCHMARK_SCHEMA_NAMES.values()) or any(schema.lower() in CONFIGURED_SCHEMAS for schema in schemas):
+        raise ValueError(f"refusing to drop {', '.join(schemas)}, not the benchmark's own schemas")
+    with db_conn.connect.cursor() as cursor:
+        for schema in schemas:
+            cursor.execute(sql.SQL("DROP SCHEMA IF EXISTS {} CASCADE").format(sql.Identifier(schema)))
+    db_conn.connect.commit()
+    db_conn.create_schemas()
+
+def step_totals(metrics: RunMetrics) -> dict:
+    """
+    Seconds per SQL file, and per kind of parallel step the sum over its
+    tables, constraints or statements (time spent, not elapsed).
+    """
+    steps = {}
+    for entry in metrics.entries:
+        if entry['stage'] == 'sql':
+            name = f"sql {entry['name']}"
+        elif entry['stage'] in ('load', 'index', 'constraint', 'maintenance', 'achilles', 'bulk'):
+            name = entry['stage']
+        else:
+            continue
+        steps[name] = round(steps.get(name, 0) + entry['wall_seconds'], 3)
+    return steps
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def previous_result(path: str, scale: float):
+    # the last earlier run at the same scale, to compare with
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                if result.get('scale') == scale:
+                    previous = result
+    return previous
+
+def compare(result: dict, previous: dict):
+    print(f"Benchmark at scale {result['scale']}, compared with {previous['started_at']} "
+          f"(commit {previous.get('commit')}):")
+    if result['settings'] != previous.get('settings'):
+        print(f"  settings {previous.get('settings')} -> {result['settings']}")
+    for group in ('stages', 'steps'):
+        for name, seconds in result[group].items():
+            before = previous.get(group, {}).get(name)
+            if before:
+                print(f"  {name:<32} {before:>9.1f}s -> {seconds:>9.1f}s  {100 * (seconds - before) / before:+.0f}%")
+            else:
+                print(f"  {name:<32} {'':>10} -> {seconds:>9.1f}s")
+
+def main():
+    scale = float(os.getenv("benchmarkScale", "1"))
+    seed = int(os.getenv("benchmarkSeed", "42"))
+    results_path = os.getenv("benchmarkResults", "benchmark_results.jsonl")
+    run_achilles = os.getenv("benchmarkAchilles", "true").lower() == "true"
+    metrics = RunMetrics()
+    stages = {}
+    db_conn = None
+    started_at = datetime.now().isoformat(timespec='seconds')
+    try:
+        db_conn, config = initialize_db_connector()
+        sql_paths = config.load_sql_configs()
+        generator = SyntheticCDM(sql_paths['cdm_sql_path'], sql_paths['vocab_sql_path'], scale=scale, seed=seed)
+        rows = timed(stages, 'generate', generator.generate, folder)
+
+        timed(stages, 'reset', reset_schemas, db_conn)
+        ddl, sql_paths = timed(stages, 'run_database_ddl', run_database_ddl, db_conn, config, create=True, metrics=metrics)
+        loader_configs = config.load_loader_configs()
+        vocab_loader = CSVLoader(db_connector=db_conn, metrics=metrics)
+        timed(stages, 'vocab load', vocab_loader.process_folder, schema=db_conn.vocabDatabaseSchema,
+              folder_path=os.environ["vocabCsvFolder"], delimiter='\t', workers=loader_configs['load_workers'])
+        timed(stages, 'load_initial_data', load_initial_data, db_conn, config, ddl, sql_paths, metrics=metrics)
+        if run_achilles and config.load_achilles_configs()['achilles_result_sql']:
+            timed(stages, 'run_achilles_analysis', run_achilles_analysis, db_conn, config, metrics=metrics)
+
+        with db_conn.connect.cursor() as cursor:
+            cursor.execute("SHOW server_version")
+            server_version = cursor.fetchone()[0]
+        db_conn.connect.commit()
+    except Exception as e:
+        print(f"Benchmark stopped: {e}")
+        return
+    finally:
+        if db_conn:
+            db_conn.close_connection()
+
+    result = {
+        'started_at': started_at,
+        'commit': git_commit(),
+        'scale': scale,
+        'seed': seed,
+        'persons': generator.persons,
+        'rows': sum(rows.values()),
+        'server_version': server_version,
+        'settings': {variable: os.getenv(variable) for variable in TUNING_VARIABLES if os.getenv(variable)},
+        'failed_steps': sum(1 for entry in metrics.entries if entry['status'] != 'ok'),
+        'total_seconds': round(sum(seconds for name, seconds in stages.items() if name != 'generate'), 3),
+        'stages': stages,
+        'steps': step_totals(metrics),
+    }
+    previous = previous_result(results_path, scale)
+    directory = os.path.dirname(results_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(results_path, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+    print(f"Benchmark result appended to {results_path}: {result['total_seconds']:.1f}s for {result['rows']} rows"
+          f"{', ' + str(result['failed_steps']) + ' failed step(s)' if result['failed_steps'] else ''}.")
+    if previous:
+        compare(result, previous)
+
+if __name__ == "__main__":
+    main()
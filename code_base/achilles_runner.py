@@ -0,0 +1,375 @@
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import psycopg
+from psycopg import sql
+from code_base.ddl import DDL, INDEX_PATTERN
+from code_base.sql_script import split_statements, statement_summary, code_only
+
+TABLE_NAME = r'((?:"?\w+"?\.)?"?\w+"?)'
+
+# statements that change or replace a table; nothing else may run on it meanwhile
+WRITE_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in (
+    r"\bCREATE\s+(?:(?:GLOBAL|LOCAL)\s+)?(?:TEMP\s+|TEMPORARY\s+|UNLOGGED\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?" + TABLE_NAME,
+    r"\bCREATE\s+(?:OR\s+REPLACE\s+)?(?:MATERIALIZED\s+)?VIEW\s+(?:IF\s+NOT\s+EXISTS\s+)?" + TABLE_NAME,
+    r"\bDROP\s+(?:TABLE|VIEW|MATERIALIZED\s+VIEW)\s+(?:IF\s+EXISTS\s+)?" + TABLE_NAME,
+    r"\bTRUNCATE\s+(?:TABLE\s+)?(?:ONLY\s+)?" + TABLE_NAME,
+    r"\bALTER\s+TABLE\s+(?:IF\s+EXISTS\s+)?(?:ONLY\s+)?" + TABLE_NAME,
+    r"\bUPDATE\s+(?:ONLY\s+)?(?!SET\b|CASCADE\b|RESTRICT\b|NO\b)" + TABLE_NAME,
+    r"\bDELETE\s+FROM\s+(?:ONLY\s+)?" + TABLE_NAME,
+    r"\bCREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:CONCURRENTLY\s+)?(?:IF\s+NOT\s+EXISTS\s+)?(?:\w+\s+)?ON\s+(?:ONLY\s+)?" + TABLE_NAME,
+    r"\bANALYZE\s+(?:VERBOSE\s+)?" + TABLE_NAME,
+    r"\bREFRESH\s+MATERIALIZED\s+VIEW\s+(?:CONCURRENTLY\s+)?" + TABLE_NAME,
+)]
+# INSERTs only add rows; two of them into the same table can run side by side
+APPEND_PATTERN = re.compile(r"\bINSERT\s+INTO\s+" + TABLE_NAME, re.IGNORECASE)
+READ_PATTERN = re.compile(r"\b(?:FROM|JOIN|REFERENCES)\s+" + TABLE_NAME, re.IGNORECASE)
+CTE_PATTERN = re.compile(r"(?:\bWITH(?:\s+RECURSIVE)?|,)\s*(\w+)\s+AS\s*(?:NOT\s+)?(?:MATERIALIZED\s+)?\(", re.IGNORECASE)
+TEMP_TABLE_PATTERN = re.compile(
+    r"\bCREATE\s+(?:(?:GLOBAL|LOCAL)\s+)?(?:TEMP|TEMPORARY)\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?" + TABLE_NAME,
+    re.IGNORECASE
+)
+
+
+class AchillesRunner:
+    """
+    Runs the Achilles scripts on a pool of connections. The scripts are
+    split into statements, and the tables each statement reads, inserts into
+    or otherwise writes are taken from its text. A statement waits for every
+    earlier statement it conflicts with: a read or write after a write, and
+    a write after a read. INSERTs into the same table don't conflict, so the
+    concept_hierarchy blocks fill it side by side.
+
+    Temp tables only exist in the session that created them, so all
+    statements from the first to the last one using a temp table form one
+    unit that runs on a single connection (the heracles_periods dates, the
+    tmp_counts block of achilles_count.sql). A statement without any table
+    it recognizes (SET, DO, ...) is a barrier: it waits for everything
+    before it, and everything after waits for it.
+
+    A failing unit is rolled back and the units that depend on it are
+    skipped; independent units still run.
+
+    With incremental, a fingerprint of every source table (the tables the
+    scripts read but don't build) is kept in <resultSchema>.achilles_fingerprint,
+    and only the units affected by a changed source table run again, see
+    _affected. A fingerprint is only stored once every unit reading the table
+    went through, so a failed unit is retried on the next run.
+    """
+    def __init__(self, ddl: DDL, workers: int = 4, incremental: bool = False):
+        self.ddl = ddl
+        self.db_connector = ddl.db_connector
+        self.workers = workers
+        self.incremental = incremental
+        self.fingerprint_schema = self.db_connector.resultsDatabaseSchema
+        self.fingerprint_table = "achilles_fingerprint"
+
+    def run(self, paths: list) -> bool:
+        units = self._plan(paths)
+        if not units:
+            print("No Achilles statements found.")
+            return True
+        fingerprints = None
+        if self.incremental:
+            fingerprints = self._fingerprints(self._source_tables(units))
+            stored = self._stored_fingerprints()
+            if stored is not None and fingerprints is not None:
+                units = self._select_changed(units, fingerprints, stored)
+                if not units:
+                    return True
+        started = time.perf_counter()
+        results = {}
+        pool = self.db_connector.create_pool(max_size=min(self.workers, len(units)), profile='analytics')
+        if pool is None:
+            return False
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                self._schedule(executor, pool, units, results)
+        finally:
+            pool.close()
+        self._report(units, results, time.perf_counter() - started)
+        if fingerprints is not None:
+            self._save_fingerprints(fingerprints, units, results)
+        return all(results[unit['id']][1] is None for unit in units)
+
+    # Incremental mode
+
+    def _source_tables(self, units: list) -> set:
+        built = set().union(*(unit['writes'] | unit['appends'] for unit in units))
+        return set().union(*(unit['reads'] for unit in units)) - built
+
+    def _select_changed(self, units: list, fingerprints: dict, stored: dict) -> list:
+        changed = {table for table, (fingerprint, _) in fingerprints.items() if stored.get(table) != fingerprint}
+        if not stored:
+            print("Incremental Achilles: no fingerprints recorded yet, running everything.")
+            return units
+        selected = self._affected(units, changed)
+        if changed:
+            print(f"Incremental Achilles: {len(changed)} of {len(fingerprints)} source table(s) changed "
+                  f"({', '.join(sorted(changed))}); rerunning {len(selected)} of {len(units)} unit(s).")
+        else:
+            print(f"Incremental Achilles: none of {len(fingerprints)} source table(s) changed, nothing to rerun.")
+        ids = {unit['id'] for unit in selected}
+        # dependencies on units that don't run again are already met
+        return [dict(unit, depends_on=unit['depends_on'] & ids) for unit in selected]
+
+    def _affected(self, units: list, changed: set) -> list:
+        """
+        The units that read a changed source table, and then every unit that
+        touches a table one of those rebuilds: a read of it has to run again,
+        and so do the other statements building it (the TRUNCATE before the
+        concept_hierarchy INSERTs, the rest of its INSERTs). Units that only
+        index or analyze such a table keep what they did.
+        """
+        selected = {unit['id'] for unit in units if unit['reads'] & changed}
+        dirty = set()
+        while True:
+            for unit in units:
+                if unit['id'] in selected:
+                    dirty |= unit['writes'] | unit['appends']
+            grown = {
+                unit['id'] for unit in units
+                if unit['id'] not in selected
+                and (unit['reads'] | unit['writes'] | unit['appends']) & dirty
+                and not all(statement['maintenance'] for statement in unit['statements'])
+            }
+            if selected and any(unit['barrier'] for unit in units):
+                grown |= {unit['id'] for unit in units if unit['barrier']} - selected
+            if not grown:
+                break
+            selected |= grown
+        return [unit for unit in units if unit['id'] in selected]
+
+    def _fingerprints(self, tables: set):
+        """
+        {table: (fingerprint, live rows)} for the tables that exist. The
+        fingerprint covers the table's file node (TRUNCATE and full reloads
+        change it) and its insert/update/delete counters, for a view those of
+        the tables it selects from. Reading it costs no scan; a statistics
+        reset only makes a table look changed once.
+        """
+        fingerprints = {}
+        try:
+            with self.db_connector.connect.cursor() as cursor:
+                if self.db_connector.connect.info.server_version >= 150000:
+                    # this session's own counters (a load on the same connection) are
+                    # only published once it goes idle
+                    cursor.execute("SELECT pg_stat_force_next_flush()")
+                    self.db_connector.connect.commit()
+                for table in sorted(tables):
+                    cursor.execute(
+                        "WITH target AS (SELECT to_regclass(%s) AS oid), "
+                        "relations AS ("
+                        "  SELECT oid FROM target "
+                        "  UNION SELECT d.refobjid FROM pg_rewrite r "
+                        "  JOIN pg_depend d ON d.classid = 'pg_rewrite'::regclass AND d.objid = r.oid "
+                        "  WHERE r.ev_class = (SELECT oid FROM target) "
+                        "  AND d.refclassid = 'pg_class'::regclass AND d.refobjid <> r.ev_class) "
+                        "SELECT md5(string_agg(concat_ws(':', c.oid, pg_relation_filenode(c.oid), "
+                        "  s.n_tup_ins, s.n_tup_upd, s.n_tup_del), ',' ORDER BY c.oid)), sum(s.n_live_tup) "
+                        "FROM relations JOIN pg_class c ON c.oid = relations.oid "
+                        "LEFT JOIN pg_stat_all_tables s ON s.relid = c.oid",
+                        (table,)
+                    )
+                    fingerprint, rows = cursor.fetchone()
+                    if fingerprint is not None:
+                        # names that aren't tables (a function argument after FROM) drop out here
+                        fingerprints[table] = (fingerprint, rows)
+            self.db_connector.connect.commit()
+            return fingerprints
+        except (Exception, psycopg.Error) as e:
+            self.db_connector.connect.rollback()
+            print(f"Could not fingerprint the source tables, running everything: {e}")
+            return None
+
+    def _stored_fingerprints(self):
+        # {table: fingerprint} of the last run, None when the table can't be used
+        try:
+            with self.db_connector.connect.cursor() as cursor:
+                cursor.execute(
+                    sql.SQL(
+                        "CREATE TABLE IF NOT EXISTS {}.{} ("
+                        "table_name varchar(500) PRIMARY KEY, "
+                        "fingerprint varchar(32) NOT NULL, "
+                        "live_rows bigint, "
+                        "recorded_at timestamp NOT NULL DEFAULT now())"
+                    ).format(sql.Identifier(self.fingerprint_schema), sql.Identifier(self.fingerprint_table))
+                )
+                cursor.execute(
+                    sql.SQL("SELECT table_name, fingerprint FROM {}.{}").format(
+                        sql.Identifier(self.fingerprint_schema), sql.Identifier(self.fingerprint_table)
+                    )
+                )
+                stored = dict(cursor.fetchall())
+            self.db_connector.connect.commit()
+            return stored
+        except (Exception, psycopg.Error) as e:
+            self.db_connector.connect.rollback()
+            print(f"No Achilles fingerprints, running everything: {e}")
+            return None
+
+    def _save_fingerprints(self, fingerprints: dict, units: list, results: dict):
+        failed_reads = set().union(*(unit['reads'] for unit in units if results[unit['id']][1] is not None))
+        rows = [
+            (table, fingerprint, live_rows)
+            for table, (fingerprint, live_rows) in fingerprints.items()
+            if table not in failed_reads
+        ]
+        try:
+            with self.db_connector.connect.cursor() as cursor:
+                cursor.executemany(
+                    sql.SQL(
+                        "INSERT INTO {}.{} (table_name, fingerprint, live_rows) VALUES (%s, %s, %s) "
+                        "ON CONFLICT (table_name) DO UPDATE SET fingerprint = EXCLUDED.fingerprint, "
+                        "live_rows = EXCLUDED.live_rows, recorded_at = now()"
+                    ).format(sql.Identifier(self.fingerprint_schema), sql.Identifier(self.fingerprint_table)),
+                    rows
+                )
+            self.db_connector.connect.commit()
+        except (Exception, psycopg.Error) as e:
+            self.db_connector.connect.rollback()
+            print(f"Could not store the Achilles fingerprints, the next run redoes everything: {e}")
+
+    def _plan(self, paths: list) -> list:
+        statements = []
+        for path in paths:
+            for index, statement in enumerate(split_statements(self.ddl._read_sql_file(path))):
+                statements.append(self._analyze(os.path.basename(path), index, statement))
+
+        units = []
+        for group in self._temp_spans(statements):
+            unit = {
+                'id': len(units),
+                'statements': group,
+                'reads': set().union(*(statement['reads'] for statement in group)),
+                'appends': set().union(*(statement['appends'] for statement in group)),
+                'writes': set().union(*(statement['writes'] for statement in group)),
+                'barrier': any(statement['barrier'] for statement in group),
+            }
+            unit['depends_on'] = {earlier['id'] for earlier in units if self._conflicts(earlier, unit)}
+            units.append(unit)
+        return units
+
+    def _analyze(self, file_name: str, index: int, statement: str) -> dict:
+        code = code_only(statement)
+        ctes = {name.lower() for name in CTE_PATTERN.findall(code)}
+        writes = {self._name(match) for pattern in WRITE_PATTERNS for match in pattern.findall(code)}
+        appends = {self._name(match) for match in APPEND_PATTERN.findall(code)}
+        reads = {self._name(match) for match in READ_PATTERN.findall(code)} - ctes - writes - appends
+        return {
+            'file': file_name,
+            'index': index,
+            'statement': statement,
+            'reads': reads,
+            'appends': appends,
+            'writes': writes,
+            'temp_tables': {self._name(match) for match in TEMP_TABLE_PATTERN.findall(code)},
+            'barrier': not (reads or appends or writes),
+            # CREATE INDEX / ANALYZE don't change the rows of their table
+            'maintenance': bool(INDEX_PATTERN.search(code) or re.match(r"\s*ANALYZE\b", code, re.IGNORECASE)),
+        }
+
+    def _name(self, name: str) -> str:
+        return name.replace('"', '').lower()
+
+    def _temp_spans(self, statements: list) -> list:
+        # each temp table pulls the statements from its first to its last use
+        # into one group; overlapping spans merge
+        temp_tables = set().union(*(statement['temp_tables'] for statement in statements))
+        spans = {}
+        for position, statement in enumerate(statements):
+            used = temp_tables & (statement['reads'] | statement['appends'] | statement['writes'])
+            for table in used:
+                first, _ = spans.get(table, (position, position))
+                spans[table] = (first, position)
+        ends = {}
+        for first, last in spans.values():
+            ends[first] = max(ends.get(first, first), last)
+
+        groups, position = [], 0
+        while position < len(statements):
+            last = ends.get(position, position)
+            end = position
+            while end < last:
+                end += 1
+                last = max(last, ends.get(end, end))
+            groups.append(statements[position:last + 1])
+            position = last + 1
+        return groups
+
+    def _conflicts(self, earlier: dict, later: dict) -> bool:
+        if earlier['barrier'] or later['barrier']:
+            return True
+        return bool(
+            earlier['writes'] & (later['reads'] | later['appends'] | later['writes'])
+            or earlier['appends'] & (later['reads'] | later['writes'])
+            or earlier['reads'] & (later['appends'] | later['writes'])
+        )
+
+    def _schedule(self, executor, pool, units: list, results: dict):
+        pending = {unit['id']: unit for unit in units}
+        running = {}
+        while pending or running:
+            for unit_id, unit in list(pending.items()):
+                if any(results.get(dependency, (None, None))[1] is not None for dependency in unit['depends_on']):
+                    # something it waits for failed or was skipped
+                    results[unit_id] = (0.0, "skipped, an earlier unit it depends on failed", 0)
+                    del pending[unit_id]
+                elif unit['depends_on'] <= results.keys():
+                    running[executor.submit(self._run_unit, pool, unit)] = unit_id
+                    del pending[unit_id]
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+
+    def _run_unit(self, pool, unit: dict) -> tuple:
+        """Returns (seconds, error or None, statements run)."""
+        started = time.perf_counter()
+        ran, error = 0, None
+        with pool.connection() as connection:
+            for statement in unit['statements']:
+                try:
+                    with connection.cursor() as cursor:
+                        self.ddl._execute_statement(cursor, statement['statement'],
+                                                    f"{statement['file']}#{statement['index'] + 1}")
+                    connection.commit()
+                    ran += 1
+                except (Exception, psycopg.Error) as e:
+                    connection.rollback()
+                    if isinstance(e, psycopg.errors.DuplicateTable) and statement['maintenance']:
+                        # the scripts' CREATE INDEX has no IF NOT EXISTS; on a rerun it's there already
+                        ran += 1
+                        continue
+                    error = f"{statement['file']} statement {statement['index'] + 1}: {str(e).strip().splitlines()[0]}"
+                    break
+        seconds = time.perf_counter() - started
+        if self.ddl.metrics:
+            self.ddl.metrics.record('achilles', self._label(unit), seconds,
+                                    status='ok' if error is None else 'failed',
+                                    detail=statement_summary(unit['statements'][0]['statement']))
+        return seconds, error, ran
+
+    def _label(self, unit: dict) -> str:
+        first, last = unit['statements'][0], unit['statements'][-1]
+        if first is last:
+            return f"{first['file']}#{first['index'] + 1}"
+        return f"{first['file']}#{first['index'] + 1}-{last['index'] + 1}"
+
+    def _report(self, units: list, results: dict, seconds: float):
+        statements = sum(len(unit['statements']) for unit in units)
+        serial = sum(unit_seconds for unit_seconds, _, _ in results.values())
+        failed = [unit for unit in units if results[unit['id']][1] is not None]
+        print(f"Achilles: {statements} statement(s) in {len(units)} unit(s) with {self.workers} worker(s) "
+              f"in {seconds:.1f}s ({serial:.1f}s of statement time).")
+        for unit in failed:
+            print(f"  {self._label(unit)} - {results[unit['id']][1]}")
+        slowest = sorted(units, key=lambda unit: results[unit['id']][0], reverse=True)
+        for unit in slowest[:3]:
+            if results[unit['id']][0] >= 1:
+                print(f"  {results[unit['id']][0]:.1f}s  {self._label(unit)}  "
+                      f"{statement_summary(unit['statements'][0]['statement'], 60)}")
+        if failed:
+            print(f"{len(failed)} Achilles unit(s) failed or were skipped.")
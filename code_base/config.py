@@ -50,6 +50,8 @@ class Config:
         return {
             "etlrole": os.getenv("role1"),
             "webapirole": os.getenv("role2"),
+            # only print the permission changes setup_security_and_roles would make
+            "permissions_dry_run": os.getenv("permissionsDryRun", "false").lower() == "true",
         }
     
     def load_sql_configs(self):
@@ -69,10 +71,89 @@ class Config:
             "cdm_csv_folder": os.getenv("cdmCsvFolder"),
         }
     
+    def load_loader_configs(self):
+        return {
+            "load_workers": int(os.getenv("loadWorkers", "1")),
+            "chunk_threshold_mb": int(os.getenv("chunkThresholdMb", "0")),
+            "chunk_workers": int(os.getenv("chunkWorkers", "4")),
+            "bulk_load": os.getenv("bulkLoad", "false").lower() == "true",
+            "load_manifest": os.getenv("loadManifest", "false").lower() == "true",
+            "copy_format": os.getenv("copyFormat", "csv").lower(),
+            # unset keeps the all-or-nothing load per table
+            "max_rejects": int(os.getenv("maxRejects")) if os.getenv("maxRejects") else None,
+            "batch_rows": int(os.getenv("batchRows", "100000")),
+            # hash IDs and normalize dates while loading, instead of running formatter.py first
+            "pseudonymize": os.getenv("pseudonymize", "false").lower() == "true",
+            # the persistent ID map formatter.py uses, shared by the pseudonymize stage
+            "id_map_path": os.getenv("idMapPath"),
+        }
+
+    def load_index_configs(self):
+        return {
+            # > 1 builds the indices table by table on a pool of connections
+            "index_workers": int(os.getenv("indexWorkers", "1")),
+        }
+
+    def load_session_profiles(self):
+        # overrides of the session settings per profile (see db_connector.SESSION_PROFILES),
+        # each variable a comma-separated list like "work_mem=512MB,synchronous_commit=off"
+        maintenance = {}
+        if os.getenv("maintenanceWorkMem"):
+            maintenance["maintenance_work_mem"] = os.getenv("maintenanceWorkMem")
+        if os.getenv("parallelMaintenanceWorkers"):
+            maintenance["max_parallel_maintenance_workers"] = os.getenv("parallelMaintenanceWorkers")
+        return {
+            "bulk_load": self._parse_settings(os.getenv("bulkLoadSettings")),
+            "maintenance": {**maintenance, **self._parse_settings(os.getenv("maintenanceSettings"))},
+            "analytics": self._parse_settings(os.getenv("analyticsSettings")),
+        }
+
+    def _parse_settings(self, value):
+        settings = {}
+        for item in (value or "").split(","):
+            if "=" in item:
+                name, setting = item.split("=", 1)
+                settings[name.strip()] = setting.strip()
+        return settings
+
+    def load_constraint_configs(self):
+        return {
+            # > 1 adds the foreign keys NOT VALID and validates them on a pool of connections
+            "constraint_workers": int(os.getenv("constraintWorkers", "1")),
+        }
+
+    def load_maintenance_configs(self):
+        return {
+            # VACUUM (ANALYZE) of the loaded tables at the end of load_initial_data
+            "post_load_maintenance": os.getenv("postLoadMaintenance", "true").lower() == "true",
+            "maintenance_workers": int(os.getenv("maintenanceWorkers", "4")),
+            # statistics target of the join columns matching statisticsColumns, 0 leaves them alone
+            "statistics_target": int(os.getenv("statisticsTarget", "1000")),
+            "statistics_columns": [column.strip() for column in
+                                   os.getenv("statisticsColumns", "person_id,*_concept_id").split(",") if column.strip()],
+        }
+
+    def load_report_configs(self):
+        run_report = os.getenv("runReport", "run_report.json")
+        return {
+            # JSON run report; a .csv with the same entries is written next to it
+            "run_report": run_report,
+            # the query profile goes next to it, as <run report>_plans.json
+            "profile_report": os.path.splitext(run_report)[0] + "_plans.json",
+            # profiles DDL and Achilles statements under EXPLAIN ANALYZE, see query_profiler.py
+            "profile_sql": os.getenv("profileSql", "false").lower() == "true",
+            # sequential scans of vocab tables reading this many rows are flagged
+            "profile_seq_scan_rows": int(os.getenv("profileSeqScanRows", "1000000")),
+        }
+
     def load_achilles_configs(self):
         return {
             "achilles_result_sql": os.getenv("achillesResult"),
             "achilles_count_sql": os.getenv("achillesCount"),
+            # > 1 runs independent Achilles statements side by side on a pool of connections
+            "achilles_workers": int(os.getenv("achillesWorkers", "1")),
+            # reruns only what depends on source tables that changed since the last run
+            "achilles_incremental": os.getenv("achillesIncremental", "false").lower() == "true",
         }
         
     # Get the list of CDM schemas from the environment variable and return it as a dictionary
@@ -81,6 +162,12 @@ class Config:
             "cdm_schemas": os.getenv("cdmSchemas").split(","),
         }
         
+    def load_view_configs(self):
+        return {
+            # CDM schemas whose vocab views are created side by side
+            "view_workers": int(os.getenv("viewWorkers", "4")),
+        }
+
     # Get the list of all vocabulary tables
     def load_vocab_tables(self):
         return {
@@ -0,0 +1,191 @@
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import psycopg
+from psycopg import sql
+from code_base.ddl import DDL
+from code_base.sql_script import split_statements, statement_summary
+
+# ALTER TABLE <table> ADD CONSTRAINT <name> FOREIGN KEY (<columns>) REFERENCES <table> (<columns>)
+FOREIGN_KEY_PATTERN = re.compile(
+    r"ALTER\s+TABLE\s+([\w.]+)\s+ADD\s+CONSTRAINT\s+(\w+)\s+FOREIGN\s+KEY\s*\(([^)]*)\)\s*"
+    r"REFERENCES\s+([\w.]+)\s*\(([^)]*)\)",
+    re.IGNORECASE
+)
+
+# violating keys shown per failed constraint
+VIOLATION_SAMPLE = 5
+
+class ConstraintBuilder:
+    """
+    Applies constraints.sql in two steps. First every foreign key is added
+    NOT VALID: that skips the scan of existing rows and only holds its locks
+    for a moment, while new rows are checked from then on. Then the existing
+    rows are checked with VALIDATE CONSTRAINT on a pool of connections. It
+    takes a lighter lock, which lets reads and writes go on. Validations of
+    one table share a connection, since they would wait for each other
+    anyway.
+
+    A constraint that fails validation stays NOT VALID and is reported with
+    a sample of the keys that have no match. Constraints that already exist
+    are not added again, and validated ones are not checked again.
+    """
+    def __init__(self, ddl: DDL, workers: int = 4):
+        self.ddl = ddl
+        self.db_connector = ddl.db_connector
+        self.workers = workers
+
+    def build(self, path: str) -> bool:
+        foreign_keys, others = self._plan(path)
+        existing = self._existing_foreign_keys()
+        started = time.perf_counter()
+
+        added, failed_adds = 0, []
+        connection = self.db_connector.connect
+        for key in foreign_keys:
+            if (key['table'], key['name']) in existing:
+                continue
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(key['statement'] + " NOT VALID")
+                connection.commit()
+                existing[(key['table'], key['name'])] = False
+                added += 1
+            except (Exception, psycopg.Error) as e:
+                connection.rollback()
+                failed_adds.append((key['name'], str(e).strip()))
+        for statement in others:
+            # anything in the file that isn't a foreign key runs as written
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(statement)
+                connection.commit()
+            except (Exception, psycopg.Error) as e:
+                connection.rollback()
+                failed_adds.append((statement_summary(statement, 40), str(e).strip()))
+        print(f"Constraints: {added} foreign key(s) added NOT VALID in {time.perf_counter() - started:.1f}s.")
+
+        pending = {}
+        for key in foreign_keys:
+            if existing.get((key['table'], key['name'])) is False:
+                pending.setdefault(key['table'], []).append(key)
+        results = self._validate(pending)
+
+        self._report(results, failed_adds, time.perf_counter() - started)
+        return not failed_adds and all(error is None for _, _, error, _ in results)
+
+    def _plan(self, path: str):
+        foreign_keys, others = [], []
+        for statement in split_statements(self.ddl._read_sql_file(path)):
+            match = FOREIGN_KEY_PATTERN.search(statement)
+            if match is None:
+                others.append(statement)
+                continue
+            foreign_keys.append({
+                'statement': statement,
+                'table': match.group(1).lower(),
+                'name': match.group(2).lower(),
+                'columns': [column.strip().lower() for column in match.group(3).split(',')],
+                'referenced_table': match.group(4).lower(),
+                'referenced_columns': [column.strip().lower() for column in match.group(5).split(',')],
+            })
+        return foreign_keys, others
+
+    def _existing_foreign_keys(self) -> dict:
+        # {(schema.table, constraint name): validated}
+        with self.db_connector.connect.cursor() as cursor:
+            cursor.execute(
+                "SELECT n.nspname || '.' || t.relname, c.conname, c.convalidated "
+                "FROM pg_constraint c "
+                "JOIN pg_class t ON t.oid = c.conrelid "
+                "JOIN pg_namespace n ON n.oid = t.relnamespace "
+                "WHERE c.contype = 'f'"
+            )
+            existing = {(table, name): validated for table, name, validated in cursor.fetchall()}
+        self.db_connector.connect.commit()
+        return existing
+
+    def _validate(self, pending: dict) -> list:
+        if not pending:
+            return []
+        results = []
+        pool = self.db_connector.create_pool(max_size=min(self.workers, len(pending)), profile='maintenance')
+        if pool is None:
+            return [(key['name'], 0.0, "no connection pool", None) for keys in pending.values() for key in keys]
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(self._validate_table, pool, keys) for keys in pending.values()]
+                for future in as_completed(futures):
+                    results.extend(future.result())
+        finally:
+            pool.close()
+        return results
+
+    def _validate_table(self, pool, keys: list) -> list:
+        """Returns (constraint, seconds, error or None, violating keys) per constraint."""
+        results = []
+        with pool.connection() as connection:
+            for key in keys:
+                started = time.perf_counter()
+                try:
+                    with connection.cursor() as cursor:
+                        cursor.execute(
+                            sql.SQL("ALTER TABLE {} VALIDATE CONSTRAINT {}").format(
+                                self._qualified(key['table']), sql.Identifier(key['name'])
+                            )
+                        )
+                    connection.commit()
+                    results.append((key['name'], time.perf_counter() - started, None, None))
+                except (Exception, psycopg.Error) as e:
+                    connection.rollback()
+                    sample = None
+                    if isinstance(e, psycopg.errors.ForeignKeyViolation):
+                        sample = self._violations(connection, key)
+                    results.append((key['name'], time.perf_counter() - started, str(e).strip().splitlines()[0], sample))
+                if self.ddl.metrics:
+                    self.ddl.metrics.record('constraint', key['name'], results[-1][1],
+                                            status='ok' if results[-1][2] is None else 'failed', detail=key['table'])
+        return results
+
+    def _violations(self, connection, key: dict) -> list:
+        # a few child keys without a parent row
+        columns = [sql.SQL("t.{}").format(sql.Identifier(column)) for column in key['columns']]
+        join = sql.SQL(" AND ").join(
+            sql.SQL("r.{} = t.{}").format(sql.Identifier(referenced), sql.Identifier(column))
+            for column, referenced in zip(key['columns'], key['referenced_columns'])
+        )
+        not_null = sql.SQL(" AND ").join(sql.SQL("{} IS NOT NULL").format(column) for column in columns)
+        query = sql.SQL(
+            "SELECT DISTINCT {} FROM {} t LEFT JOIN {} r ON {} WHERE {} AND r.{} IS NULL LIMIT {}"
+        ).format(
+            sql.SQL(", ").join(columns), self._qualified(key['table']), self._qualified(key['referenced_table']),
+            join, not_null, sql.Identifier(key['referenced_columns'][0]), sql.Literal(VIOLATION_SAMPLE)
+        )
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(query)
+                rows = cursor.fetchall()
+            connection.commit()
+            return [row[0] if len(row) == 1 else row for row in rows]
+        except (Exception, psycopg.Error) as e:
+            connection.rollback()
+            print(f"Could not sample violations of {key['name']}: {e}")
+            return None
+
+    def _qualified(self, table: str):
+        return sql.Identifier(*table.split('.'))
+
+    def _report(self, results: list, failed_adds: list, seconds: float):
+        failed = [result for result in results if result[2] is not None]
+        print(f"Constraints: validated {len(results) - len(failed)} of {len(results)} foreign key(s) "
+              f"with {self.workers} worker(s) in {seconds:.1f}s.")
+        for name, error in failed_adds:
+            print(f"  could not add {name}: {error}")
+        for name, _, error, sample in sorted(failed):
+            print(f"  {name} stays NOT VALID: {error}")
+            if sample:
+                print(f"    keys without a match, e.g.: {', '.join(str(value) for value in sample)}")
+        slowest = sorted((result for result in results if result[2] is None), key=lambda result: result[1], reverse=True)
+        for name, validate_seconds, _, _ in slowest[:3]:
+            if validate_seconds >= 1:
+                print(f"  {validate_seconds:.1f}s  {name}")
@@ -1,13 +1,93 @@
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
 import psycopg
 from psycopg import sql
 from tqdm import tqdm
-import pandas as pd
 from code_base.db_connector import DBConnector
+from code_base.load_manifest import LoadManifest
+from code_base.csv_source import as_source, find_sources
+from code_base.row_transform import RowTransform
+from code_base.pseudonymize import Pseudonymizer
+from code_base.metrics import RunMetrics, server_clock
+
+# rows are re-encoded and handed to COPY in blocks of about this size
+COPY_BLOCK_SIZE = 1024 * 1024
+
+# rows checked before a file is loaded with binary COPY, see _binary_dates_ok
+DATE_SAMPLE_ROWS = 1000
+
+def _parse_date(value: str) -> date:
+    try:
+        return date.fromisoformat(value)  # also takes the 20230131 form of the vocab files
+    except ValueError:
+        return datetime.fromisoformat(value).date()
+
+def _parse_numeric(value: str) -> Decimal:
+    # Decimal raises InvalidOperation, an ArithmeticError; the loaders expect a ValueError
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        raise ValueError(f"invalid numeric value: {value!r}") from None
+
+# what Postgres' boolean input takes: true/false, yes/no, on/off, 1/0 and
+# the unique prefixes of the words, in any case
+BOOL_TRUE = {'t', 'tr', 'tru', 'true', 'y', 'ye', 'yes', 'on', '1'}
+BOOL_FALSE = {'f', 'fa', 'fal', 'fals', 'false', 'n', 'no', 'of', 'off', '0'}
+
+def _parse_bool(value: str) -> bool:
+    # anything else is rejected, as text COPY would
+    value = value.strip().lower()
+    if value in BOOL_TRUE:
+        return True
+    if value in BOOL_FALSE:
+        return False
+    raise ValueError(f"invalid boolean value: {value!r}")
+
+# Client-side parsers for FORMAT BINARY, by Postgres type name. Empty fields
+# are NULL, as in the CSV format. Dates and timestamps must be ISO 8601;
+# text COPY would also take what the server's DateStyle accepts.
+BINARY_CONVERTERS = {
+    'int2': int,
+    'int4': int,
+    'int8': int,
+    'numeric': _parse_numeric,
+    'float4': float,
+    'float8': float,
+    'date': _parse_date,
+    'timestamp': datetime.fromisoformat,
+    'timestamptz': datetime.fromisoformat,
+    'bool': _parse_bool,
+    'varchar': str,
+    'bpchar': str,
+    'text': str,
+}
 
 class CSVLoader:
-    def __init__(self, db_connector: DBConnector):
+    def __init__(self, db_connector: DBConnector, manifest: LoadManifest = None, binary: bool = False,
+                 max_rejects: int = None, batch_rows: int = 100000, metrics: RunMetrics = None,
+                 pseudonymizer: Pseudonymizer = None):
         self.db_connector = db_connector
+        # optional stage that hashes the ID columns and normalizes the dates of
+        # every file on its way into COPY, instead of a formatter.py pass
+        self.pseudonymizer = pseudonymizer
+        # optional run metrics, one entry per loaded file
+        self.metrics = metrics
+        # optional load manifest, lets process_folder skip files that are already in
+        self.manifest = manifest
+        # binary=True parses the rows here and sends FORMAT BINARY, so the
+        # database server doesn't have to parse the text
+        self.binary = binary
+        # Error-tolerant mode (see load_file_tolerant): off while max_rejects is
+        # None, otherwise the number of bad rows a table may reject before the
+        # load is aborted.
+        self.max_rejects = max_rejects
+        self.batch_rows = batch_rows
+        self.reject_schema = db_connector.resultsDatabaseSchema
+        self.reject_table = "load_rejects"
+        self._reject_table_ready = False
         # This map allows you to specify a non-standard delimiter for certain files.
         # The filename (without extension) is matched against the keys.
         self.delimiter_map = {
@@ -16,79 +96,662 @@ class CSVLoader:
             'caret_separated_table': '^',
             'comma_separated_table': ',',
         }
+        # Streaming row transforms, keyed like delimiter_map by the file name
+        # (without extension). Applied while the rows go into COPY.
+        self.transforms = {
+            # loading cpt4 concepts into concept table
+            'concept_cpt4': RowTransform(
+                defaults={'concept_name': 'Unknown CPT4 Concept'},
+                target_table='concept',
+            ),
+        }
 
-    def load_file(self, schema: str, table: str, file_path: str, delimiter: str = '\t'):
-        copy_query = sql.SQL(
-            "COPY {}.{} FROM STDIN WITH (FORMAT CSV, HEADER TRUE, DELIMITER {}, QUOTE E'\\b')"
-        ).format(
-            sql.Identifier(schema),
-            sql.Identifier(table),
-            sql.Literal(delimiter)
-        )
+    def load_file(self, schema: str, table: str, file_path, delimiter: str = '\t', connection=None) -> bool:
+        # file_path may also be a CSVSource, e.g. a compressed file or zip member.
+        # process_folder passes in a bulk-load session, direct calls without
+        # one go through the shared connection.
+        source = as_source(file_path)
+        connection = connection or self.db_connector.connect
+        started = time.perf_counter()
 
         try:
-            file_size = os.path.getsize(file_path)
+            file_size = source.size
             
-            with self.db_connector.connect.cursor() as cursor:
-                with open(file_path, 'rb') as f:
-                    # Initialize tqdm with the file size
-                    with tqdm(
-                        total=file_size, 
-                        desc=f"Streaming {table}", 
-                        unit='B', 
-                        unit_scale=True,
-                        leave=False # Cleans up the bar after the file is done
-                    ) as pbar:
-                        
+            with connection.cursor() as cursor:
+                # Initialize tqdm with the file size
+                with tqdm(
+                    total=file_size, 
+                    desc=f"Streaming {table}", 
+                    unit='B', 
+                    unit_scale=True,
+                    leave=False # Cleans up the bar after the file is done
+                ) as pbar:
+                    # the source updates the bar itself, for compressed inputs
+                    # it counts the compressed bytes read from disk
+                    with source.open(pbar.update) as f:
+                        columns = self._header_columns(f.readline(), delimiter)
+                        copy_query, apply, converters = self._prepare_copy(cursor, schema, table, source, columns, delimiter)
+                        transaction_start = server_clock(cursor) if self.metrics else None
                         with cursor.copy(copy_query) as copy:
-                            while data := f.read(1024 * 1024): # 1MB chunks
-                                copy.write(data)
-                                pbar.update(len(data)) # Update progress by the number of bytes read
-                    
-                self.db_connector.connect.commit()
+                            if apply or converters:
+                                self._copy_lines(copy, f, delimiter, apply, converters)
+                            else:
+                                while data := f.read(1024 * 1024): # 1MB chunks
+                                    copy.write(data)
+                        rows = cursor.rowcount
+
+                transaction_seconds = server_clock(cursor) - transaction_start if self.metrics else None
+                if self.manifest:
+                    self.manifest.mark(cursor, schema, table, source, 'loaded', rows=rows)
+                connection.commit()
+                self._record(table, source, started, rows, transaction_seconds)
                 print(f" -> OK: '{table}' loaded.")
+                return True
 
         except Exception as error:
-            self.db_connector.connect.rollback()
+            connection.rollback()
+            print(f"\n -> FAILED: {table}: {error}")
+            self._record(table, source, started, status='failed')
+            if self.manifest:
+                self.manifest.mark_failed(connection, schema, table, source)
+            return False
+
+    def load_file_chunked(self, schema: str, table: str, file_path: str, delimiter: str = '\t', workers: int = 4) -> bool:
+        """
+        Splits one large file into newline-aligned byte ranges and streams them
+        concurrently into the same table, one pooled connection per range.
+        The ranges are only committed once every one of them has loaded;
+        otherwise they are all rolled back and the failed ranges are reported.
+        """
+        source = as_source(file_path)
+        if not source.splittable:
+            # compressed inputs can't be cut into byte ranges
+            return self.load_file(schema, table, source, delimiter)
+        file_path = source.path
+        ranges = self._split_file(file_path, workers)
+        if len(ranges) < 2:
+            return self.load_file(schema, table, source, delimiter)
+
+        started = time.perf_counter()
+        # the header is skipped by _split_file, the ranges only carry rows
+        with open(file_path, 'rb') as f:
+            columns = self._header_columns(f.readline(), delimiter)
+        pool = self.db_connector.create_pool(max_size=len(ranges), profile='bulk_load')
+        if pool is None:
+            print(f"\n -> FAILED: {table}: could not create a connection pool.")
+            return False
+
+        connections = []
+        try:
+            connections = [pool.getconn() for _ in ranges]
+            with connections[0].cursor() as cursor:
+                copy_query, apply, converters = self._prepare_copy(cursor, schema, table, source, columns, delimiter)
+                transaction_start = server_clock(cursor) if self.metrics else None
+            with tqdm(
+                total=ranges[-1][1] - ranges[0][0],
+                desc=f"Streaming {table} ({len(ranges)} ranges)",
+                unit='B',
+                unit_scale=True,
+                leave=False
+            ) as pbar:
+                with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                    futures = [
+                        executor.submit(self._copy_range, connection, copy_query, file_path, start, end, pbar, delimiter, apply, converters)
+                        for connection, (start, end) in zip(connections, ranges)
+                    ]
+                    errors = [future.exception() for future in futures]
+
+            failed = [(byte_range, error) for byte_range, error in zip(ranges, errors) if error is not None]
+            if failed:
+                for connection in connections:
+                    connection.rollback()
+                print(f"\n -> FAILED: {table}: {len(failed)} of {len(ranges)} ranges failed, nothing committed.")
+                for (start, end), error in failed:
+                    print(f"    bytes {start}-{end}: {error}")
+                self._record(table, source, started, status='failed')
+                if self.manifest:
+                    self.manifest.mark_failed(connections[0], schema, table, source)
+                return False
+
+            rows = sum(future.result() for future in futures)
+            transaction_seconds = None
+            if self.metrics:
+                with connections[0].cursor() as cursor:
+                    transaction_seconds = server_clock(cursor) - transaction_start
+            if self.manifest:
+                # 'partial' goes in with the first range and is only replaced by
+                # 'loaded' with the last one, so a broken commit sequence shows up.
+                with connections[0].cursor() as cursor:
+                    self.manifest.mark(cursor, schema, table, source, 'partial')
+
+            # Every range is in; commit them back to back. This is not a
+            # two-phase commit, so a commit failing here is reported separately.
+            for index, connection in enumerate(connections):
+                try:
+                    if self.manifest and index == len(connections) - 1:
+                        # written only now, the 'partial' row is committed and unlocked
+                        with connection.cursor() as cursor:
+                            self.manifest.mark(cursor, schema, table, source, 'loaded', rows=rows)
+                    connection.commit()
+                except Exception as error:
+                    start, end = ranges[index]
+                    print(f"\n -> FAILED: {table}: commit of bytes {start}-{end} failed: {error}")
+                    for pending in connections[index + 1:]:
+                        pending.rollback()
+                    print(f"    ranges before bytes {start} were already committed.")
+                    self._record(table, source, started, status='partial')
+                    return False
+            self._record(table, source, started, rows, transaction_seconds)
+            print(f" -> OK: '{table}' loaded in {len(ranges)} ranges.")
+            return True
+
+        except Exception as error:
+            for connection in connections:
+                connection.rollback()
+            print(f"\n -> FAILED: {table}: {error}")
+            self._record(table, source, started, status='failed')
+            return False
+        finally:
+            for connection in connections:
+                pool.putconn(connection)
+            pool.close()
+
+    def load_file_tolerant(self, schema: str, table: str, file_path, delimiter: str = '\t', connection=None) -> bool:
+        """
+        Loads the file in committed batches of batch_rows rows. A batch that
+        fails is bisected under savepoints until the offending rows are
+        isolated; those go to the reject table with their line number and the
+        Postgres error, and the rest of the batch is kept. Once the table has
+        rejected more than max_rejects rows the current batch is rolled back
+        and the load stops. Batches committed before that stay in; the first
+        one marks the file 'partial' in the manifest, the last one 'loaded'.
+        """
+        source = as_source(file_path)
+        connection = connection or self.db_connector.connect
+        max_rejects = self.max_rejects or 0
+        self._ensure_reject_table()
+        loaded, rejected, committed = 0, 0, False
+        started = time.perf_counter()
+
+        try:
+            with connection.cursor() as cursor:
+                with tqdm(
+                    total=source.size,
+                    desc=f"Streaming {table}",
+                    unit='B',
+                    unit_scale=True,
+                    leave=False
+                ) as pbar:
+                    with source.open(pbar.update) as f:
+                        columns = self._header_columns(f.readline(), delimiter)
+                        copy_query, apply, converters = self._prepare_copy(cursor, schema, table, source, columns, delimiter)
+                        transaction_start = server_clock(cursor) if self.metrics else None
+                        connection.commit()
+
+                        batch = []
+                        # line 1 is the header
+                        for line_number, line in enumerate(f, start=2):
+                            batch.append((line_number, line))
+                            if len(batch) < self.batch_rows:
+                                continue
+                            rows, rejects = self._load_batch(cursor, copy_query, batch, delimiter, apply, converters)
+                            loaded, rejected = loaded + rows, rejected + len(rejects)
+                            if rejected > max_rejects:
+                                break
+                            self._write_rejects(cursor, schema, table, source, rejects)
+                            if self.manifest and not committed:
+                                # 'partial' goes in with the first batch, so a run that
+                                # dies after it makes the next one truncate first
+                                self.manifest.mark(cursor, schema, table, source, 'partial')
+                            connection.commit()
+                            committed = True
+                            batch = []
+                        else:
+                            rows, rejects = self._load_batch(cursor, copy_query, batch, delimiter, apply, converters)
+                            loaded, rejected = loaded + rows, rejected + len(rejects)
+
+                if rejected > max_rejects:
+                    connection.rollback()
+                    print(f"\n -> FAILED: {table}: {rejected} rejected rows, over the budget of {max_rejects}. Load stopped.")
+                    if committed:
+                        print(f"    batches committed before that stay in {schema}.{table}.")
+                    self._mark_stopped(connection, schema, table, source, committed)
+                    self._record(table, source, started, loaded, status='partial' if committed else 'failed')
+                    return False
+
+                self._write_rejects(cursor, schema, table, source, rejects)
+                if self.manifest:
+                    self.manifest.mark(cursor, schema, table, source, 'loaded', rows=loaded)
+                transaction_seconds = server_clock(cursor) - transaction_start if self.metrics else None
+                connection.commit()
+                self._record(table, source, started, loaded, transaction_seconds)
+                note = f", {rejected} rows rejected to {self.reject_schema}.{self.reject_table}" if rejected else ""
+                print(f" -> OK: '{table}' loaded{note}.")
+                return True
+
+        except Exception as error:
+            connection.rollback()
             print(f"\n -> FAILED: {table}: {error}")
+            self._mark_stopped(connection, schema, table, source, committed)
+            self._record(table, source, started, status='partial' if committed else 'failed')
+            return False
+
+    def _record(self, table: str, source, started: float, rows: int = None, transaction_seconds: float = None,
+                status: str = 'ok'):
+        if self.metrics:
+            self.metrics.record('load', table, time.perf_counter() - started, bytes=source.size, rows=rows,
+                                transaction_seconds=transaction_seconds, status=status, detail=source.name)
+
+    def _load_batch(self, cursor, copy_query, batch: list, delimiter: str, apply, converters):
+        """
+        COPYs a batch of (line_number, line) rows under a savepoint. On error
+        the batch is split in halves and each half retried, down to single
+        rows. Returns the number of rows loaded and the rejected rows as
+        (line_number, line, error).
+        """
+        if not batch:
+            return 0, []
+        cursor.execute("SAVEPOINT load_batch")
+        try:
+            with cursor.copy(copy_query) as copy:
+                self._copy_lines(copy, (line for _, line in batch), delimiter, apply, converters)
+            cursor.execute("RELEASE SAVEPOINT load_batch")
+            return len(batch), []
+        except (psycopg.Error, ValueError) as error:
+            cursor.execute("ROLLBACK TO SAVEPOINT load_batch")
+            cursor.execute("RELEASE SAVEPOINT load_batch")
+            if len(batch) == 1:
+                line_number, line = batch[0]
+                return 0, [(line_number, line, str(error).strip())]
+        middle = len(batch) // 2
+        first_rows, first_rejects = self._load_batch(cursor, copy_query, batch[:middle], delimiter, apply, converters)
+        second_rows, second_rejects = self._load_batch(cursor, copy_query, batch[middle:], delimiter, apply, converters)
+        return first_rows + second_rows, first_rejects + second_rejects
+
+    def _write_rejects(self, cursor, schema: str, table: str, source, rejects: list):
+        if not rejects:
+            return
+        cursor.executemany(
+            sql.SQL(
+                "INSERT INTO {}.{} (schema_name, table_name, source_name, line_number, raw_line, error) "
+                "VALUES (%s, %s, %s, %s, %s, %s)"
+            ).format(sql.Identifier(self.reject_schema), sql.Identifier(self.reject_table)),
+            [
+                (schema, table, source.name, line_number, line.decode('utf-8', errors='replace').rstrip('\r\n'), error)
+                for line_number, line, error in rejects
+            ]
+        )
+
+    def _mark_stopped(self, connection, schema: str, table: str, source, committed: bool):
+        if not self.manifest:
+            return
+        if not committed:
+            self.manifest.mark_failed(connection, schema, table, source)
+            return
+        # some batches are in, the next run has to truncate before reloading
+        try:
+            with connection.cursor() as cursor:
+                self.manifest.mark(cursor, schema, table, source, 'partial')
+            connection.commit()
+        except (Exception, psycopg.Error) as error:
+            connection.rollback()
+            print(f"Error recording partial load of '{source.name}' in the manifest: {error}")
+
+    def _ensure_reject_table(self):
+        if self._reject_table_ready:
+            return
+        with self.db_connector.connect.cursor() as cursor:
+            cursor.execute(
+                sql.SQL(
+                    "CREATE TABLE IF NOT EXISTS {}.{} ("
+                    "schema_name varchar(255) NOT NULL, "
+                    "table_name varchar(255) NOT NULL, "
+                    "source_name varchar(1000) NOT NULL, "
+                    "line_number bigint, "
+                    "raw_line text, "
+                    "error text, "
+                    "rejected_at timestamp NOT NULL DEFAULT now())"
+                ).format(sql.Identifier(self.reject_schema), sql.Identifier(self.reject_table))
+            )
+        self.db_connector.connect.commit()
+        self._reject_table_ready = True
+
+    def _copy_range(self, connection, copy_query, file_path: str, start: int, end: int, pbar, delimiter: str,
+                    apply=None, converters=None):
+        # Streams bytes [start, end) of the file and returns the row count. No
+        # commit here, the caller decides once all ranges have finished.
+        with connection.cursor() as cursor:
+            with open(file_path, 'rb') as f:
+                f.seek(start)
+                remaining = end - start
+                with cursor.copy(copy_query) as copy:
+                    if apply or converters:
+                        self._copy_lines(copy, self._range_lines(f, end, pbar), delimiter, apply, converters)
+                    else:
+                        while remaining > 0 and (data := f.read(min(1024 * 1024, remaining))):
+                            copy.write(data)
+                            remaining -= len(data)
+                            pbar.update(len(data))
+            return cursor.rowcount
+
+    def _range_lines(self, f, end: int, pbar):
+        while f.tell() < end and (line := f.readline()):
+            pbar.update(len(line))
+            yield line
+
+    def _copy_lines(self, copy, lines, delimiter: str, apply=None, converters=None):
+        """
+        Splits each line on the delimiter (the loader uses QUOTE E'\\b', so
+        there is no quoting to honour) and runs the row transform. Text rows go
+        to COPY in blocks; in binary mode every field is parsed by its column's
+        converter and sent with write_row. Memory use stays bounded whatever
+        the file size.
+        """
+        if converters:
+            copy.set_types([type_oid for type_oid, _ in converters])
+            converters = [convert for _, convert in converters]
+        block, block_size = [], 0
+        for line in lines:
+            fields = line.decode('utf-8').rstrip('\r\n').split(delimiter)
+            if apply:
+                fields = apply(fields)
+            if converters:
+                if len(fields) != len(converters):
+                    raise ValueError(f"expected {len(converters)} fields, got {len(fields)}: {line[:200]!r}")
+                try:
+                    row = [convert(value) if value != '' else None for convert, value in zip(converters, fields)]
+                except (ValueError, ArithmeticError) as error:
+                    # one type of error for every bad field, tolerant loads quarantine those
+                    raise ValueError(f"{error}: {line[:200]!r}") from error
+                copy.write_row(row)
+                continue
+            row = (delimiter.join(fields) + '\n').encode('utf-8')
+            block.append(row)
+            block_size += len(row)
+            if block_size >= COPY_BLOCK_SIZE:
+                copy.write(b''.join(block))
+                block, block_size = [], 0
+        if block:
+            copy.write(b''.join(block))
+
+    def _header_columns(self, header: bytes, delimiter: str) -> list:
+        return [column.strip().lower() for column in header.decode('utf-8-sig').rstrip('\r\n').split(delimiter)]
+
+    def _prepare_copy(self, cursor, schema: str, table: str, source, columns: list, delimiter: str):
+        """
+        Checks the header against the table in the catalog and returns the
+        COPY statement with an explicit column list, the bound row transform
+        (or None) and, in binary mode, one converter per column (or None).
+        Raises ValueError for header columns the table doesn't have.
+        """
+        table_columns = self._table_columns(cursor, schema, table)
+        unknown = [column for column in columns if column not in table_columns]
+        if unknown:
+            raise ValueError(f"columns not in {schema}.{table}: {', '.join(unknown)}")
+
+        stages = []
+        transform = self.transforms.get(source.table_name)
+        if transform and transform.changes_rows:
+            stages.append(transform.bind(columns))
+        if self.pseudonymizer:
+            column_types = {column: table_columns[column][0] for column in columns}
+            pseudonymize = self.pseudonymizer.bind(f"{schema}.{table}", columns, column_types)
+            if pseudonymize:
+                stages.append(pseudonymize)
+        apply = self._chain(stages)
+
+        converters = None
+        if self.binary:
+            type_names = [table_columns[column][0] for column in columns]
+            missing = sorted({name for name in type_names if name not in BINARY_CONVERTERS})
+            if missing:
+                raise ValueError(f"binary COPY does not handle column type(s) {', '.join(missing)}")
+            if self.pseudonymizer or self._binary_dates_ok(source, columns, type_names, delimiter, transform):
+                # (type oid, parser) per column, the oids go to copy.set_types
+                converters = [(table_columns[column][1], BINARY_CONVERTERS[table_columns[column][0]]) for column in columns]
+            else:
+                print(f"\n -> '{source.name}' has dates that aren't ISO 8601, loading it with text COPY.")
+
+        copy_query = self._copy_query(schema, table, delimiter, columns, binary=converters is not None)
+        return copy_query, apply, converters
+
+    def _binary_dates_ok(self, source, columns: list, type_names: list, delimiter: str, transform=None) -> bool:
+        """
+        Parses the date and timestamp fields of the first DATE_SAMPLE_ROWS
+        rows with the binary converters. Those only read ISO 8601, where text
+        COPY goes by the server's DateStyle, so a file with e.g. DD/MM/YYYY
+        dates is loaded as text instead of failing row by row. The
+        pseudonymize stage writes ISO dates itself and needs no check.
+        """
+        dates = [index for index, name in enumerate(type_names) if name in ('date', 'timestamp', 'timestamptz')]
+        if not dates:
+            return True
+        bound = transform.bind(columns) if transform and transform.changes_rows else None
+        with source.open() as f:
+            f.readline()
+            for _, line in zip(range(DATE_SAMPLE_ROWS), f):
+                fields = line.decode('utf-8').rstrip('\r\n').split(delimiter)
+                if bound:
+                    fields = bound(fields)
+                for index in dates:
+                    if index < len(fields) and fields[index] != '':
+                        try:
+                            BINARY_CONVERTERS[type_names[index]](fields[index])
+                        except ValueError:
+                            return False
+        return True
+
+    def _chain(self, stages: list):
+        # one row function out of the file's transform and the pseudonymize stage
+        if len(stages) <= 1:
+            return stages[0] if stages else None
+
+        def apply(fields: list) -> list:
+            for stage in stages:
+                fields = stage(fields)
+            return fields
+
+        return apply
+
+    def _table_columns(self, cursor, schema: str, table: str) -> dict:
+        # column name -> (type name, type oid), straight from the catalog
+        cursor.execute(
+            "SELECT a.attname, t.typname, a.atttypid "
+            "FROM pg_attribute a "
+            "JOIN pg_class c ON c.oid = a.attrelid "
+            "JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "JOIN pg_type t ON t.oid = a.atttypid "
+            "WHERE n.nspname = %s AND c.relname = %s AND a.attnum > 0 AND NOT a.attisdropped "
+            "ORDER BY a.attnum",
+            (schema, table)
+        )
+        return {name: (type_name, type_oid) for name, type_name, type_oid in cursor.fetchall()}
+
+    def _split_file(self, file_path: str, parts: int) -> list:
+        """
+        Returns up to `parts` (start, end) byte ranges covering everything after
+        the header line. Every boundary sits right after a newline. The loader
+        uses QUOTE E'\\b', so a newline always ends a row and the split can't
+        land inside a field.
+        """
+        file_size = os.path.getsize(file_path)
+        with open(file_path, 'rb') as f:
+            f.readline()  # header
+            data_start = f.tell()
+            bounds = [data_start]
+            for part in range(1, parts):
+                target = data_start + (file_size - data_start) * part // parts
+                f.seek(max(target - 1, bounds[-1]))
+                f.readline()  # move on to the start of the next row
+                position = f.tell()
+                if position >= file_size:
+                    break
+                if position > bounds[-1]:
+                    bounds.append(position)
+        bounds.append(file_size)
+        return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+    def _copy_query(self, schema: str, table: str, delimiter: str, columns: list, binary: bool = False):
+        # the header is read by the loader, so COPY never sees one
+        if binary:
+            return sql.SQL("COPY {}.{} ({}) FROM STDIN WITH (FORMAT BINARY)").format(
+                sql.Identifier(schema),
+                sql.Identifier(table),
+                sql.SQL(", ").join(sql.Identifier(column) for column in columns)
+            )
+        return sql.SQL(
+            "COPY {}.{} ({}) FROM STDIN WITH (FORMAT CSV, HEADER FALSE, DELIMITER {}, QUOTE E'\\b')"
+        ).format(
+            sql.Identifier(schema),
+            sql.Identifier(table),
+            sql.SQL(", ").join(sql.Identifier(column) for column in columns),
+            sql.Literal(delimiter)
+        )
     
-    def process_folder(self, schema: str, folder_path: str, delimiter: str = ','):
+    def process_folder(self, schema: str, folder_path: str, delimiter: str = ',', workers: int = 1,
+                       chunk_threshold_mb: int = 0, chunk_workers: int = 4):
         """
         Processes all .csv files in a folder, streaming each into a
-        correspondingly named table.
+        correspondingly named table. Compressed inputs (.csv.gz, .csv.zst and
+        the .csv members of .zip archives) are decompressed on the fly. With workers > 1 the files are loaded
+        concurrently, one pooled connection per worker. Files bigger than
+        chunk_threshold_mb (0 turns this off) are themselves split across
+        chunk_workers connections, see load_file_chunked.
         """
         print(f"Starting to process files in: {folder_path}")
         try:
-            csv_files = sorted([f for f in os.listdir(folder_path) if f.lower().endswith('.csv')])
+            sources = find_sources(folder_path)
         except FileNotFoundError:
             print(f"Error: The specified folder does not exist: {folder_path}")
             return
         
-        if not csv_files:
+        if not sources:
             print("No .csv files found in the specified folder.")
             return
             
-        for file_name in tqdm(csv_files, desc="Overall Progress", unit="file"):
-            file_path = os.path.join(folder_path, file_name)
-            table_name = os.path.splitext(file_name)[0].lower()
-            # loading cpt4 concepts into concept table
-            if 'concept_cpt4' in table_name:
-                self.fill_nulls_with_default("concept_cpt4.csv", folder_path, delimiter='\t', column_name='concept_name', 
-                                             default_value='Unknown CPT4 Concept')
-                table_name = 'concept'  # special case handling
+        jobs = self._plan_folder(schema, sources)
+        if self.max_rejects is not None:
+            # created up front, parallel workers only insert into it
+            self._ensure_reject_table()
+        if self.manifest:
+            jobs, stale_tables = self.manifest.plan(schema, jobs)
+            if not self.truncate_tables(schema, stale_tables):
+                print("Stopping folder processing, changed tables could not be truncated.")
+                return
+        chunking = (chunk_threshold_mb * 1024 * 1024, chunk_workers)
 
-            if not self.check_table_exists(schema, table_name):
-                print(f"\nTable '{table_name}' does not exist in schema '{schema}'. Skipping file '{file_name}'.")
-                continue
-            
-            try:
-                self.load_file(schema, table_name, file_path, delimiter)
-            except Exception:
-                # If load_file fails, it prints the error. We can stop the whole process.
-                print(f"Stopping folder processing due to a critical error.")
-                break # Exit the loop
+        if workers > 1 and len(jobs) > 1:
+            failed = self._load_parallel(schema, jobs, delimiter, workers, chunking)
+        else:
+            # one bulk-load session for the whole folder, each file still its own transaction;
+            # a failed file is rolled back and reported, the next one still loads
+            failed = []
+            with self.db_connector.session('bulk_load') as connection:
+                for table_name, source in tqdm(jobs, desc="Overall Progress", unit="file"):
+                    if not self._load_job(schema, table_name, source, delimiter, chunking, connection=connection):
+                        failed.append(source.name)
         
         print("\nFolder processing complete.")
+        if failed:
+            print(f"{len(failed)} file(s) failed to load: {', '.join(sorted(failed))}")
+        if self.pseudonymizer:
+            self.pseudonymizer.report()
+
+    def truncate_tables(self, schema: str, tables: list) -> bool:
+        if not tables:
+            return True
+        try:
+            with self.db_connector.connect.cursor() as cursor:
+                cursor.execute(
+                    sql.SQL("TRUNCATE {}").format(
+                        sql.SQL(", ").join(sql.Identifier(schema, table) for table in tables)
+                    )
+                )
+            self.db_connector.connect.commit()
+            print(f"Truncated {', '.join(tables)} for reload.")
+            return True
+        except (Exception, psycopg.Error) as error:
+            self.db_connector.connect.rollback()
+            print(f"Error truncating tables {tables}: {error}")
+            return False
+
+    def list_target_tables(self, schema: str, folder_path: str) -> list:
+        """
+        Returns the existing tables a folder load would write into, without
+        touching the files. Used to prepare bulk-load mode.
+        """
+        try:
+            sources = find_sources(folder_path)
+        except FileNotFoundError:
+            return []
+        tables = {self._table_for_source(source) for source in sources}
+        return sorted(table for table in tables if self.check_table_exists(schema, table))
+
+    def _table_for_source(self, source) -> str:
+        transform = self.transforms.get(source.table_name)
+        if transform and transform.target_table:
+            return transform.target_table
+        return source.table_name
+
+    def _plan_folder(self, schema: str, sources: list) -> list:
+        """
+        Resolves each source to its target table and drops the ones without a table.
+        Returns a list of (table_name, source) tuples.
+        """
+        jobs = []
+        for source in sources:
+            table_name = self._table_for_source(source)
+            if not self.check_table_exists(schema, table_name):
+                print(f"\nTable '{table_name}' does not exist in schema '{schema}'. Skipping file '{source.name}'.")
+                continue
+            jobs.append((table_name, source))
+        return jobs
+
+    def _load_job(self, schema: str, table: str, source, delimiter: str, chunking: tuple, connection=None) -> bool:
+        if self.max_rejects is not None:
+            # error-tolerant loads commit batch by batch on a single stream
+            return self.load_file_tolerant(schema, table, source, delimiter, connection=connection)
+        if self._chunked(source, chunking):
+            # chunked loads bring their own pool, one connection per range
+            return self.load_file_chunked(schema, table, source, delimiter, chunking[1])
+        return self.load_file(schema, table, source, delimiter, connection=connection)
+
+    def _chunked(self, source, chunking: tuple) -> bool:
+        threshold, chunk_workers = chunking
+        return (self.max_rejects is None and bool(threshold) and chunk_workers > 1
+                and source.splittable and source.size > threshold)
+
+    def _load_parallel(self, schema: str, jobs: list, delimiter: str, workers: int, chunking: tuple) -> list:
+        # Largest files first, so the longest COPY doesn't start last and
+        # stretch the tail of the run. Returns the names of the failed files.
+        jobs = sorted(jobs, key=lambda job: job[1].size, reverse=True)
+        pool = self.db_connector.create_pool(max_size=min(workers, len(jobs)), profile='bulk_load')
+        if pool is None:
+            print("Could not create a connection pool, nothing loaded.")
+            return [source.name for _, source in jobs]
+
+        failed = []
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    executor.submit(self._load_pooled, pool, schema, table_name, source, delimiter, chunking): source
+                    for table_name, source in jobs
+                }
+                for future in tqdm(as_completed(futures), total=len(futures), desc="Overall Progress", unit="file"):
+                    if not future.result():
+                        failed.append(futures[future].name)
+        finally:
+            pool.close()
+        return failed
+
+    def _load_pooled(self, pool, schema: str, table: str, source, delimiter: str, chunking: tuple) -> bool:
+        if self._chunked(source, chunking):
+            # runs on its own pool, a borrowed connection would sit idle meanwhile
+            return self._load_job(schema, table, source, delimiter, chunking)
+        # every table is still its own transaction: load_file commits or rolls
+        # back on the borrowed connection before it goes back to the pool.
+        with pool.connection() as connection:
+            return self._load_job(schema, table, source, delimiter, chunking, connection=connection)
 
     def check_table_exists(self, schema: str, table: str) -> bool:
         """
@@ -111,20 +774,3 @@ class CSVLoader:
         except (Exception, psycopg.Error) as error:
             print(f"Error checking if table exists: {error}")
             return False
-        
-    def fill_nulls_with_default(self, file_name: str, folder_path: str, delimiter: str = ',', column_name: str = '', default_value: str = '') -> bool:
-        try:
-            csv_to_read = os.path.join(folder_path, file_name)
-            df = pd.read_csv(csv_to_read, delimiter=delimiter)
-            if column_name in df.columns:
-                df.fillna({column_name: default_value}, inplace=True)
-                df.to_csv(csv_to_read, index=False, sep=delimiter)
-                print(f"Nulls in column '{column_name}' of file '{file_name}' filled with default value '{default_value}'.")
-                return True
-            else:
-                print(f"Column '{column_name}' does not exist in file '{file_name}'.")
-                return False
-        
-        except Exception as error:
-            print(f"Error filling nulls with default values: {error}")
-            return False
\ No newline at end of file
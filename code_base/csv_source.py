@@ -0,0 +1,138 @@
+import io
+import os
+import gzip
+import zipfile
+from contextlib import contextmanager
+
+# zstd is optional, only needed for .zst inputs
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSED_SUFFIXES = {
+    '.gz': 'gzip',
+    '.zst': 'zstd',
+}
+
+class ProgressReader:
+    """Wraps a binary stream and reports every chunk read to a progress callback."""
+    def __init__(self, stream, progress=None):
+        self.stream = stream
+        self.progress = progress
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if data and self.progress:
+            self.progress(len(data))
+        return data
+
+    def readline(self, size=-1):
+        data = self.stream.readline(size)
+        if data and self.progress:
+            self.progress(len(data))
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def close(self):
+        self.stream.close()
+
+
+class CSVSource:
+    """
+    One CSV input: a plain file, a .gz/.zst file, or a .csv member of a zip
+    archive (e.g. an Athena vocabulary bundle). open() yields the decompressed
+    bytes, so nothing has to be unpacked to disk first.
+    """
+    def __init__(self, path: str, compression: str = None, member: str = None):
+        self.path = path
+        self.compression = compression
+        self.member = member
+
+    @property
+    def name(self) -> str:
+        # stable name used for the table mapping and the load manifest
+        if self.member is not None:
+            return f"{os.path.basename(self.path)}/{self.member}"
+        return os.path.basename(self.path)
+
+    @property
+    def table_name(self) -> str:
+        file_name = os.path.basename(self.member if self.member is not None else self.path)
+        if self.compression in ('gzip', 'zstd'):
+            file_name = os.path.splitext(file_name)[0]
+        return os.path.splitext(file_name)[0].lower()
+
+    @property
+    def splittable(self) -> bool:
+        # byte ranges only make sense for plain files
+        return self.compression is None
+
+    @property
+    def size(self) -> int:
+        """
+        Size the progress bar counts towards: the on-disk size for plain and
+        .gz/.zst files, the uncompressed size for zip members.
+        """
+        if self.member is not None:
+            with zipfile.ZipFile(self.path) as archive:
+                return archive.getinfo(self.member).file_size
+        return os.path.getsize(self.path)
+
+    @contextmanager
+    def open(self, progress=None):
+        if self.member is not None:
+            with zipfile.ZipFile(self.path) as archive:
+                with archive.open(self.member) as stream:
+                    yield ProgressReader(stream, progress)
+            return
+
+        with open(self.path, 'rb') as raw:
+            # count the compressed bytes, that is what the bar's total is in
+            counted = ProgressReader(raw, progress)
+            if self.compression == 'gzip':
+                with gzip.GzipFile(fileobj=counted) as stream:
+                    yield stream
+            elif self.compression == 'zstd':
+                if zstandard is None:
+                    raise ImportError(f"'{self.path}' is zstd compressed, install the zstandard package to load it.")
+                with zstandard.ZstdDecompressor().stream_reader(counted) as stream:
+                    yield io.BufferedReader(stream)
+            else:
+                yield counted
+
+    def __repr__(self):
+        return f"CSVSource({self.name!r})"
+
+
+def as_source(source) -> CSVSource:
+    # load_file and friends accept plain paths as well
+    if isinstance(source, CSVSource):
+        return source
+    for suffix, compression in COMPRESSED_SUFFIXES.items():
+        if source.lower().endswith(suffix):
+            return CSVSource(source, compression=compression)
+    return CSVSource(source)
+
+
+def find_sources(folder_path: str) -> list:
+    """
+    Lists the CSV inputs in a folder: *.csv, *.csv.gz, *.csv.zst and the .csv
+    members of *.zip archives. Raises FileNotFoundError for a missing folder.
+    """
+    sources = []
+    for file_name in sorted(os.listdir(folder_path)):
+        path = os.path.join(folder_path, file_name)
+        lowered = file_name.lower()
+        if lowered.endswith('.csv'):
+            sources.append(CSVSource(path))
+        elif any(lowered.endswith(f'.csv{suffix}') for suffix in COMPRESSED_SUFFIXES):
+            sources.append(as_source(path))
+        elif lowered.endswith('.zip'):
+            with zipfile.ZipFile(path) as archive:
+                for member in sorted(archive.namelist()):
+                    if member.lower().endswith('.csv') and not member.endswith('/'):
+                        sources.append(CSVSource(path, compression='zip', member=member))
+    return sources
@@ -1,7 +1,38 @@
+import threading
+from contextlib import contextmanager
 import psycopg
 from psycopg import sql
+from psycopg_pool import ConnectionPool
 from urllib.parse import quote_plus
 
+# Session settings per kind of work. Every pooled connection of a profile
+# runs these SETs once when it is opened; sessionProfiles from the config
+# overrides single settings.
+SESSION_PROFILES = {
+    # COPY sessions: a commit doesn't wait for its WAL flush. A crash can lose
+    # the last few commits but never leaves a half-written one. The manifest
+    # entry of a file commits with its COPY, so the two are lost together.
+    # A plain COPY sorts and hashes nothing, work_mem would only be multiplied
+    # over the load connections.
+    'bulk_load': {
+        'synchronous_commit': 'off',
+    },
+    # CREATE INDEX, primary keys, VALIDATE CONSTRAINT
+    'maintenance': {
+        'maintenance_work_mem': '1GB',
+        'max_parallel_maintenance_workers': '2',
+    },
+    # Achilles: big sorts and hash joins, temp tables, parallel scans
+    'analytics': {
+        'work_mem': '512MB',
+        'temp_buffers': '256MB',
+        'max_parallel_workers_per_gather': '4',
+    },
+}
+
+# connections kept per profile for session(); the parallel steps size their own pools
+SHARED_POOL_SIZE = 4
+
 class DBConnector:
     def __init__(self, **kwargs):
         # Extract database config
@@ -26,18 +57,83 @@ class DBConnector:
         self.etlUser = kwargs.get('dbUser1')
         self.etlPassword = kwargs.get('dbPassword1')
 
+        # Session settings per profile, the defaults with the configured overrides
+        overrides = kwargs.get('sessionProfiles') or {}
+        self.session_profiles = {
+            name: {**settings, **overrides.get(name, {})} for name, settings in SESSION_PROFILES.items()
+        }
+        # pools behind session(), opened on first use and closed with the connection
+        self._shared_pools = {}
+        self._shared_pools_lock = threading.Lock()
+
         # Create connection
         self.connect = self.create_connection()
 
+    def _connection_string(self):
+        return f"postgresql://{quote_plus(self.dbUser)}:{quote_plus(self.dbPassword)}@{self.dbHost}:{self.dbPort}/{self.dbName}"
+
     def create_connection(self):
         try:
-            connect_string = f"postgresql://{quote_plus(self.dbUser)}:{quote_plus(self.dbPassword)}@{self.dbHost}:{self.dbPort}/{self.dbName}"
-            connection = psycopg.connect(connect_string)
+            connection = psycopg.connect(self._connection_string())
             connection.autocommit = False
             return connection
         except (Exception, psycopg.Error) as error:
             print(f"Error connecting to PostgreSQL: {error}")
             return None
+
+    # pool of extra connections for work that runs on several backends at once
+    # (parallel loads etc). The caller owns the pool and must close it. With a
+    # profile, every connection gets that profile's session settings.
+    def create_pool(self, max_size: int, configure=None, profile: str = None):
+        pool = None
+        if profile and configure is None:
+            configure = self._configure_profile(profile)
+        try:
+            pool = ConnectionPool(
+                self._connection_string(),
+                min_size=1,
+                max_size=max_size,
+                kwargs={"autocommit": False},
+                configure=configure,
+                open=True,
+            )
+            pool.wait()
+            return pool
+        except (Exception, psycopg.Error) as error:
+            print(f"Error creating connection pool: {error}")
+            if pool:
+                pool.close()
+            return None
+
+    @contextmanager
+    def session(self, profile: str):
+        """
+        Lends a connection with the profile's session settings for the
+        duration of a with block, from a pool shared by everything using
+        that profile. Commit or roll back inside the block; an open
+        transaction is committed when the block ends, or rolled back on an
+        exception. Without a pool this falls back to the shared connection.
+        """
+        with self._shared_pools_lock:
+            if profile not in self._shared_pools:
+                self._shared_pools[profile] = self.create_pool(SHARED_POOL_SIZE, profile=profile)
+            pool = self._shared_pools[profile]
+        if pool is None:
+            yield self.connect
+            return
+        with pool.connection() as connection:
+            yield connection
+
+    def _configure_profile(self, profile: str):
+        settings = self.session_profiles[profile]
+
+        def configure(connection):
+            with connection.cursor() as cursor:
+                for name, value in settings.items():
+                    cursor.execute(sql.SQL("SET {} = {}").format(sql.Identifier(name), sql.Literal(str(value))))
+            connection.commit()
+
+        return configure
     
     def create_schemas(self):
         try:
@@ -226,6 +322,11 @@ class DBConnector:
 
     # close connection
     def close_connection(self):
+        with self._shared_pools_lock:
+            for pool in self._shared_pools.values():
+                if pool:
+                    pool.close()
+            self._shared_pools = {}
         if self.connect:
             self.connect.close()
             print("Database connection closed.")   
@@ -1,86 +1,426 @@
 # create a class 
+import os
+import re
+import time
 from code_base.db_connector import DBConnector
+from code_base.metrics import RunMetrics
+from code_base.query_profiler import QueryProfiler
+from code_base.sql_script import split_statements, statement_digest, statement_summary
 import psycopg
+from psycopg import sql
+
+# statements in the key/index files and the table each one touches
+PRIMARY_KEY_PATTERN = re.compile(r"ALTER\s+TABLE\s+([\w.]+)\s+ADD\s+CONSTRAINT\s+(\w+)\s+PRIMARY\s+KEY", re.IGNORECASE)
+INDEX_PATTERN = re.compile(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+(\w+)\s+ON\s+([\w.]+)", re.IGNORECASE)
+CLUSTER_PATTERN = re.compile(r"CLUSTER\s+([\w.]+)\s+USING", re.IGNORECASE)
 
 class DDL:
-    def __init__(self, db_connector: DBConnector):
+    def __init__(self, db_connector: DBConnector, metrics: RunMetrics = None, profiler: QueryProfiler = None):
         self.db_connector = db_connector
+        # optional run metrics, one entry per executed SQL file and statement
+        self.metrics = metrics
+        # optional query profiler, runs the statements under EXPLAIN ANALYZE
+        self.profiler = profiler
+        # statements of an interrupted key/index/constraint file that already
+        # ran, so a rerun picks up where it stopped
+        self.checkpoint_schema = db_connector.resultsDatabaseSchema
+        self.checkpoint_table = "ddl_checkpoint"
+        # (referenced schema, schema, table, name, definition) of the foreign keys
+        # prepare_bulk_load dropped with the primary keys they point at,
+        # finish_bulk_load adds them back
+        self.dropped_foreign_keys = []
 
     def create_vocab_tables(self, path: str):
         try:
             self._execute_sql_file(path)
             print("Vocab tables created successfully.")
         except (Exception, psycopg.Error) as e:
-            # rollback in case of error
-            self.db_connector.connect.rollback()
-            print(f"Error creating Vocab tables: {e} - rolled back.")   
+            self._report_failure("Error creating Vocab tables", path, e)
 
     def create_cdm_tables(self, path: str):
         try:
             self._execute_sql_file(path)
             print("CDM tables created successfully.")
         except (Exception, psycopg.Error) as e:
-            # rollback in case of error
-            self.db_connector.connect.rollback()
-            print(f"Error creating CDM tables: {e} - rolled back.")
+            self._report_failure("Error creating CDM tables", path, e)
 
     def add_primary_keys(self, path: str):
         try:
-            self._execute_sql_file(path)
+            self._execute_sql_file(path, checkpoint=True, profile='maintenance')
             print("Primary keys added successfully.")
         except (Exception, psycopg.Error) as e:
-            # rollback in case of error
-            self.db_connector.connect.rollback()
-            print(f"Error adding primary keys: {e} - rolled back.")
+            self._report_failure("Error adding primary keys", path, e, checkpoint=True)
 
     def add_indices(self, path: str):
         try:
-            self._execute_sql_file(path)
+            self._execute_sql_file(path, checkpoint=True, profile='maintenance')
             print("Indices added successfully.")
         except (Exception, psycopg.Error) as e:
-            # rollback in case of error
-            self.db_connector.connect.rollback()
-            print(f"Error adding indices: {e} - rolled back.")
+            self._report_failure("Error adding indices", path, e, checkpoint=True)
 
     def add_constraints(self, path: str):
         try:
-            self._execute_sql_file(path)
+            self._execute_sql_file(path, checkpoint=True, profile='maintenance')
             print("Constraints added successfully.")
         except (Exception, psycopg.Error) as e:
-            # rollback in case of error
-            self.db_connector.connect.rollback()
-            print(f"Error adding constraints: {e} - rolled back.")
+            self._report_failure("Error adding constraints", path, e, checkpoint=True)
 
     def run_achilles_script(self, path: str):
         try:
             print("analysis started")
-            self._execute_sql_file(path)
+            self._execute_sql_file(path, profile='analytics')
             print("Achilles script executed successfully.")
         except (Exception, psycopg.Error) as e:
-            # rollback in case of error
+            self._report_failure("Error executing Achilles script", path, e)
+
+    # Bulk-load mode: the target tables are made UNLOGGED and lose their
+    # primary keys and indices for the duration of the COPY, then everything
+    # is rebuilt once the data is in.
+    def prepare_bulk_load(self, schema: str, tables: list, primary_key_paths: list, index_paths: list):
+        tables = {table.lower() for table in tables}
+        try:
+            started = time.perf_counter()
+            primary_keys = [key for path in primary_key_paths for key in self._find_primary_keys(path, schema, tables)]
+            foreign_keys = self._referencing_foreign_keys(schema, {table for _, table in primary_keys})
+            with self.db_connector.connect.cursor() as cursor:
+                for path in index_paths:
+                    for index_name, table in self._find_indices(path, schema, tables):
+                        cursor.execute(
+                            sql.SQL("DROP INDEX IF EXISTS {}.{}").format(sql.Identifier(schema), sql.Identifier(index_name))
+                        )
+                # the foreign keys pointing at the primary keys are dropped by
+                # name and their definitions kept, finish_bulk_load adds exactly
+                # these back, whatever constraints.sql still has to do
+                for _, fk_schema, fk_table, name, _ in foreign_keys:
+                    cursor.execute(
+                        sql.SQL("ALTER TABLE {}.{} DROP CONSTRAINT {}").format(
+                            sql.Identifier(fk_schema), sql.Identifier(fk_table), sql.Identifier(name)
+                        )
+                    )
+                for constraint_name, table in primary_keys:
+                    cursor.execute(
+                        sql.SQL("ALTER TABLE {}.{} DROP CONSTRAINT IF EXISTS {}").format(
+                            sql.Identifier(schema), sql.Identifier(table), sql.Identifier(constraint_name)
+                        )
+                    )
+            self.db_connector.connect.commit()
+            self.dropped_foreign_keys.extend(foreign_keys)
+            print(f"Bulk load: dropped primary keys and indices on {len(tables)} tables"
+                  f"{f' and {len(foreign_keys)} foreign key(s) pointing at them' if foreign_keys else ''} "
+                  f"in {time.perf_counter() - started:.1f}s.")
+            if self.metrics:
+                self.metrics.record('bulk', 'drop keys and indices', time.perf_counter() - started, detail=schema)
+
+            self.set_tables_logged(schema, tables, logged=False)
+        except (Exception, psycopg.Error) as e:
             self.db_connector.connect.rollback()
-            print(f"Error executing Achilles script: {e} - rolled back.")
+            print(f"Error preparing bulk load: {e} - rolled back.")
+
+    def finish_bulk_load(self, schema: str, tables: list, primary_key_paths: list, index_paths: list):
+        """
+        Rebuilds the primary key and indices of every table in a transaction
+        of its own and sets the tables LOGGED again, even when a rebuild
+        failed. Then adds back the foreign keys prepare_bulk_load dropped
+        (a logged table can't reference an unlogged one). Raises when anything
+        could not be restored, after listing it.
+        """
+        tables = {table.lower() for table in tables}
+        failed = []
+        try:
+            with self.db_connector.session('maintenance') as connection:
+                for table in sorted(tables):
+                    error = self._rebuild_table(connection, schema, table, primary_key_paths, index_paths)
+                    if error:
+                        failed.append((f"{schema}.{table}", error))
+        except (Exception, psycopg.Error) as e:
+            failed.append(("maintenance session", str(e).strip()))
+        finally:
+            failed.extend((f"{schema}.{table}", "still UNLOGGED")
+                          for table in self.set_tables_logged(schema, tables, logged=True))
+        try:
+            with self.db_connector.session('maintenance') as connection:
+                failed.extend(self._restore_foreign_keys(connection, schema))
+        except (Exception, psycopg.Error) as e:
+            failed.append(("maintenance session", str(e).strip()))
+
+        if failed:
+            print(f"Error finishing bulk load, {len(failed)} step(s) failed:")
+            for name, error in failed:
+                print(f"  {name}: {error}")
+            raise RuntimeError(f"bulk load of {schema} left {len(failed)} table(s) or key(s) unrestored")
+
+    def _rebuild_table(self, connection, schema: str, table: str, primary_key_paths: list, index_paths: list):
+        # primary key, then indices (and CLUSTER) of one table, committed together; the error or None
+        statements = [statement for path in primary_key_paths for statement in self._primary_key_statements(path, schema, {table})]
+        statements += [statement for path in index_paths for statement in self._index_statements(path, schema, {table})]
+        started = time.perf_counter()
+        error = None
+        try:
+            with connection.cursor() as cursor:
+                for statement in statements:
+                    cursor.execute(statement)
+            connection.commit()
+            print(f"Bulk load: rebuilt the keys and indices of {schema}.{table} in {time.perf_counter() - started:.1f}s.")
+        except (Exception, psycopg.Error) as e:
+            connection.rollback()
+            error = str(e).strip().splitlines()[0]
+        if self.metrics:
+            self.metrics.record('bulk', 'rebuild keys and indices', time.perf_counter() - started,
+                                status='ok' if error is None else 'failed', detail=f"{schema}.{table}")
+        return error
 
-    def _execute_sql_file(self, path: str):
+    def _restore_foreign_keys(self, connection, schema: str) -> list:
+        # adds back the dropped foreign keys pointing into schema one by one;
+        # [(name, error)] of those that failed
+        failed = []
+        remaining = [key for key in self.dropped_foreign_keys if key[0] != schema]
+        restoring = [key for key in self.dropped_foreign_keys if key[0] == schema]
+        for key in restoring:
+            _, fk_schema, fk_table, name, definition = key
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        sql.SQL("ALTER TABLE {}.{} ADD CONSTRAINT {} {}").format(
+                            sql.Identifier(fk_schema), sql.Identifier(fk_table), sql.Identifier(name), sql.SQL(definition)
+                        )
+                    )
+                connection.commit()
+            except (Exception, psycopg.Error) as e:
+                connection.rollback()
+                remaining.append(key)
+                failed.append((f"{fk_schema}.{fk_table}.{name}", f"{str(e).strip().splitlines()[0]} ({definition})"))
+        if restoring:
+            print(f"Bulk load: added back {len(restoring) - len(failed)} of {len(restoring)} foreign key(s).")
+        self.dropped_foreign_keys = remaining
+        return failed
+
+    def _referencing_foreign_keys(self, schema: str, tables: set) -> list:
+        # (schema, referencing schema, table, name, definition) of the foreign keys pointing at the tables
+        if not tables:
+            return []
         with self.db_connector.connect.cursor() as cursor:
-            with open(path, 'r') as file:
-                sql_commands = file.read()
-                # replace schema placeholder with actual schema name, it has @vocabDatabaseSchema or @cdmDatabaseSchema
-                sql_commands = sql_commands.replace("@cdmDatabaseSchema", self.db_connector.cdmDatabaseSchema)
-                sql_commands = sql_commands.replace("@vocabDatabaseSchema", self.db_connector.vocabDatabaseSchema)
-                sql_commands = sql_commands.replace("@resultSchema", self.db_connector.resultsDatabaseSchema)
-                sql_commands = sql_commands.replace("@tempSchema", self.db_connector.tempSchema)      
-                cursor.execute(sql_commands)
+            cursor.execute(
+                "SELECT rn.nspname, cn.nspname, c.relname, con.conname, pg_get_constraintdef(con.oid) "
+                "FROM pg_constraint con "
+                "JOIN pg_class c ON c.oid = con.conrelid "
+                "JOIN pg_namespace cn ON cn.oid = c.relnamespace "
+                "JOIN pg_class r ON r.oid = con.confrelid "
+                "JOIN pg_namespace rn ON rn.oid = r.relnamespace "
+                "WHERE con.contype = 'f' AND rn.nspname = %s AND r.relname = ANY(%s) "
+                "ORDER BY cn.nspname, c.relname, con.conname",
+                (schema, sorted(tables))
+            )
+            return cursor.fetchall()
+
+    def set_tables_logged(self, schema: str, tables, logged: bool = True) -> list:
+        """Sets every table LOGGED or UNLOGGED in its own transaction, returns the tables that failed."""
+        mode = "LOGGED" if logged else "UNLOGGED"
+        failed = []
+        for table in sorted(tables):
+            started = time.perf_counter()
+            try:
+                with self.db_connector.connect.cursor() as cursor:
+                    cursor.execute(
+                        sql.SQL("ALTER TABLE {}.{} SET {}").format(
+                            sql.Identifier(schema), sql.Identifier(table), sql.SQL(mode)
+                        )
+                    )
+                self.db_connector.connect.commit()
+                print(f"Bulk load: {schema}.{table} set {mode} in {time.perf_counter() - started:.1f}s.")
+                if self.metrics:
+                    self.metrics.record('bulk', f'set {mode.lower()}', time.perf_counter() - started, detail=f"{schema}.{table}")
+            except (Exception, psycopg.Error) as e:
+                self.db_connector.connect.rollback()
+                failed.append(table)
+                print(f"Error setting {schema}.{table} {mode}: {e} - rolled back.")
+        return failed
+
+    def _find_primary_keys(self, path: str, schema: str, tables: set) -> list:
+        found = []
+        for match in PRIMARY_KEY_PATTERN.finditer(self._read_sql_file(path)):
+            table = self._table_in_schema(match.group(1), schema)
+            if table in tables:
+                found.append((match.group(2), table))
+        return found
+
+    def _find_indices(self, path: str, schema: str, tables: set) -> list:
+        found = []
+        for match in INDEX_PATTERN.finditer(self._read_sql_file(path)):
+            table = self._table_in_schema(match.group(2), schema)
+            if table in tables:
+                found.append((match.group(1), table))
+        return found
+
+    def _primary_key_statements(self, path: str, schema: str, tables: set) -> list:
+        return self._statements_for_tables(path, schema, tables, [PRIMARY_KEY_PATTERN])
+
+    def _index_statements(self, path: str, schema: str, tables: set) -> list:
+        # CLUSTER comes right after the index it uses, so order is kept.
+        return self._statements_for_tables(path, schema, tables, [INDEX_PATTERN, CLUSTER_PATTERN])
+
+    def _statements_for_tables(self, path: str, schema: str, tables: set, patterns: list) -> list:
+        statements = []
+        for statement in split_statements(self._read_sql_file(path)):
+            for pattern in patterns:
+                match = pattern.search(statement)
+                if match:
+                    target = match.group(2) if pattern is INDEX_PATTERN else match.group(1)
+                    if self._table_in_schema(target, schema) in tables:
+                        statements.append(statement.strip())
+                    break
+        return statements
+
+    def _table_in_schema(self, qualified_name: str, schema: str):
+        # "cdm.person" -> "person" when it lives in schema, None otherwise
+        parts = qualified_name.lower().split('.')
+        if len(parts) == 2 and parts[0] == schema.lower():
+            return parts[1]
+        return None
+
+    def _report_failure(self, action: str, path: str, error: Exception, checkpoint: bool = False):
+        # each statement commits on its own (on a pooled session for profiled
+        # files), so only the failing one was rolled back; _execute_statements
+        # already printed which one it was
+        print(f"{action} from {os.path.basename(path)}: {error}")
+        if checkpoint:
+            print(f"  The statements before it stay committed and are recorded in "
+                  f"{self.checkpoint_schema}.{self.checkpoint_table}; rerun to resume from the failing one.")
+        else:
+            print("  The statements before it stay committed.")
+
+    def _read_sql_file(self, path: str) -> str:
+        with open(path, 'r') as file:
+            sql_commands = file.read()
+        # replace schema placeholder with actual schema name, it has @vocabDatabaseSchema or @cdmDatabaseSchema
+        sql_commands = sql_commands.replace("@cdmDatabaseSchema", self.db_connector.cdmDatabaseSchema)
+        sql_commands = sql_commands.replace("@vocabDatabaseSchema", self.db_connector.vocabDatabaseSchema)
+        sql_commands = sql_commands.replace("@resultSchema", self.db_connector.resultsDatabaseSchema)
+        sql_commands = sql_commands.replace("@tempSchema", self.db_connector.tempSchema)
+        return sql_commands
+
+    def _execute_sql_file(self, path: str, checkpoint: bool = False, profile: str = None):
+        started = time.perf_counter()
+        try:
+            if profile:
+                # a pooled session with the profile's settings instead of the shared connection
+                with self.db_connector.session(profile) as connection:
+                    self._execute_statements(path, checkpoint, connection)
+            else:
+                self._execute_statements(path, checkpoint)
+        except Exception:
+            self._record_sql_file(path, started, 'failed')
+            raise
+        self._record_sql_file(path, started)
+
+    def _execute_statements(self, path: str, checkpoint: bool = False, connection=None):
+        """
+        Runs the statements of a SQL file one by one on connection (the
+        shared one by default), each in its own transaction, and prints how
+        long they took. A failing statement is
+        rolled back and stops the file; the ones before it stay.
+
+        With checkpoint, every finished statement is also recorded in
+        <resultSchema>.ddl_checkpoint, in the statement's transaction. A rerun skips
+        the statements recorded there (same position, same text), and the
+        records are cleared once the whole file went through.
+        """
+        connection = connection or self.db_connector.connect
+        statements = split_statements(self._read_sql_file(path))
+        done = self._completed_statements(path) if checkpoint else None
+        checkpoint = done is not None
+        timings, skipped = [], 0
+        for index, statement in enumerate(statements):
+            digest = statement_digest(statement)
+            if checkpoint and done.get(index) == digest:
+                skipped += 1
+                continue
+            started = time.perf_counter()
+            try:
+                with connection.cursor() as cursor:
+                    self._execute_statement(cursor, statement, f"{os.path.basename(path)}#{index + 1}")
+                    seconds = time.perf_counter() - started
+                    if checkpoint:
+                        self._checkpoint(cursor, path, index, digest, seconds)
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                print(f"{os.path.basename(path)}: statement {index + 1}/{len(statements)} failed after "
+                      f"{time.perf_counter() - started:.1f}s: {statement_summary(statement)}")
+                raise
+            timings.append((seconds, index, statement))
+            if self.metrics:
+                self.metrics.record('statement', f"{os.path.basename(path)}#{index + 1}", seconds,
+                                    detail=statement_summary(statement))
+
+        if checkpoint:
+            self._clear_checkpoints(path)
+        summary = f"{os.path.basename(path)}: {len(timings)} statement(s) in {sum(t for t, _, _ in timings):.1f}s"
+        if skipped:
+            summary += f", {skipped} skipped (done in an earlier run)"
+        print(summary)
+        for seconds, index, statement in sorted(timings, reverse=True)[:3]:
+            if seconds >= 1:
+                print(f"  {seconds:.1f}s  #{index + 1}  {statement_summary(statement)}")
+
+    def _execute_statement(self, cursor, statement: str, label: str):
+        if self.profiler:
+            self.profiler.execute(cursor, statement, label)
+        else:
+            cursor.execute(statement)
+
+    def _completed_statements(self, path: str):
+        # {statement index: digest} of the finished statements, None when the
+        # checkpoint table can't be used (e.g. the results schema is missing)
+        try:
+            with self.db_connector.connect.cursor() as cursor:
+                cursor.execute(
+                    sql.SQL(
+                        "CREATE TABLE IF NOT EXISTS {}.{} ("
+                        "file_path varchar(1000) NOT NULL, "
+                        "statement_index integer NOT NULL, "
+                        "statement_hash varchar(32) NOT NULL, "
+                        "seconds double precision, "
+                        "completed_at timestamp NOT NULL DEFAULT now(), "
+                        "PRIMARY KEY (file_path, statement_index))"
+                    ).format(sql.Identifier(self.checkpoint_schema), sql.Identifier(self.checkpoint_table))
+                )
+                cursor.execute(
+                    sql.SQL("SELECT statement_index, statement_hash FROM {}.{} WHERE file_path = %s").format(
+                        sql.Identifier(self.checkpoint_schema), sql.Identifier(self.checkpoint_table)
+                    ),
+                    (path,)
+                )
+                done = dict(cursor.fetchall())
             self.db_connector.connect.commit()
-            
-    def _execute_view_cdm(self, cdm_schemas, vocab_tables, vocab_schema: str):
+            return done
+        except (Exception, psycopg.Error) as e:
+            self.db_connector.connect.rollback()
+            print(f"No statement checkpoints for {path}: {e}")
+            return None
+
+    def _checkpoint(self, cursor, path: str, index: int, digest: str, seconds: float):
+        cursor.execute(
+            sql.SQL(
+                "INSERT INTO {}.{} (file_path, statement_index, statement_hash, seconds) VALUES (%s, %s, %s, %s) "
+                "ON CONFLICT (file_path, statement_index) DO UPDATE SET "
+                "statement_hash = EXCLUDED.statement_hash, seconds = EXCLUDED.seconds, completed_at = now()"
+            ).format(sql.Identifier(self.checkpoint_schema), sql.Identifier(self.checkpoint_table)),
+            (path, index, digest, seconds)
+        )
+
+    def _clear_checkpoints(self, path: str):
         with self.db_connector.connect.cursor() as cursor:
-            for cdm in cdm_schemas:
-                for table in vocab_tables:
-                    sql_command = f"""
-                    CREATE OR REPLACE VIEW {cdm}.{table} AS
-                    SELECT *
-                    FROM {vocab_schema}.{table};
-                    """
-                    cursor.execute(sql_command)
-            self.db_connector.connect.commit()
\ No newline at end of file
+            cursor.execute(
+                sql.SQL("DELETE FROM {}.{} WHERE file_path = %s").format(
+                    sql.Identifier(self.checkpoint_schema), sql.Identifier(self.checkpoint_table)
+                ),
+                (path,)
+            )
+        self.db_connector.connect.commit()
+
+    def _record_sql_file(self, path: str, started: float, status: str = 'ok'):
+        if self.metrics:
+            size = os.path.getsize(path) if os.path.exists(path) else None
+            self.metrics.record('sql', os.path.basename(path), time.perf_counter() - started,
+                                bytes=size, status=status, detail=path)
+
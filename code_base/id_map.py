@@ -0,0 +1,150 @@
+import sqlite3
+import threading
+from datetime import datetime
+from code_base.pseudonymize import SEED, MAX_ID, hash_to_int
+
+# SQLite limits the number of bound parameters per statement
+LOOKUP_BATCH = 900
+
+# probes per value before the map gives up; a domain needs to be nearly full
+# of max_id IDs for a value to miss this many times
+MAX_PROBES = 100
+
+class IdMapStore:
+    """
+    Persistent (ID domain, source ID) -> OMOP ID map in a SQLite file.
+
+    IDs are unique per domain, the table an ID column points at (see
+    pseudonymize.id_domain), so person IDs only compete with person IDs and
+    preceding_visit_occurrence_id shares visit_occurrence's IDs. A new source
+    value gets hash_to_int(value) unless another value of its domain already
+    holds that ID; then it probes hash_to_int("value#1"), "value#2", ... up
+    to MAX_PROBES times, and raises ValueError if all of them are taken. A
+    value keeps its ID for good, so IDs without a collision are the plain
+    hash_to_int values, and a monthly delta only hashes the values the map
+    hasn't seen yet.
+
+    New values of one resolve() call are assigned in sorted order. Which of
+    two colliding values keeps its plain hash therefore depends on which one
+    reaches the map first: the IDs are reproducible for the same files
+    resolved in the same order with the same chunk size, e.g. with one
+    formatter worker.
+    """
+    def __init__(self, path: str, seed=SEED, max_id=MAX_ID):
+        self.path = path
+        self.seed = seed
+        self.max_id = max_id
+        self.assigned = 0
+        self.collisions = 0
+        # several formatter processes can share the file, writers wait for each other
+        self.connection = sqlite3.connect(path, timeout=300, isolation_level=None, check_same_thread=False)
+        # the loader's worker threads share one store and its connection
+        self._lock = threading.Lock()
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.ensure_tables()
+
+    def ensure_tables(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS id_map ("
+                "domain TEXT NOT NULL, "
+                "source_value TEXT NOT NULL, "
+                "omop_id INTEGER NOT NULL, "
+                "probe INTEGER NOT NULL, "
+                "created_at TEXT NOT NULL, "
+                "PRIMARY KEY (domain, source_value), "
+                "UNIQUE (domain, omop_id))"
+            )
+            self.connection.execute("CREATE TABLE IF NOT EXISTS id_map_settings (name TEXT PRIMARY KEY, value TEXT)")
+            self.connection.execute(
+                "INSERT OR IGNORE INTO id_map_settings VALUES ('seed', ?), ('max_id', ?)",
+                (str(self.seed), str(self.max_id))
+            )
+            settings = dict(self.connection.execute("SELECT name, value FROM id_map_settings"))
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        # the IDs in the file only stay valid with the settings they were made with
+        if (settings['seed'], settings['max_id']) != (str(self.seed), str(self.max_id)):
+            raise ValueError(
+                f"ID map '{self.path}' was built with seed={settings['seed']} and max_id={settings['max_id']}, "
+                f"not seed={self.seed} and max_id={self.max_id}."
+            )
+
+    def resolve(self, values, domain: str) -> dict:
+        """
+        Returns {source value: OMOP ID} for the given values of one ID
+        domain, assigning and storing IDs for the new ones in a single
+        transaction.
+        """
+        values = sorted(set(values))
+        with self._lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                resolved = self._lookup(domain, "source_value", values)
+                new = [value for value in values if value not in resolved]
+                if new:
+                    resolved.update(self._assign(domain, new))
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return resolved
+
+    def _assign(self, domain: str, values: list) -> dict:
+        candidates = {value: hash_to_int(value, self.seed, self.max_id) for value in values}
+        taken = set(self._lookup(domain, "omop_id", list(candidates.values())).keys())
+        assigned = {}
+        rows = []
+        created_at = datetime.now().isoformat(timespec='seconds')
+        for value in values:
+            omop_id, probe = candidates[value], 0
+            while omop_id in taken or (probe and self._id_taken(domain, omop_id)):
+                probe += 1
+                if probe > MAX_PROBES:
+                    raise ValueError(
+                        f"ID map '{self.path}': no free {domain} ID for {value!r} after {MAX_PROBES} probes. "
+                        f"The domain holds {self._domain_size(domain) + len(rows)} of {self.max_id} IDs; "
+                        f"a larger max_id needs a new map file."
+                    )
+                omop_id = hash_to_int(f"{value}#{probe}", self.seed, self.max_id)
+            if probe:
+                self.collisions += 1
+            taken.add(omop_id)
+            assigned[value] = omop_id
+            rows.append((domain, value, omop_id, probe, created_at))
+        self.connection.executemany("INSERT INTO id_map VALUES (?, ?, ?, ?, ?)", rows)
+        self.assigned += len(rows)
+        return assigned
+
+    def _id_taken(self, domain: str, omop_id: int) -> bool:
+        # only reached for probed IDs, the plain hashes were looked up in bulk
+        return self.connection.execute(
+            "SELECT 1 FROM id_map WHERE domain = ? AND omop_id = ?", (domain, omop_id)
+        ).fetchone() is not None
+
+    def _domain_size(self, domain: str) -> int:
+        return self.connection.execute("SELECT count(*) FROM id_map WHERE domain = ?", (domain,)).fetchone()[0]
+
+    def _lookup(self, domain: str, column: str, keys: list) -> dict:
+        # source_value -> omop_id, or omop_id -> source_value, for the keys present in the domain
+        found = {}
+        select = "source_value, omop_id" if column == "source_value" else "omop_id, source_value"
+        for start in range(0, len(keys), LOOKUP_BATCH):
+            batch = keys[start:start + LOOKUP_BATCH]
+            placeholders = ", ".join("?" * len(batch))
+            found.update(self.connection.execute(
+                f"SELECT {select} FROM id_map WHERE domain = ? AND {column} IN ({placeholders})", [domain, *batch]
+            ))
+        return found
+
+    def stats(self) -> tuple:
+        # (values mapped, values that needed a probe) over the whole map
+        with self._lock:
+            return self.connection.execute("SELECT count(*), count(*) FILTER (WHERE probe > 0) FROM id_map").fetchone()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,145 @@
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import psycopg
+from code_base.ddl import DDL, INDEX_PATTERN
+from code_base.sql_script import split_statements, statement_summary
+
+# CLUSTER <table> USING <index>, with the index name
+CLUSTER_USING_PATTERN = re.compile(r"CLUSTER\s+([\w.]+)\s+USING\s+(\w+)", re.IGNORECASE)
+
+class IndexBuilder:
+    """
+    Builds the indices of cdm_indices.sql / vocab_indices.sql table by table
+    on a pool of connections. The statements of one table (its CREATE INDEX
+    and the CLUSTER that uses one of them) run in file order on one
+    connection; different tables build side by side, largest first. The
+    connections use the maintenance session profile, each with its own
+    maintenance_work_mem, so plan for workers x maintenance_work_mem of memory.
+
+    Indices that already exist and CLUSTERs that already ran are skipped, so
+    a rerun after a failure only builds what is missing.
+    """
+    def __init__(self, ddl: DDL, workers: int = 4):
+        self.ddl = ddl
+        self.db_connector = ddl.db_connector
+        self.workers = workers
+
+    def build(self, paths: list) -> bool:
+        groups, others = self._plan(paths)
+        if not groups and not others:
+            print("No index statements found.")
+            return True
+
+        started = time.perf_counter()
+        results = []
+        pool = self.db_connector.create_pool(max_size=min(self.workers, len(groups)) or 1, profile='maintenance')
+        if pool is None:
+            return False
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [
+                    executor.submit(self._build_table, pool, table, statements)
+                    for table, statements in self._largest_first(groups)
+                ]
+                for future in as_completed(futures):
+                    results.append(future.result())
+        finally:
+            pool.close()
+
+        # statements the patterns don't recognize run last, in file order
+        for statement in others:
+            results.append(self._build_table(None, statement_summary(statement, 40), [statement]))
+
+        self._report(results, time.perf_counter() - started)
+        return all(error is None for _, _, _, _, error in results)
+
+    def _plan(self, paths: list):
+        # {table: [statements in file order]} plus the statements of no known table
+        groups, others = {}, []
+        for path in paths:
+            for statement in split_statements(self.ddl._read_sql_file(path)):
+                match = INDEX_PATTERN.search(statement) or CLUSTER_USING_PATTERN.search(statement)
+                if match is None:
+                    others.append(statement)
+                    continue
+                table = (match.group(2) if match.re is INDEX_PATTERN else match.group(1)).lower()
+                groups.setdefault(table, []).append(statement)
+        return groups, others
+
+    def _largest_first(self, groups: dict) -> list:
+        sizes = {}
+        try:
+            with self.db_connector.connect.cursor() as cursor:
+                for table in groups:
+                    cursor.execute("SELECT coalesce(pg_total_relation_size(to_regclass(%s)), 0)", (table,))
+                    sizes[table] = cursor.fetchone()[0]
+            self.db_connector.connect.commit()
+        except (Exception, psycopg.Error) as e:
+            self.db_connector.connect.rollback()
+            print(f"Could not read table sizes, building in file order: {e}")
+        return sorted(groups.items(), key=lambda item: sizes.get(item[0], 0), reverse=True)
+
+    def _build_table(self, pool, table: str, statements: list) -> tuple:
+        """Returns (table, statements run, statements skipped, seconds, error or None)."""
+        started = time.perf_counter()
+        ran, skipped = 0, 0
+        connection = pool.getconn() if pool else self.db_connector.connect
+        try:
+            for statement in statements:
+                if self._already_built(connection, statement, table):
+                    skipped += 1
+                    continue
+                with connection.cursor() as cursor:
+                    cursor.execute(statement)
+                connection.commit()
+                ran += 1
+            error = None
+        except (Exception, psycopg.Error) as e:
+            connection.rollback()
+            error = f"{statement_summary(statement)}: {e}"
+        finally:
+            if pool:
+                pool.putconn(connection)
+        seconds = time.perf_counter() - started
+        if self.ddl.metrics:
+            self.ddl.metrics.record('index', table, seconds, status='ok' if error is None else 'failed',
+                                    detail=f"{ran} built, {skipped} skipped")
+        return table, ran, skipped, seconds, error
+
+    def _already_built(self, connection, statement: str, table: str) -> bool:
+        if '.' not in table:
+            return False
+        schema = table.split('.')[0]
+        index_match = INDEX_PATTERN.search(statement)
+        cluster_match = CLUSTER_USING_PATTERN.search(statement)
+        if index_match:
+            index_name = index_match.group(1)
+        elif cluster_match:
+            index_name = cluster_match.group(2)
+        else:
+            return False
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT i.indisclustered FROM pg_index i WHERE i.indexrelid = to_regclass(%s)",
+                (f"{schema}.{index_name}",)
+            )
+            row = cursor.fetchone()
+        connection.commit()
+        if index_match:
+            return row is not None
+        # a CLUSTER is done once its index is marked as the clustered one
+        return row is not None and row[0]
+
+    def _report(self, results: list, seconds: float):
+        failed = [result for result in results if result[4] is not None]
+        print(f"Indices built on {len(results)} table(s) with {self.workers} worker(s) in {seconds:.1f}s.")
+        for table, ran, skipped, table_seconds, error in sorted(results, key=lambda result: result[3], reverse=True):
+            line = f"  {table}: {ran} statement(s) in {table_seconds:.1f}s"
+            if skipped:
+                line += f", {skipped} already built"
+            if error:
+                line += f" - FAILED: {error}"
+            print(line)
+        if failed:
+            print(f"{len(failed)} table(s) failed; rerun to build the missing indices.")
@@ -0,0 +1,213 @@
+import os
+import time
+import hashlib
+import zipfile
+import psycopg
+from psycopg import sql
+from code_base.db_connector import DBConnector
+from code_base.csv_source import as_source
+
+# a file is fingerprinted from this many evenly spaced blocks, not read in full
+FINGERPRINT_BLOCKS = 16
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+
+class LoadManifest:
+    """
+    Control table in the results schema that records, per loaded file, its
+    size, mtime, a content fingerprint, the target table, the rows loaded and
+    the load status. CSVLoader writes a file's entry in the same transaction
+    as its COPY, so "loaded" always means the rows were committed (an
+    UNLOGGED table can still lose them in a crash, plan() checks for that).
+    """
+    def __init__(self, db_connector: DBConnector, schema: str = None, table: str = "load_manifest"):
+        self.db_connector = db_connector
+        self.schema = schema or db_connector.resultsDatabaseSchema
+        self.table = table
+        # file stats taken while planning, reused when the entry is written
+        self._file_stats = {}
+        self.ensure_table()
+
+    def ensure_table(self):
+        try:
+            with self.db_connector.connect.cursor() as cursor:
+                cursor.execute(
+                    sql.SQL(
+                        "CREATE TABLE IF NOT EXISTS {}.{} ("
+                        "schema_name varchar(255) NOT NULL, "
+                        "file_name varchar(1000) NOT NULL, "
+                        "table_name varchar(255) NOT NULL, "
+                        "file_size bigint, "
+                        "file_mtime double precision, "
+                        "fingerprint varchar(64), "
+                        "rows_loaded bigint, "
+                        "status varchar(20) NOT NULL, "
+                        "updated_at timestamp NOT NULL DEFAULT now(), "
+                        "PRIMARY KEY (schema_name, file_name))"
+                    ).format(sql.Identifier(self.schema), sql.Identifier(self.table))
+                )
+            self.db_connector.connect.commit()
+        except (Exception, psycopg.Error) as error:
+            self.db_connector.connect.rollback()
+            print(f"Error creating load manifest table: {error}")
+
+    def plan(self, schema: str, jobs: list):
+        """
+        Splits (table_name, source) jobs into the ones that still need a load
+        and the tables that must be truncated first.
+
+        A file is skipped when its last load finished and its size, mtime and
+        fingerprint are unchanged. Failed loads were rolled back and are simply
+        loaded again. A table is truncated when one of its files changed after
+        loading or was only partly committed; all files of that table are then
+        loaded again.
+
+        An entry can outlive its rows: bulk mode loads into UNLOGGED tables,
+        which a crash empties while the manifest keeps saying 'loaded'. So
+        'loaded' is only trusted when the table still has rows, the files of
+        an empty table that recorded rows are loaded again.
+        """
+        entries = self._read_entries(schema)
+        emptied = self._emptied_tables(schema, entries)
+        stale_tables = set()
+        pending = []
+        for table_name, source in jobs:
+            stats = self.file_stats(source)
+            entry = entries.get(source.name)
+            if entry is None:
+                pending.append((table_name, source))
+                continue
+            if entry['table_name'] in emptied:
+                # nothing left to truncate, the rows are gone
+                pending.append((table_name, source))
+                continue
+            unchanged = (entry['file_size'], entry['file_mtime'], entry['fingerprint']) == stats
+            if entry['status'] == 'loaded' and unchanged and entry['table_name'] == table_name:
+                continue
+            if entry['status'] in ('loaded', 'partial'):
+                # old rows from this file are still in the table
+                stale_tables.add(entry['table_name'])
+                stale_tables.add(table_name)
+            pending.append((table_name, source))
+
+        # truncating a table drops the rows of its unchanged files as well
+        pending_names = {source.name for _, source in pending}
+        for table_name, source in jobs:
+            if table_name in stale_tables and source.name not in pending_names:
+                pending.append((table_name, source))
+
+        skipped = len(jobs) - len(pending)
+        if skipped:
+            print(f"Load manifest: {skipped} unchanged file(s) already loaded, skipping them.")
+        return pending, sorted(stale_tables)
+
+    def mark(self, cursor, schema: str, table: str, source, status: str, rows: int = None):
+        """Upserts the entry for a file. Runs inside the caller's transaction."""
+        source = as_source(source)
+        size, mtime, fingerprint = self.file_stats(source)
+        cursor.execute(
+            sql.SQL(
+                "INSERT INTO {}.{} (schema_name, file_name, table_name, file_size, file_mtime, "
+                "fingerprint, rows_loaded, status, updated_at) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, now()) "
+                "ON CONFLICT (schema_name, file_name) DO UPDATE SET "
+                "table_name = EXCLUDED.table_name, file_size = EXCLUDED.file_size, "
+                "file_mtime = EXCLUDED.file_mtime, fingerprint = EXCLUDED.fingerprint, "
+                "rows_loaded = EXCLUDED.rows_loaded, status = EXCLUDED.status, updated_at = now()"
+            ).format(sql.Identifier(self.schema), sql.Identifier(self.table)),
+            (schema, source.name, table, size, mtime, fingerprint, rows, status)
+        )
+
+    def mark_failed(self, connection, schema: str, table: str, source):
+        # called after the load was rolled back, so it gets its own transaction
+        source = as_source(source)
+        try:
+            with connection.cursor() as cursor:
+                self.mark(cursor, schema, table, source, 'failed')
+            connection.commit()
+        except (Exception, psycopg.Error) as error:
+            connection.rollback()
+            print(f"Error recording failed load of '{source.name}' in the manifest: {error}")
+
+    def file_stats(self, source) -> tuple:
+        source = as_source(source)
+        if source.name not in self._file_stats:
+            if source.member is not None:
+                # zip members carry their own size, timestamp and CRC, no need to read them
+                with zipfile.ZipFile(source.path) as archive:
+                    info = archive.getinfo(source.member)
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                stats = (info.file_size, mtime, f"crc32:{info.CRC:08x}")
+            else:
+                stat = os.stat(source.path)
+                stats = (stat.st_size, stat.st_mtime, self.fingerprint(source.path))
+            self._file_stats[source.name] = stats
+        return self._file_stats[source.name]
+
+    def fingerprint(self, file_path: str) -> str:
+        """
+        Hashes the size and evenly spaced blocks of the file, so it stays cheap
+        on files of tens of GB. Edits that keep the size and miss every block
+        are caught by the mtime check instead.
+        """
+        size = os.path.getsize(file_path)
+        digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+        with open(file_path, 'rb') as f:
+            if size <= FINGERPRINT_BLOCKS * FINGERPRINT_BLOCK_SIZE:
+                digest.update(f.read())
+            else:
+                step = (size - FINGERPRINT_BLOCK_SIZE) // (FINGERPRINT_BLOCKS - 1)
+                for block in range(FINGERPRINT_BLOCKS):
+                    f.seek(block * step)
+                    digest.update(f.read(FINGERPRINT_BLOCK_SIZE))
+        return digest.hexdigest()
+
+    def _read_entries(self, schema: str) -> dict:
+        try:
+            with self.db_connector.connect.cursor() as cursor:
+                cursor.execute(
+                    sql.SQL(
+                        "SELECT file_name, table_name, file_size, file_mtime, fingerprint, rows_loaded, status "
+                        "FROM {}.{} WHERE schema_name = %s"
+                    ).format(sql.Identifier(self.schema), sql.Identifier(self.table)),
+                    (schema,)
+                )
+                rows = cursor.fetchall()
+            self.db_connector.connect.commit()
+        except (Exception, psycopg.Error) as error:
+            self.db_connector.connect.rollback()
+            print(f"Error reading load manifest: {error}")
+            return {}
+        return {
+            file_name: {
+                'table_name': table_name,
+                'file_size': file_size,
+                'file_mtime': file_mtime,
+                'fingerprint': fingerprint,
+                'rows_loaded': rows_loaded,
+                'status': status,
+            }
+            for file_name, table_name, file_size, file_mtime, fingerprint, rows_loaded, status in rows
+        }
+
+    def _emptied_tables(self, schema: str, entries: dict) -> set:
+        # tables with files recorded as loaded with rows that have no rows now
+        recorded = {}
+        for entry in entries.values():
+            if entry['status'] == 'loaded' and (entry['rows_loaded'] or 0) > 0:
+                recorded[entry['table_name']] = recorded.get(entry['table_name'], 0) + 1
+        emptied = set()
+        for table, files in sorted(recorded.items()):
+            try:
+                with self.db_connector.connect.cursor() as cursor:
+                    cursor.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {})").format(sql.Identifier(schema, table)))
+                    has_rows = cursor.fetchone()[0]
+                self.db_connector.connect.commit()
+            except (Exception, psycopg.Error) as error:
+                self.db_connector.connect.rollback()
+                print(f"Error checking {schema}.{table} for the load manifest: {error}")
+                continue
+            if not has_rows:
+                emptied.add(table)
+                print(f"Load manifest: {schema}.{table} is empty although {files} file(s) were recorded as loaded "
+                      f"(an UNLOGGED table after a crash?), loading them again.")
+        return emptied
@@ -0,0 +1,81 @@
+import os
+import csv
+import json
+import threading
+from datetime import datetime
+
+REPORT_FIELDS = [
+    'stage', 'name', 'detail', 'status', 'bytes', 'rows', 'wall_seconds', 'transaction_seconds',
+    'mb_per_second', 'rows_per_second', 'finished_at',
+]
+
+class RunMetrics:
+    """
+    Collects one entry per loaded table and per executed SQL file: bytes,
+    rows, wall time, for loads the span of the load on the server's clock
+    (transaction_seconds, see server_clock) and the derived MB/s and rows/s.
+    write_report dumps them as JSON and CSV at the end of a run. Safe to use
+    from the parallel loader threads.
+    """
+    def __init__(self):
+        self.started_at = datetime.now()
+        self._entries = []
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, name: str, wall_seconds: float, bytes: int = None, rows: int = None,
+               transaction_seconds: float = None, status: str = 'ok', detail: str = None):
+        # rates of a failed step would only describe how fast it failed
+        finished = status == 'ok' and wall_seconds > 0
+        entry = {
+            'stage': stage,
+            'name': name,
+            'detail': detail,
+            'status': status,
+            'bytes': bytes,
+            'rows': rows,
+            'wall_seconds': round(wall_seconds, 3),
+            'transaction_seconds': round(transaction_seconds, 3) if transaction_seconds is not None else None,
+            'mb_per_second': round(bytes / 1024 / 1024 / wall_seconds, 2) if bytes and finished else None,
+            'rows_per_second': round(rows / wall_seconds, 1) if rows and finished else None,
+            'finished_at': datetime.now().isoformat(timespec='seconds'),
+        }
+        with self._lock:
+            self._entries.append(entry)
+
+    @property
+    def entries(self) -> list:
+        with self._lock:
+            return list(self._entries)
+
+    def write_report(self, path: str):
+        """Writes <path> as JSON and the same entries next to it as .csv."""
+        entries = self.entries
+        report = {
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'finished_at': datetime.now().isoformat(timespec='seconds'),
+            'entries': entries,
+        }
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+            csv_path = os.path.splitext(path)[0] + '.csv'
+            with open(csv_path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+                writer.writeheader()
+                writer.writerows(entries)
+            print(f"Run report written to {path} and {csv_path}.")
+        except OSError as error:
+            print(f"Error writing run report: {error}")
+
+
+def server_clock(cursor) -> float:
+    # Seconds on the server's clock. Two readings on one connection, before
+    # and after a COPY FROM STDIN, span everything in between: the server
+    # waits for the rows while the client reads, decompresses and sends them,
+    # so this is not the server's own work, only the session's time between
+    # the readings minus the client's set-up and teardown around them.
+    cursor.execute("SELECT extract(epoch FROM clock_timestamp())")
+    return float(cursor.fetchone()[0])
@@ -0,0 +1,271 @@
+import time
+import psycopg
+from psycopg import sql
+from code_base.db_connector import DBConnector
+
+READ_ONLY_TABLE_PRIVILEGES = {'SELECT'}
+READ_WRITE_TABLE_PRIVILEGES = {'SELECT', 'INSERT', 'UPDATE', 'DELETE'}
+
+# GRANT ... ON TABLE takes at most this many tables per statement
+GRANT_BATCH = 500
+
+# Everything the planner compares, in one round trip: roles, memberships,
+# schemas, and the privileges on the database, the schemas, their tables and
+# sequences, plus the default privileges of the current user. NULL ACLs are
+# replaced by the owner's implicit ones (acldefault).
+CATALOG_QUERY = """
+SELECT 'role', rolname, NULL, NULL, CASE WHEN rolsuper THEN 'SUPERUSER' END FROM pg_roles
+UNION ALL
+SELECT 'member', m.rolname, r.rolname, NULL, NULL
+FROM pg_auth_members am JOIN pg_roles r ON r.oid = am.roleid JOIN pg_roles m ON m.oid = am.member
+UNION ALL
+SELECT 'schema', n.nspname, pg_get_userbyid(n.nspowner), NULL, NULL
+FROM pg_namespace n WHERE n.nspname = ANY(%(schemas)s)
+UNION ALL
+SELECT 'schema_acl', n.nspname, NULL, pg_get_userbyid(a.grantee), a.privilege_type
+FROM pg_namespace n, aclexplode(coalesce(n.nspacl, acldefault('n', n.nspowner))) a
+WHERE n.nspname = ANY(%(schemas)s)
+UNION ALL
+SELECT 'database_acl', d.datname, NULL, pg_get_userbyid(a.grantee), a.privilege_type
+FROM pg_database d, aclexplode(coalesce(d.datacl, acldefault('d', d.datdba))) a
+WHERE d.datname = current_database()
+UNION ALL
+SELECT CASE WHEN c.relkind = 'S' THEN 'sequence' ELSE 'table' END, n.nspname, c.relname, NULL, NULL
+FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = ANY(%(schemas)s) AND c.relkind IN ('r', 'p', 'v', 'm', 'f', 'S')
+UNION ALL
+SELECT CASE WHEN c.relkind = 'S' THEN 'sequence_acl' ELSE 'table_acl' END, n.nspname, c.relname,
+       pg_get_userbyid(a.grantee), a.privilege_type
+FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace,
+     aclexplode(coalesce(c.relacl, acldefault(CASE WHEN c.relkind = 'S' THEN 's' ELSE 'r' END::"char", c.relowner))) a
+WHERE n.nspname = ANY(%(schemas)s) AND c.relkind IN ('r', 'p', 'v', 'm', 'f', 'S')
+UNION ALL
+SELECT 'default_acl', n.nspname, d.defaclobjtype::text, pg_get_userbyid(a.grantee), a.privilege_type
+FROM pg_default_acl d JOIN pg_namespace n ON n.oid = d.defaclnamespace, aclexplode(d.defaclacl) a
+WHERE d.defaclrole = (SELECT oid FROM pg_roles WHERE rolname = current_user) AND n.nspname = ANY(%(schemas)s)
+"""
+
+class PermissionPlanner:
+    """
+    Declarative version of the role and permission setup. The wanted state is
+    declared first (schemas, roles, users, grants, owners, memberships); plan()
+    reads the current state from the catalog in one query and returns only
+    the statements that are missing, and apply() runs them in a single
+    transaction. A rerun on a set-up database changes nothing and takes no
+    locks beyond the catalog read.
+
+    Grants are only ever added; privileges the declaration doesn't mention
+    are left as they are. Existing users keep their password.
+    """
+    def __init__(self, db_connector: DBConnector, lock_timeout: str = '10s'):
+        self.db_connector = db_connector
+        # a GRANT waiting behind a long WebAPI query would block everything after it
+        self.lock_timeout = lock_timeout
+        self.superusers = []
+        self.wanted_schemas = []
+        self.roles = []
+        self.users = {}
+        self.database_access = []
+        self.schema_privileges = {}
+        self.table_privileges = {}
+        self.sequence_privileges = {}
+        self.owners = {}
+        self.memberships = []
+
+    # Declarations
+
+    def superuser(self, username):
+        self.superusers.append(username)
+
+    def schemas(self, schemas: list):
+        self.wanted_schemas.extend(schema for schema in schemas if schema and schema not in self.wanted_schemas)
+
+    def role(self, role_name):
+        self.roles.append(role_name)
+
+    def user(self, username, password):
+        self.users[username] = password
+
+    def database_connect(self, role_name, database_name):
+        self.database_access.append((role_name, database_name))
+
+    def read_only(self, role_name, schema_name):
+        # USAGE on the schema, SELECT on its tables, now and in future
+        self._grant(role_name, schema_name, {'USAGE'}, READ_ONLY_TABLE_PRIVILEGES, set())
+
+    def read_write(self, role_name, schema_name):
+        # USAGE and CREATE on the schema, DML on its tables, USAGE on its sequences, now and in future
+        self._grant(role_name, schema_name, {'USAGE', 'CREATE'}, READ_WRITE_TABLE_PRIVILEGES, {'USAGE'})
+
+    def schema_owner(self, schema_name, role_name):
+        self.owners[schema_name] = role_name
+
+    def member(self, username, role_name):
+        self.memberships.append((username, role_name))
+
+    def _grant(self, role_name, schema_name, schema_privileges: set, table_privileges: set, sequence_privileges: set):
+        if not schema_name:
+            return
+        self.schemas([schema_name])
+        key = (schema_name, role_name)
+        self.schema_privileges.setdefault(key, set()).update(schema_privileges)
+        self.table_privileges.setdefault(key, set()).update(table_privileges)
+        if sequence_privileges:
+            self.sequence_privileges.setdefault(key, set()).update(sequence_privileges)
+
+    # Planning
+
+    def plan(self) -> list:
+        """Returns the missing changes as (description, statement) pairs, in the order they must run."""
+        state = self._read_catalog()
+        changes = []
+        for schema in self.wanted_schemas:
+            if schema not in state['schemas']:
+                changes.append((f"create schema {schema}",
+                                sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(sql.Identifier(schema))))
+        for role_name in self.roles:
+            if role_name not in state['roles']:
+                changes.append((f"create role {role_name}",
+                                sql.SQL("CREATE ROLE {} NOLOGIN").format(sql.Identifier(role_name))))
+        for username, password in self.users.items():
+            if username not in state['roles']:
+                changes.append((f"create user {username}",
+                                sql.SQL("CREATE USER {} WITH PASSWORD {}").format(
+                                    sql.Identifier(username), sql.Literal(password))))
+        for username in self.superusers:
+            if username not in state['superusers']:
+                changes.append((f"make {username} superuser",
+                                sql.SQL("ALTER USER {} WITH SUPERUSER").format(sql.Identifier(username))))
+        for schema, role_name in self.owners.items():
+            if state['schemas'].get(schema) != role_name:
+                changes.append((f"schema {schema} owned by {role_name}",
+                                sql.SQL("ALTER SCHEMA {} OWNER TO {}").format(
+                                    sql.Identifier(schema), sql.Identifier(role_name))))
+        for role_name, database_name in self.database_access:
+            if 'CONNECT' not in state['database_acl'].get((database_name, role_name), set()):
+                changes.append((f"connect on {database_name} for {role_name}",
+                                sql.SQL("GRANT CONNECT ON DATABASE {} TO {}").format(
+                                    sql.Identifier(database_name), sql.Identifier(role_name))))
+        for (schema, role_name), privileges in self.schema_privileges.items():
+            if self.owners.get(schema) == role_name:
+                # the owner has every privilege on its schema
+                continue
+            missing = privileges - state['schema_acl'].get((schema, role_name), set())
+            if missing:
+                changes.append((f"{', '.join(sorted(missing))} on schema {schema} for {role_name}",
+                                sql.SQL("GRANT {} ON SCHEMA {} TO {}").format(
+                                    self._privileges(missing), sql.Identifier(schema), sql.Identifier(role_name))))
+        changes.extend(self._object_grants(state, 'table', self.table_privileges))
+        changes.extend(self._object_grants(state, 'sequence', self.sequence_privileges))
+        changes.extend(self._default_grants(state, 'r', 'TABLES', self.table_privileges))
+        changes.extend(self._default_grants(state, 'S', 'SEQUENCES', self.sequence_privileges))
+        for username, role_name in self.memberships:
+            if (username, role_name) not in state['members']:
+                changes.append((f"{username} member of {role_name}",
+                                sql.SQL("GRANT {} TO {}").format(sql.Identifier(role_name), sql.Identifier(username))))
+        return changes
+
+    def _read_catalog(self) -> dict:
+        state = {
+            'roles': set(), 'superusers': set(), 'members': set(), 'schemas': {},
+            'schema_acl': {}, 'database_acl': {}, 'table': {}, 'sequence': {},
+            'table_acl': {}, 'sequence_acl': {}, 'default_acl': {},
+        }
+        with self.db_connector.connect.cursor() as cursor:
+            cursor.execute(CATALOG_QUERY, {'schemas': self.wanted_schemas})
+            rows = cursor.fetchall()
+        self.db_connector.connect.commit()
+        for kind, name, detail, grantee, privilege in rows:
+            if kind == 'role':
+                state['roles'].add(name)
+                if privilege:
+                    state['superusers'].add(name)
+            elif kind == 'member':
+                state['members'].add((name, detail))
+            elif kind == 'schema':
+                state['schemas'][name] = detail
+            elif kind in ('schema_acl', 'database_acl'):
+                state[kind].setdefault((name, grantee), set()).add(privilege)
+            elif kind in ('table', 'sequence'):
+                state[kind].setdefault(name, []).append(detail)
+            else:
+                # table_acl / sequence_acl by (schema, object, grantee), default_acl by (schema, object type, grantee)
+                state[kind].setdefault((name, detail, grantee), set()).add(privilege)
+        return state
+
+    def _object_grants(self, state: dict, kind: str, wanted: dict) -> list:
+        # GRANT ... ON ALL TABLES IN SCHEMA when every object misses the same
+        # privileges, otherwise only on the objects that miss something
+        changes = []
+        keyword = 'TABLES' if kind == 'table' else 'SEQUENCES'
+        for (schema, role_name), privileges in wanted.items():
+            objects = sorted(state[kind].get(schema, []))
+            missing_by_object = {}
+            for name in objects:
+                missing = privileges - state[f'{kind}_acl'].get((schema, name, role_name), set())
+                if missing:
+                    missing_by_object.setdefault(frozenset(missing), []).append(name)
+            if not missing_by_object:
+                continue
+            if len(missing_by_object) == 1 and len(next(iter(missing_by_object.values()))) == len(objects):
+                missing = next(iter(missing_by_object))
+                changes.append((f"{', '.join(sorted(missing))} on all {len(objects)} {kind}(s) in {schema} for {role_name}",
+                                sql.SQL("GRANT {} ON ALL {} IN SCHEMA {} TO {}").format(
+                                    self._privileges(missing), sql.SQL(keyword),
+                                    sql.Identifier(schema), sql.Identifier(role_name))))
+                continue
+            for missing, names in missing_by_object.items():
+                for start in range(0, len(names), GRANT_BATCH):
+                    batch = names[start:start + GRANT_BATCH]
+                    changes.append((f"{', '.join(sorted(missing))} on {len(batch)} {kind}(s) in {schema} for {role_name}",
+                                    sql.SQL("GRANT {} ON {} {} TO {}").format(
+                                        self._privileges(missing), sql.SQL(kind.upper()),
+                                        sql.SQL(", ").join(sql.Identifier(schema, name) for name in batch),
+                                        sql.Identifier(role_name))))
+        return changes
+
+    def _default_grants(self, state: dict, object_type: str, keyword: str, wanted: dict) -> list:
+        changes = []
+        for (schema, role_name), privileges in wanted.items():
+            missing = privileges - state['default_acl'].get((schema, object_type, role_name), set())
+            if missing:
+                changes.append((f"default {', '.join(sorted(missing))} on new {keyword.lower()} in {schema} for {role_name}",
+                                sql.SQL("ALTER DEFAULT PRIVILEGES IN SCHEMA {} GRANT {} ON {} TO {}").format(
+                                    sql.Identifier(schema), self._privileges(missing),
+                                    sql.SQL(keyword), sql.Identifier(role_name))))
+        return changes
+
+    def _privileges(self, privileges) -> sql.Composed:
+        return sql.SQL(", ").join(sql.SQL(privilege) for privilege in sorted(privileges))
+
+    # Applying
+
+    def apply(self, dry_run: bool = False) -> bool:
+        started = time.perf_counter()
+        connection = self.db_connector.connect
+        try:
+            changes = self.plan()
+        except (Exception, psycopg.Error) as e:
+            connection.rollback()
+            print(f"Error reading roles and privileges: {e}")
+            return False
+        if not changes:
+            print(f"Roles and permissions are up to date (checked in {time.perf_counter() - started:.1f}s).")
+            return True
+        print(f"Roles and permissions: {len(changes)} change(s){' planned (dry run)' if dry_run else ''}:")
+        for description, _ in changes:
+            print(f"  {description}")
+        if dry_run:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(sql.SQL("SET LOCAL lock_timeout = {}").format(sql.Literal(self.lock_timeout)))
+                for _, statement in changes:
+                    cursor.execute(statement)
+            connection.commit()
+            print(f"Applied {len(changes)} permission change(s) in one transaction in {time.perf_counter() - started:.1f}s.")
+            return True
+        except (Exception, psycopg.Error) as e:
+            connection.rollback()
+            print(f"Error applying permission changes: {e} - rolled back, nothing changed.")
+            return False
@@ -0,0 +1,195 @@
+import hashlib
+import threading
+from datetime import datetime
+
+SEED = 42  # Fixed seed for reproducibility
+MAX_ID = 99999999
+
+# OMOP ID columns that are replaced by a pseudonym
+ID_COLUMNS = ['care_site_id', 'location_id', 'person_id', 'observation_period_id',
+              'visit_occurrence_id', 'condition_occurrence_id', 'preceding_visit_occurrence_id', 'drug_exposure_id',
+              'dose_era_id', 'drug_era_id', 'condition_era_id', 'device_exposure_id', 'measurement_id', 'visit_detail_id',
+              'preceding_visit_detail_id', 'procedure_occurrence_id', 'observation_id', 'specimen_id']
+
+# Formats tried when inferring a column's date format. Day-first comes before
+# month-first, so an ambiguous column (every day <= 12) reads as DD/MM/YYYY,
+# as dayfirst=True did.
+DATE_FORMATS = [
+    '%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S.%f',
+    '%d/%m/%Y', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M', '%d-%m-%Y', '%d.%m.%Y',
+    '%Y/%m/%d', '%Y%m%d', '%m/%d/%Y', '%m/%d/%Y %H:%M:%S',
+]
+
+# Postgres column types whose values are normalized by the COPY stage
+DATE_TYPES = {'date', 'timestamp', 'timestamptz'}
+
+# per column, distinct date strings remembered with their normalized form
+DATE_MEMO_SIZE = 100000
+
+# ID values remembered with their pseudonym, per IdHasher
+ID_MEMO_SIZE = 5000000
+
+def id_domain(column: str) -> str:
+    # the table whose rows an ID column points at: visit_occurrence for
+    # visit_occurrence_id and preceding_visit_occurrence_id
+    column = column.lower()
+    if column.startswith('preceding_'):
+        column = column[len('preceding_'):]
+    return column[:-len('_id')] if column.endswith('_id') else column
+
+def primary_key_column(table: str) -> str:
+    # a table's own ID column; its values are unique per row, so never worth remembering
+    return f"{table.lower()}_id"
+
+def hash_to_int(value, seed, max_id):
+    hash_object = hashlib.md5(f"{seed}_{value}".encode())
+    hash_int = int(hash_object.hexdigest(), 16)
+    return (hash_int % max_id) + 1  # Ensure it's within the range and not zero
+
+
+class IdHasher:
+    """
+    hash_to_int over the string form of a value. formatter.py and the COPY
+    stage share this, so a value gets the same pseudonym on either path.
+
+    Values of foreign-key columns (person_id in measurement, ...) repeat and
+    are remembered with their pseudonym, up to ID_MEMO_SIZE values. Callers
+    pass remember=False for a table's own ID column, whose values are unique
+    per row and would only fill the memo.
+
+    With a store (an IdMapStore), IDs come from the persistent map instead,
+    which remembers them across runs and resolves collisions within each ID
+    domain (see id_domain), so the memo is keyed by (domain, value).
+    """
+    def __init__(self, seed=SEED, max_id=MAX_ID, store=None):
+        self.seed = seed
+        self.max_id = max_id
+        self.store = store
+        self.memo = {}
+
+    def __call__(self, key: str, remember: bool = True, domain: str = None) -> int:
+        hashed = self.memo.get((domain, key))
+        if hashed is None:
+            if self.store:
+                return self.hash_many([key], remember, domain)[0]
+            # same digest as hash_to_int; reading the bytes skips the hex round trip
+            digest = hashlib.md5(f"{self.seed}_{key}".encode()).digest()
+            hashed = (int.from_bytes(digest, 'big') % self.max_id) + 1
+            if remember and len(self.memo) < ID_MEMO_SIZE:
+                self.memo[(domain, key)] = hashed
+        return hashed
+
+    def hash_many(self, keys: list, remember: bool = True, domain: str = None) -> list:
+        # one store round trip for all keys not in the memo yet
+        if self.store:
+            missing = [key for key in keys if (domain, key) not in self.memo]
+            resolved = self.store.resolve(missing, domain) if missing else {}
+            if remember:
+                for key in missing[:max(0, ID_MEMO_SIZE - len(self.memo))]:
+                    self.memo[(domain, key)] = resolved[key]
+            return [resolved[key] if key in resolved else self.memo[(domain, key)] for key in keys]
+        return [self(key, remember, domain) for key in keys]
+
+
+class DateNormalizer:
+    """
+    Rewrites one column's date strings as ISO text, value by value. Formats
+    are always tried in DATE_FORMATS order, so a value's result doesn't
+    depend on the rows before it or on thread scheduling: an ambiguous
+    03/04/2020 is day-first, and only a value day-first can't read (12/31/2020)
+    is read month-first. Results are memoized, dates repeat a lot.
+    """
+    def __init__(self, date_only: bool):
+        self.date_only = date_only
+        self.memo = {}
+
+    def __call__(self, value: str):
+        # None when no format matches
+        normalized = self.memo.get(value)
+        if normalized is not None:
+            return normalized
+        for date_format in DATE_FORMATS:
+            try:
+                parsed = datetime.strptime(value, date_format)
+            except ValueError:
+                continue
+            break
+        else:
+            return None
+        if self.date_only:
+            normalized = parsed.strftime('%Y-%m-%d')
+        else:
+            normalized = parsed.isoformat(sep=' ')
+        if len(self.memo) < DATE_MEMO_SIZE:
+            self.memo[value] = normalized
+        return normalized
+
+
+class Pseudonymizer:
+    """
+    The formatter.py rewrite as a streaming stage of the loader: ID columns
+    are hashed and date/timestamp columns normalized while the rows go into
+    COPY, so the source files are never rewritten.
+
+    Differences from formatter.py: an empty ID stays NULL instead of being
+    hashed as "nan", and IDs are hashed as written ("5"), where the formatter
+    hashes "5.0" for ID columns pandas read as float because of a gap. Which
+    columns are dates comes from the table's column types, not the column
+    names. Do not run it on files formatter.py already rewrote.
+
+    With a store (an IdMapStore on the same idMapPath as formatter.py), IDs
+    come from the persistent map, so a value that moved off a colliding hash
+    gets the same OMOP ID on both paths. Values not in the memo cost a map
+    lookup each, which every row's own ID does.
+    """
+    def __init__(self, seed=SEED, max_id=MAX_ID, id_columns: list = None, store=None):
+        self.hasher = IdHasher(seed, max_id, store)
+        self.id_columns = set(id_columns or ID_COLUMNS)
+        self._failed = {}
+        self._lock = threading.Lock()
+
+    def bind(self, name: str, columns: list, column_types: dict):
+        """
+        Returns a function that pseudonymizes one row (a list of field
+        strings) in place, or None when the file has no ID or date column.
+        column_types maps each column to its Postgres type name.
+        """
+        hasher = self.hasher
+        primary_key = primary_key_column(name.split('.')[-1])
+        ids = [(index, column != primary_key, id_domain(column))
+               for index, column in enumerate(columns) if column in self.id_columns]
+        dates = [
+            (index, column, DateNormalizer(date_only=column_types.get(column) == 'date'))
+            for index, column in enumerate(columns)
+            if column_types.get(column) in DATE_TYPES
+        ]
+        if not ids and not dates:
+            return None
+
+        def apply(fields: list) -> list:
+            for index, remember, domain in ids:
+                if index < len(fields) and fields[index] != '':
+                    fields[index] = str(hasher(fields[index], remember, domain))
+            for index, column, normalize in dates:
+                if index < len(fields) and fields[index] != '':
+                    normalized = normalize(fields[index])
+                    if normalized is None:
+                        # loaded as NULL, as formatter.py does with unparseable dates
+                        self._count_failed(name, column)
+                        normalized = ''
+                    fields[index] = normalized
+            return fields
+
+        return apply
+
+    def _count_failed(self, name: str, column: str):
+        with self._lock:
+            self._failed[(name, column)] = self._failed.get((name, column), 0) + 1
+
+    def report(self):
+        print(f"Pseudonymized the ID columns, {len(self.hasher.memo)} foreign-key ID values remembered.")
+        if self.hasher.store:
+            mapped, probed = self.hasher.store.stats()
+            print(f"  ID map '{self.hasher.store.path}' holds {mapped} values, {probed} of them moved off a colliding hash.")
+        for (name, column), count in sorted(self._failed.items()):
+            print(f"  {count} unparseable date(s) in {name}.{column} were loaded as NULL.")
@@ -0,0 +1,125 @@
+import os
+import re
+import json
+import time
+import threading
+from datetime import datetime
+from code_base.sql_script import code_only, statement_summary
+
+# statements EXPLAIN ANALYZE can run; everything else is executed and timed as is
+EXPLAINABLE_PATTERN = re.compile(
+    r"\s*(?:WITH|SELECT|INSERT|UPDATE|DELETE|MERGE|VALUES|"
+    r"CREATE\s+(?:(?:GLOBAL|LOCAL)\s+)?(?:TEMP\s+|TEMPORARY\s+|UNLOGGED\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?[\w.\"]+\s+AS\b|"
+    r"CREATE\s+MATERIALIZED\s+VIEW\b)",
+    re.IGNORECASE
+)
+
+# slowest statements printed at the end
+SLOWEST_SHOWN = 5
+
+class QueryProfiler:
+    """
+    Runs the statements handed to it under EXPLAIN (ANALYZE, BUFFERS, VERBOSE,
+    FORMAT JSON), which executes them as usual and returns the plan with the
+    actual rows, loops, timings and buffer counts of every node. Statements
+    that can't be explained (CREATE INDEX, TRUNCATE, ...) are executed and
+    only timed.
+
+    Sequential scans that read at least seq_scan_rows rows (rows returned plus
+    rows removed by the filter, over all loops) of a table in one of the
+    watched schemas are flagged, with the filter and the join condition above
+    them: a cast on an indexed column there is the usual reason the index
+    isn't used. Timing every plan node costs some overhead, so leave this off
+    for production runs.
+    """
+    def __init__(self, watched_schemas: list, seq_scan_rows: int = 1000000):
+        self.watched_schemas = {schema.lower() for schema in watched_schemas}
+        self.seq_scan_rows = seq_scan_rows
+        self.started_at = datetime.now()
+        self._entries = []
+        self._lock = threading.Lock()
+
+    @property
+    def entries(self) -> list:
+        with self._lock:
+            return list(self._entries)
+
+    def execute(self, cursor, statement: str, label: str):
+        """Executes statement on cursor, profiled, and keeps the result under label."""
+        entry = {'label': label, 'statement': statement_summary(statement, 200), 'explained': False}
+        started = time.perf_counter()
+        if EXPLAINABLE_PATTERN.match(code_only(statement)):
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS, VERBOSE, FORMAT JSON) " + statement)
+            entry.update(self._summarize(cursor.fetchone()[0][0]))
+            entry['explained'] = True
+        else:
+            cursor.execute(statement)
+        entry['wall_seconds'] = round(time.perf_counter() - started, 3)
+        with self._lock:
+            self._entries.append(entry)
+
+    def _summarize(self, explained: dict) -> dict:
+        plan = explained['Plan']
+        seq_scans = []
+        self._find_seq_scans(plan, None, seq_scans)
+        return {
+            'planning_ms': explained.get('Planning Time'),
+            'execution_ms': explained.get('Execution Time'),
+            # buffer counts of the top node include everything below it
+            'shared_hit_blocks': plan.get('Shared Hit Blocks'),
+            'shared_read_blocks': plan.get('Shared Read Blocks'),
+            'temp_written_blocks': plan.get('Temp Written Blocks'),
+            'seq_scans': seq_scans,
+            'plan': plan,
+        }
+
+    def _find_seq_scans(self, node: dict, parent: dict, found: list):
+        if node.get('Node Type') == 'Seq Scan':
+            loops = node.get('Actual Loops', 1)
+            rows = (node.get('Actual Rows', 0) + node.get('Rows Removed by Filter', 0)) * loops
+            schema = (node.get('Schema') or '').lower()
+            condition = None
+            if parent:
+                condition = (parent.get('Hash Cond') or parent.get('Merge Cond')
+                             or parent.get('Join Filter') or parent.get('Filter'))
+            found.append({
+                'table': f"{schema}.{node.get('Relation Name')}" if schema else node.get('Relation Name'),
+                'rows_scanned': rows,
+                'loops': loops,
+                'filter': node.get('Filter'),
+                'join_condition': condition,
+                'flagged': schema in self.watched_schemas and rows >= self.seq_scan_rows,
+            })
+        for child in node.get('Plans', []):
+            self._find_seq_scans(child, node, found)
+
+    def write_report(self, path: str):
+        """Writes the profiled statements, slowest first, as JSON and prints the summary."""
+        entries = sorted(self.entries, key=lambda entry: entry['wall_seconds'], reverse=True)
+        flagged = [(entry, scan) for entry in entries for scan in entry.get('seq_scans', []) if scan['flagged']]
+        report = {
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'finished_at': datetime.now().isoformat(timespec='seconds'),
+            'seq_scan_rows': self.seq_scan_rows,
+            'watched_schemas': sorted(self.watched_schemas),
+            'statements': entries,
+        }
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2, default=str)
+            print(f"Query profile of {len(entries)} statement(s) written to {path}.")
+        except OSError as error:
+            print(f"Error writing query profile: {error}")
+
+        for entry in entries[:SLOWEST_SHOWN]:
+            print(f"  {entry['wall_seconds']:.1f}s  {entry['label']}  {statement_summary(entry['statement'], 60)}")
+        if flagged:
+            print(f"{len(flagged)} sequential scan(s) of large {'/'.join(sorted(self.watched_schemas))} tables:")
+            for entry, scan in flagged:
+                line = f"  {entry['label']}: {scan['table']}, {scan['rows_scanned']} row(s) in {scan['loops']} loop(s)"
+                if scan['join_condition']:
+                    line += f", joined on {scan['join_condition']}"
+                print(line)
@@ -0,0 +1,49 @@
+class RowTransform:
+    """
+    Per-table transform applied to rows while they stream into COPY, in
+    constant memory and without touching the source file.
+
+    defaults:      {column: value} written when the field is empty (NULL to COPY).
+    rewrites:      {column: {old_value: new_value}} applied to exact field values.
+    target_table:  load the rows into this table instead of the one named
+                   after the file (e.g. concept_cpt4 -> concept).
+    """
+    def __init__(self, defaults: dict = None, rewrites: dict = None, target_table: str = None):
+        self.defaults = defaults or {}
+        self.rewrites = rewrites or {}
+        self.target_table = target_table
+
+    @property
+    def changes_rows(self) -> bool:
+        # a pure redirect can keep streaming raw bytes
+        return bool(self.defaults or self.rewrites)
+
+    def bind(self, columns: list):
+        """
+        Resolves the configured columns against a file's header and returns a
+        function that transforms one row (a list of field strings) in place.
+        """
+        positions = {column.lower(): index for index, column in enumerate(columns)}
+        defaults = []
+        for column, value in self.defaults.items():
+            if column.lower() in positions:
+                defaults.append((positions[column.lower()], value))
+            else:
+                print(f"Column '{column}' does not exist in the file, no default applied.")
+        rewrites = []
+        for column, mapping in self.rewrites.items():
+            if column.lower() in positions:
+                rewrites.append((positions[column.lower()], mapping))
+            else:
+                print(f"Column '{column}' does not exist in the file, no rewrite applied.")
+
+        def apply(fields: list) -> list:
+            for index, value in defaults:
+                if index < len(fields) and fields[index] == '':
+                    fields[index] = value
+            for index, mapping in rewrites:
+                if index < len(fields) and fields[index] in mapping:
+                    fields[index] = mapping[fields[index]]
+            return fields
+
+        return apply
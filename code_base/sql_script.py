@@ -0,0 +1,142 @@
+import re
+import hashlib
+
+# $$ or $tag$ opening a dollar-quoted string
+DOLLAR_TAG_PATTERN = re.compile(r"\$([A-Za-z_][A-Za-z0-9_]*)?\$")
+
+def split_statements(script: str) -> list:
+    """
+    Splits a SQL script into its statements, on the semicolons that end
+    them. Semicolons inside '...' and E'...' strings, "quoted identifiers",
+    $tag$ dollar quotes, -- line comments and (nested) /* block comments */
+    don't split. Comments stay with the statement that follows them;
+    statements that are only comments or whitespace are dropped.
+    """
+    statements = []
+    start = 0
+    i = 0
+    length = len(script)
+    while i < length:
+        char = script[i]
+        if char == '-' and script.startswith('--', i):
+            end = script.find('\n', i)
+            i = length if end == -1 else end + 1
+        elif char == '/' and script.startswith('/*', i):
+            i = _skip_block_comment(script, i)
+        elif char == "'":
+            # E'...' strings take backslash escapes, the rest only ''
+            escaped = i > 0 and script[i - 1] in 'eE' and (i == 1 or not _is_word_char(script[i - 2]))
+            i = _skip_quoted(script, i, "'", escaped)
+        elif char == '"':
+            i = _skip_quoted(script, i, '"', False)
+        elif char == '$' and (i == 0 or not _is_word_char(script[i - 1])):
+            match = DOLLAR_TAG_PATTERN.match(script, i)
+            if match:
+                end = script.find(match.group(0), match.end())
+                i = length if end == -1 else end + len(match.group(0))
+            else:
+                i += 1
+        elif char == ';':
+            _append_statement(statements, script[start:i])
+            i += 1
+            start = i
+        else:
+            i += 1
+    _append_statement(statements, script[start:])
+    return statements
+
+def _skip_block_comment(script: str, i: int) -> int:
+    # Postgres block comments nest
+    depth = 0
+    length = len(script)
+    while i < length:
+        if script.startswith('/*', i):
+            depth += 1
+            i += 2
+        elif script.startswith('*/', i):
+            depth -= 1
+            i += 2
+            if depth == 0:
+                return i
+        else:
+            i += 1
+    return length
+
+def _skip_quoted(script: str, i: int, quote: str, backslash_escapes: bool) -> int:
+    i += 1
+    length = len(script)
+    while i < length:
+        char = script[i]
+        if backslash_escapes and char == '\\':
+            i += 2
+        elif char == quote:
+            if script.startswith(quote * 2, i):
+                i += 2  # doubled quote inside the string
+            else:
+                return i + 1
+        else:
+            i += 1
+    return length
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == '_'
+
+def _append_statement(statements: list, text: str):
+    text = text.strip()
+    if text and _strip_comments(text).strip():
+        statements.append(text)
+
+def _strip_comments(text: str) -> str:
+    parts = []
+    i = 0
+    length = len(text)
+    while i < length:
+        if text.startswith('--', i):
+            end = text.find('\n', i)
+            i = length if end == -1 else end
+        elif text.startswith('/*', i):
+            i = _skip_block_comment(text, i)
+        elif text[i] in "'\"":
+            end = _skip_quoted(text, i, text[i], text[i] == "'" and i > 0 and text[i - 1] in 'eE')
+            parts.append(text[i:end])
+            i = end
+        else:
+            parts.append(text[i])
+            i += 1
+    return "".join(parts)
+
+def statement_digest(statement: str) -> str:
+    return hashlib.md5(statement.encode()).hexdigest()
+
+def statement_summary(statement: str, width: int = 80) -> str:
+    # the statement on one line without its comments, for logs and reports
+    text = " ".join(_strip_comments(statement).split())
+    return text if len(text) <= width else text[:width - 3] + "..."
+
+def code_only(statement: str) -> str:
+    # the statement without comments and with empty string literals, so
+    # patterns looking for table names don't match inside either
+    parts = []
+    i = 0
+    length = len(statement)
+    while i < length:
+        char = statement[i]
+        if statement.startswith('--', i):
+            end = statement.find('\n', i)
+            i = length if end == -1 else end
+        elif statement.startswith('/*', i):
+            i = _skip_block_comment(statement, i)
+            parts.append(' ')
+        elif char == "'":
+            escaped = i > 0 and statement[i - 1] in 'eE' and (i == 1 or not _is_word_char(statement[i - 2]))
+            i = _skip_quoted(statement, i, "'", escaped)
+            parts.append("''")
+        elif char == '$' and (i == 0 or not _is_word_char(statement[i - 1])) and DOLLAR_TAG_PATTERN.match(statement, i):
+            tag = DOLLAR_TAG_PATTERN.match(statement, i).group(0)
+            end = statement.find(tag, i + len(tag))
+            i = length if end == -1 else end + len(tag)
+            parts.append("''")
+        else:
+            parts.append(char)
+            i += 1
+    return "".join(parts)
@@ -0,0 +1,259 @@
+import os
+import re
+import json
+import random
+from bisect import bisect
+from datetime import date, timedelta
+from itertools import accumulate
+
+# CREATE TABLE @schema.<table> ( <columns> );
+TABLE_PATTERN = re.compile(r"CREATE\s+TABLE\s+[@\w]+\.(\w+)\s*\((.*?)\)\s*;", re.IGNORECASE | re.DOTALL)
+# <column> <type>[(length)] [NOT] NULL
+COLUMN_PATTERN = re.compile(r"^\s*(\w+)\s+(\w+)(?:\s*\((\d+)(?:\s*,\s*\d+)?\))?\s+(NOT\s+NULL|NULL)", re.IGNORECASE)
+END_PATTERN = re.compile(r"(?:^|_)end(?:_|$)")
+
+# rows per person; tables not listed here stay empty and get no file
+ROWS_PER_PERSON = {
+    'observation_period': 1,
+    'visit_occurrence': 6,
+    'visit_detail': 2,
+    'condition_occurrence': 10,
+    'drug_exposure': 12,
+    'procedure_occurrence': 6,
+    'device_exposure': 1,
+    'measurement': 25,
+    'observation': 8,
+    'death': 0.05,
+    'note': 1,
+    'specimen': 0.2,
+    'payer_plan_period': 1,
+    'drug_era': 4,
+    'dose_era': 1,
+    'condition_era': 5,
+    'location': 0.05,
+    'care_site': 0.01,
+    'provider': 0.02,
+}
+# tables with at most one row per person
+ONE_PER_PERSON = {'observation_period', 'death', 'payer_plan_period'}
+PERSONS_PER_SCALE = 1000
+DOMAINS = ['Metadata', 'Condition', 'Drug', 'Procedure', 'Measurement', 'Observation', 'Device',
+           'Visit', 'Type Concept', 'Gender', 'Race', 'Ethnicity', 'Unit', 'Specimen', 'Note']
+FIRST_DATE = date(2005, 1, 1)
+
+def parse_tables(path: str) -> dict:
+    """{table: [(column, type, length or None, not null)]} of the CREATE TABLE statements in a DDL file."""
+    with open(path, 'r') as file:
+        ddl = file.read()
+    tables = {}
+    for match in TABLE_PATTERN.finditer(ddl):
+        columns = []
+        for line in match.group(2).split(','):
+            column = COLUMN_PATTERN.match(line)
+            if column:
+                length = int(column.group(3)) if column.group(3) else None
+                columns.append((column.group(1).lower(), column.group(2).lower(), length,
+                                column.group(4).upper().startswith('NOT')))
+        tables[match.group(1).lower()] = columns
+    return tables
+
+class SkewedPicker:
+    """
+    Draws from values with Zipf-like weights, 1 / rank ** skew, over a
+    shuffled order. A few values then account for much of the draws, as
+    with frequent patients and common concepts, without the frequent ones
+    being the lowest ids.
+    """
+    def __init__(self, values: list, skew: float, rng: random.Random):
+        self.values = list(values)
+        rng.shuffle(self.values)
+        self.cumulative = list(accumulate(1 / (rank ** skew) for rank in range(1, len(self.values) + 1)))
+        self.rng = rng
+
+    def pick(self):
+        return self.values[bisect(self.cumulative, self.rng.random() * self.cumulative[-1])]
+
+class SyntheticCDM:
+    """
+    Writes CDM 5.4 CSVs for PERSONS_PER_SCALE x scale persons, one file per
+    table of cdm.sql with rows in ROWS_PER_PERSON, plus a small vocabulary
+    (concept, concept_ancestor, ...) the concept ids point into, so the
+    foreign keys of constraints.sql validate. The columns come from the DDL
+    files; values follow the column name and type.
+
+    Events are spread over persons and concepts with skewed weights
+    (person_skew, concept_skew), and dated inside the person's observation
+    period. The output only depends on the seed and the scale.
+    """
+    def __init__(self, cdm_ddl: str, vocab_ddl: str, scale: float = 1.0, seed: int = 42,
+                 person_skew: float = 0.5, concept_skew: float = 1.0, concepts: int = 10000):
+        self.cdm_tables = parse_tables(cdm_ddl)
+        self.vocab_tables = parse_tables(vocab_ddl)
+        self.scale = scale
+        self.seed = seed
+        self.person_skew = person_skew
+        self.concept_skew = concept_skew
+        self.concepts = concepts
+        self.persons = max(1, int(PERSONS_PER_SCALE * scale))
+        self.counts = {
+            table: (self.persons if table == 'person' else
+                    min(self.persons, int(self.persons * per_person)) if table in ONE_PER_PERSON else
+                    int(self.persons * per_person))
+            for table, per_person in {'person': 1, **ROWS_PER_PERSON}.items() if table in self.cdm_tables
+        }
+        self.counts['cdm_source'] = 1
+        rng = random.Random(f"{seed}:periods")
+        # observation period of every person, the events are dated inside it
+        self.periods = {}
+        for person_id in range(1, self.persons + 1):
+            start = FIRST_DATE + timedelta(days=rng.randint(0, 15 * 365))
+            self.periods[person_id] = (start, start + timedelta(days=rng.randint(365, 6 * 365)))
+
+    def settings(self) -> dict:
+        return {'scale': self.scale, 'seed': self.seed, 'person_skew': self.person_skew,
+                'concept_skew': self.concept_skew, 'concepts': self.concepts}
+
+    def generate(self, folder: str) -> dict:
+        """
+        Writes <folder>/cdm/*.csv (comma-separated) and <folder>/vocab/*.csv
+        (tab-separated, like Athena) and returns the rows per table. A folder
+        generated with the same settings before is reused as is.
+        """
+        manifest_path = os.path.join(folder, 'synthetic.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('settings') == self.settings():
+                print(f"Reusing synthetic data in {folder}.")
+                return manifest['rows']
+
+        rows = {}
+        os.makedirs(os.path.join(folder, 'cdm'), exist_ok=True)
+        os.makedirs(os.path.join(folder, 'vocab'), exist_ok=True)
+        for table, count in self.counts.items():
+            if count > 0:
+                path = os.path.join(folder, 'cdm', f"{table}.csv")
+                rows[table] = self._write(path, self.cdm_tables[table], self._cdm_rows(table, count), ',')
+        for table, table_rows in self._vocab_rows().items():
+            if table in self.vocab_tables:
+                path = os.path.join(folder, 'vocab', f"{table}.csv")
+                rows[table] = self._write(path, self.vocab_tables[table], table_rows, '\t')
+
+        with open(manifest_path, 'w') as f:
+            json.dump({'settings': self.settings(), 'rows': rows}, f, indent=2)
+        print(f"Synthetic CDM for {self.persons} persons written to {folder}: {sum(rows.values())} rows.")
+        return rows
+
+    def _write(self, path: str, columns: list, rows, delimiter: str) -> int:
+        names = [column[0] for column in columns]
+        written = 0
+        with open(path, 'w', buffering=1024 * 1024) as f:
+            f.write(delimiter.join(names) + '\n')
+            for row in rows:
+                f.write(delimiter.join('' if row.get(name) is None else str(row[name]) for name in names) + '\n')
+                written += 1
+        return written
+
+    def _cdm_rows(self, table: str, count: int):
+        rng = random.Random(f"{self.seed}:{table}")
+        persons = SkewedPicker(range(1, self.persons + 1), self.person_skew, rng)
+        concepts = {}
+        columns = self.cdm_tables[table]
+        one_per_person = rng.sample(range(1, self.persons + 1), count) if table in ONE_PER_PERSON else None
+        for index in range(count):
+            row_id = index + 1
+            if table == 'person':
+                person_id = row_id
+            elif one_per_person:
+                person_id = one_per_person[index]
+            else:
+                person_id = persons.pick()
+            start, end = self.periods[person_id]
+            event_date = start + timedelta(days=rng.randint(0, (end - start).days))
+            end_date = min(end, event_date + timedelta(days=rng.randint(0, 30)))
+            row = {}
+            for name, column_type, length, not_null in columns:
+                row[name] = self._value(table, name, column_type, length, not_null, rng, concepts,
+                                        row_id, person_id, (start, end), event_date, end_date)
+            yield row
+
+    def _value(self, table, name, column_type, length, not_null, rng, concepts, row_id, person_id, period,
+               event_date, end_date):
+        if name == f"{table}_id":
+            return row_id
+        if name == 'person_id':
+            return person_id
+        if 'concept_id' in name:
+            if name not in concepts:
+                # every column draws from its own order of the concepts
+                concepts[name] = SkewedPicker(range(self.concepts + 1), self.concept_skew, rng)
+            return concepts[name].pick()
+        if name.endswith('_domain_id'):
+            return rng.choice(DOMAINS)
+        if name.endswith('_id'):
+            # a row of the referenced table, NULL when that table is empty
+            referenced = next((other for other in self.counts if name.endswith(f"{other}_id")), None)
+            if referenced and self.counts[referenced]:
+                return rng.randint(1, self.counts[referenced])
+            return 0 if not_null else None
+        if not not_null and rng.random() < 0.3:
+            return None
+        if column_type in ('date', 'timestamp'):
+            if table == 'observation_period':
+                value = period[1] if END_PATTERN.search(name) else period[0]
+            elif 'birth' in name:
+                value = date(1930, 1, 1) + timedelta(days=person_id * 7919 % (80 * 365))
+            else:
+                value = end_date if END_PATTERN.search(name) else event_date
+            if column_type == 'timestamp':
+                return f"{value.isoformat()} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00"
+            return value.isoformat()
+        if name == 'year_of_birth':
+            return 1930 + person_id * 7919 % (80 * 365) // 365
+        if name in ('month_of_birth', 'day_of_birth'):
+            return rng.randint(1, 12 if name == 'month_of_birth' else 28)
+        if column_type == 'numeric':
+            return round(rng.uniform(0, 200), 2)
+        if column_type in ('integer', 'bigint'):
+            return rng.randint(1, 30)
+        value = f"{name.split('_')[0]}{rng.randint(1, 999)}"
+        return value[:length] if length else value
+
+    def _vocab_rows(self) -> dict:
+        valid = {'valid_start_date': '1970-01-01', 'valid_end_date': '2099-12-31'}
+        concept = [
+            {'concept_id': concept_id, 'concept_name': f"Synthetic concept {concept_id}",
+             'domain_id': DOMAINS[concept_id % len(DOMAINS)], 'vocabulary_id': 'Synthetic',
+             'concept_class_id': 'Synthetic', 'standard_concept': 'S' if concept_id else None,
+             'concept_code': concept_id, **valid}
+            for concept_id in range(self.concepts + 1)
+        ]
+        # concepts 1..n form a binary tree: the parent of concept c is c // 2
+        relationships, ancestors = [], []
+        for concept_id in range(1, self.concepts + 1):
+            ancestors.append({'ancestor_concept_id': concept_id, 'descendant_concept_id': concept_id,
+                              'min_levels_of_separation': 0, 'max_levels_of_separation': 0})
+            parent, level = concept_id // 2, 1
+            if parent:
+                relationships.append({'concept_id_1': concept_id, 'concept_id_2': parent, 'relationship_id': 'Is a', **valid})
+                relationships.append({'concept_id_1': parent, 'concept_id_2': concept_id, 'relationship_id': 'Subsumes', **valid})
+            while parent:
+                ancestors.append({'ancestor_concept_id': parent, 'descendant_concept_id': concept_id,
+                                  'min_levels_of_separation': level, 'max_levels_of_separation': level})
+                parent, level = parent // 2, level + 1
+        return {
+            'concept': concept,
+            'vocabulary': [{'vocabulary_id': 'Synthetic', 'vocabulary_name': 'Synthetic vocabulary',
+                            'vocabulary_version': f"seed {self.seed}", 'vocabulary_concept_id': 0}],
+            'domain': [{'domain_id': domain, 'domain_name': domain, 'domain_concept_id': 0} for domain in DOMAINS],
+            'concept_class': [{'concept_class_id': 'Synthetic', 'concept_class_name': 'Synthetic',
+                               'concept_class_concept_id': 0}],
+            'relationship': [
+                {'relationship_id': 'Is a', 'relationship_name': 'Is a', 'is_hierarchical': 1,
+                 'defines_ancestry': 1, 'reverse_relationship_id': 'Subsumes', 'relationship_concept_id': 0},
+                {'relationship_id': 'Subsumes', 'relationship_name': 'Subsumes', 'is_hierarchical': 1,
+                 'defines_ancestry': 1, 'reverse_relationship_id': 'Is a', 'relationship_concept_id': 0},
+            ],
+            'concept_relationship': relationships,
+            'concept_ancestor': ancestors,
+        }
@@ -0,0 +1,136 @@
+import time
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import psycopg
+from psycopg import sql
+from code_base.db_connector import DBConnector
+from code_base.metrics import RunMetrics
+
+# size and columns with their current statistics target of the given tables
+CATALOG_QUERY = """
+SELECT c.relname, pg_table_size(c.oid),
+       (SELECT array_agg(a.attname || '=' || coalesce(a.attstattarget, -1) ORDER BY a.attnum)
+        FROM pg_attribute a
+        WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped) AS columns
+FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = %(schema)s AND c.relname = ANY(%(tables)s) AND c.relkind IN ('r', 'p')
+"""
+
+class TableMaintainer:
+    """
+    Runs VACUUM (ANALYZE) on freshly loaded tables, so the first Achilles and
+    ATLAS queries are planned with real statistics instead of those of an
+    empty table. VACUUM also sets the visibility map, which index-only scans
+    need. Tables run side by side on a pool of connections with the
+    maintenance session profile, largest first, so the biggest one doesn't
+    start last.
+
+    Before that, the join columns matching one of the column patterns
+    (person_id, *_concept_id by default) get a higher statistics target:
+    their most common values and histograms are what the row estimates of
+    the joins between CDM and vocab tables come from. Columns already at the
+    target are left alone.
+    """
+    def __init__(self, db_connector: DBConnector, workers: int = 4, metrics: RunMetrics = None,
+                 statistics_target: int = 1000, statistics_columns: list = None):
+        self.db_connector = db_connector
+        self.workers = workers
+        self.metrics = metrics
+        # 0 leaves the statistics targets as they are
+        self.statistics_target = statistics_target
+        self.statistics_columns = statistics_columns or ['person_id', '*_concept_id']
+
+    def maintain(self, schema: str, tables: list) -> bool:
+        tables = sorted({table.lower() for table in tables})
+        if not tables:
+            return True
+        started = time.perf_counter()
+        try:
+            with self.db_connector.connect.cursor() as cursor:
+                cursor.execute(CATALOG_QUERY, {'schema': schema, 'tables': tables})
+                rows = cursor.fetchall()
+            self.db_connector.connect.commit()
+        except (Exception, psycopg.Error) as e:
+            self.db_connector.connect.rollback()
+            print(f"Error reading the tables to vacuum in {schema}: {e}")
+            return False
+
+        # largest first
+        rows.sort(key=lambda row: row[1] or 0, reverse=True)
+        results = []
+        pool = self.db_connector.create_pool(max_size=min(self.workers, len(rows)) or 1, profile='maintenance')
+        if pool is None:
+            return False
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [
+                    executor.submit(self._maintain_table, pool, schema, table, size, self._hot_columns(columns))
+                    for table, size, columns in rows
+                ]
+                for future in as_completed(futures):
+                    results.append(future.result())
+        finally:
+            pool.close()
+
+        self._report(schema, results, time.perf_counter() - started)
+        return all(error is None for _, _, _, _, error in results)
+
+    def _hot_columns(self, columns: list) -> list:
+        # columns matching a pattern whose statistics target isn't the wanted one yet
+        if not self.statistics_target:
+            return []
+        hot = []
+        for column in columns or []:
+            name, target = column.rsplit('=', 1)
+            if int(target) != self.statistics_target and any(fnmatch(name, pattern) for pattern in self.statistics_columns):
+                hot.append(name)
+        return hot
+
+    def _maintain_table(self, pool, schema: str, table: str, size: int, hot_columns: list) -> tuple:
+        """Returns (table, bytes, live rows, seconds, error or None)."""
+        started = time.perf_counter()
+        rows, error = None, None
+        with pool.connection() as connection:
+            try:
+                if hot_columns:
+                    with connection.cursor() as cursor:
+                        cursor.execute(sql.SQL("ALTER TABLE {} {}").format(
+                            sql.Identifier(schema, table),
+                            sql.SQL(", ").join(
+                                sql.SQL("ALTER COLUMN {} SET STATISTICS {}").format(
+                                    sql.Identifier(column), sql.Literal(self.statistics_target))
+                                for column in hot_columns
+                            )
+                        ))
+                    connection.commit()
+                # VACUUM can't run inside a transaction block
+                connection.autocommit = True
+                with connection.cursor() as cursor:
+                    cursor.execute(sql.SQL("VACUUM (ANALYZE) {}").format(sql.Identifier(schema, table)))
+                    cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                                   (f"{schema}.{table}",))
+                    rows = cursor.fetchone()[0]
+            except (Exception, psycopg.Error) as e:
+                if not connection.autocommit:
+                    connection.rollback()
+                error = str(e).strip().splitlines()[0]
+            finally:
+                connection.autocommit = False
+        seconds = time.perf_counter() - started
+        if self.metrics:
+            detail = f"{schema}.{table}"
+            if hot_columns:
+                detail += f", statistics {self.statistics_target} on {', '.join(hot_columns)}"
+            self.metrics.record('maintenance', f"{schema}.{table}", seconds, bytes=size, rows=rows,
+                                status='ok' if error is None else 'failed', detail=detail)
+        return table, size, rows, seconds, error
+
+    def _report(self, schema: str, results: list, seconds: float):
+        failed = [result for result in results if result[4] is not None]
+        print(f"Vacuumed and analyzed {len(results) - len(failed)} of {len(results)} table(s) in {schema} "
+              f"with {self.workers} worker(s) in {seconds:.1f}s.")
+        for table, _, rows, table_seconds, error in sorted(results, key=lambda result: result[3], reverse=True):
+            if error:
+                print(f"  {table} FAILED: {error}")
+            elif table_seconds >= 1:
+                print(f"  {table_seconds:.1f}s  {table} ({rows} rows)")
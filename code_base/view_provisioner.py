@@ -0,0 +1,143 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import psycopg
+from psycopg import sql
+from code_base.db_connector import DBConnector
+
+# Every object named like a vocab table in the CDM schemas and the vocab
+# schema, with the relations a view selects from and its columns and types.
+CATALOG_QUERY = """
+SELECT n.nspname, c.relname, c.relkind,
+       (SELECT array_agg(DISTINCT rn.nspname || '.' || rc.relname)
+        FROM pg_rewrite r
+        JOIN pg_depend d ON d.classid = 'pg_rewrite'::regclass AND d.objid = r.oid
+        JOIN pg_class rc ON rc.oid = d.refobjid
+        JOIN pg_namespace rn ON rn.oid = rc.relnamespace
+        WHERE r.ev_class = c.oid AND d.refclassid = 'pg_class'::regclass AND d.refobjid <> c.oid) AS sources,
+       (SELECT array_agg(a.attname || ' ' || format_type(a.atttypid, a.atttypmod) ORDER BY a.attnum)
+        FROM pg_attribute a
+        WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped) AS columns
+FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE (n.nspname = ANY(%(cdm_schemas)s) OR n.nspname = %(vocab_schema)s) AND c.relname = ANY(%(tables)s)
+"""
+
+class ViewProvisioner:
+    """
+    Creates the <cdm schema>.<vocab table> views over the vocab schema. The
+    existing objects are read from the catalog in one query first. A view
+    that selects from the right vocab table and has its current columns is
+    left alone, so a rerun takes no locks on views WebAPI is reading. Missing
+    views are created and stale ones replaced, with one connection per CDM
+    schema, each view in its own transaction.
+
+    A table in the CDM schema with a vocab table's name is never replaced,
+    it is reported instead.
+    """
+    def __init__(self, db_connector: DBConnector, workers: int = 4, lock_timeout: str = '10s'):
+        self.db_connector = db_connector
+        self.workers = workers
+        self.lock_timeout = lock_timeout
+
+    def provision(self, cdm_schemas: list, vocab_tables: list, vocab_schema: str) -> bool:
+        started = time.perf_counter()
+        cdm_schemas = [schema.strip() for schema in cdm_schemas if schema.strip()]
+        vocab_tables = [table.strip() for table in vocab_tables if table.strip()]
+        try:
+            existing, vocab_columns = self._read_catalog(cdm_schemas, vocab_tables, vocab_schema)
+        except (Exception, psycopg.Error) as e:
+            self.db_connector.connect.rollback()
+            print(f"Error reading the existing views: {e}")
+            return False
+
+        pending, conflicts, up_to_date = {}, [], 0
+        for schema in cdm_schemas:
+            for table in vocab_tables:
+                if table not in vocab_columns:
+                    conflicts.append(f"{vocab_schema}.{table} does not exist")
+                    continue
+                current = existing.get((schema, table))
+                if current is None:
+                    pending.setdefault(schema, []).append((table, False))
+                elif current['kind'] != 'v':
+                    conflicts.append(f"{schema}.{table} exists and is not a view")
+                elif current['sources'] == [f"{vocab_schema}.{table}"] and current['columns'] == vocab_columns[table]:
+                    up_to_date += 1
+                else:
+                    pending.setdefault(schema, []).append((table, True))
+
+        results = self._create_views(pending, vocab_schema) if pending else []
+        failed = [result for result in results if result[3] is not None]
+        created = sum(1 for result in results if result[3] is None and not result[2])
+        replaced = sum(1 for result in results if result[3] is None and result[2])
+        print(f"Vocab views in {len(cdm_schemas)} CDM schema(s): {created} created, {replaced} replaced, "
+              f"{up_to_date} already up to date, in {time.perf_counter() - started:.1f}s.")
+        for conflict in conflicts:
+            print(f"  skipped: {conflict}")
+        for schema, table, _, error in failed:
+            print(f"  {schema}.{table} failed: {error}")
+        return not failed and not conflicts
+
+    def _read_catalog(self, cdm_schemas: list, vocab_tables: list, vocab_schema: str):
+        existing, vocab_columns = {}, {}
+        with self.db_connector.connect.cursor() as cursor:
+            cursor.execute(CATALOG_QUERY, {'cdm_schemas': cdm_schemas, 'vocab_schema': vocab_schema, 'tables': vocab_tables})
+            rows = cursor.fetchall()
+        self.db_connector.connect.commit()
+        for schema, name, kind, sources, columns in rows:
+            if schema == vocab_schema:
+                vocab_columns[name] = columns
+            else:
+                existing[(schema, name)] = {'kind': kind, 'sources': sorted(sources or []), 'columns': columns}
+        return existing, vocab_columns
+
+    def _create_views(self, pending: dict, vocab_schema: str) -> list:
+        results = []
+        pool = self.db_connector.create_pool(max_size=min(self.workers, len(pending)))
+        if pool is None:
+            return [(schema, table, replace, "no connection pool") for schema, views in pending.items() for table, replace in views]
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [
+                    executor.submit(self._create_schema_views, pool, schema, views, vocab_schema)
+                    for schema, views in pending.items()
+                ]
+                for future in as_completed(futures):
+                    results.extend(future.result())
+        finally:
+            pool.close()
+        return results
+
+    def _create_schema_views(self, pool, schema: str, views: list, vocab_schema: str) -> list:
+        """Returns (schema, table, replaced, error or None) per view."""
+        results = []
+        with pool.connection() as connection:
+            for table, replace in views:
+                select = sql.SQL("SELECT * FROM {}").format(sql.Identifier(vocab_schema, table))
+                try:
+                    with connection.cursor() as cursor:
+                        cursor.execute(sql.SQL("SET LOCAL lock_timeout = {}").format(sql.Literal(self.lock_timeout)))
+                        cursor.execute(sql.SQL("CREATE OR REPLACE VIEW {} AS {}").format(
+                            sql.Identifier(schema, table), select))
+                    connection.commit()
+                    results.append((schema, table, replace, None))
+                except psycopg.errors.InvalidTableDefinition:
+                    # columns were dropped or changed type in the vocab table, which
+                    # CREATE OR REPLACE can't do; views built on this one block the DROP
+                    connection.rollback()
+                    results.append((schema, table, replace, self._recreate_view(connection, schema, table, select)))
+                except (Exception, psycopg.Error) as e:
+                    connection.rollback()
+                    results.append((schema, table, replace, str(e).strip().splitlines()[0]))
+        return results
+
+    def _recreate_view(self, connection, schema: str, table: str, select):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(sql.SQL("SET LOCAL lock_timeout = {}").format(sql.Literal(self.lock_timeout)))
+                cursor.execute(sql.SQL("DROP VIEW {}").format(sql.Identifier(schema, table)))
+                cursor.execute(sql.SQL("CREATE VIEW {} AS {}").format(sql.Identifier(schema, table), select))
+            connection.commit()
+            return None
+        except (Exception, psycopg.Error) as e:
+            connection.rollback()
+            return str(e).strip().splitlines()[0]
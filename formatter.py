@@ -1,11 +1,12 @@
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 import os
-import hashlib
-from datetime import datetime
-import pandas as pd
-import os
+import tempfile
 import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from code_base.pseudonymize import SEED, MAX_ID, ID_COLUMNS, DATE_FORMATS, IdHasher, hash_to_int, id_domain, primary_key_column
+from code_base.id_map import IdMapStore
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -14,55 +15,290 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-folder_path = os.getenv("cdmCsvFolder", "./csv_data")
+# shared with the loader's pseudonymize stage, see code_base/pseudonymize.py
+seed = SEED
+max_id = MAX_ID
+column = ID_COLUMNS
+
+# Common date column patterns in medical data
+DATE_COLUMN_PATTERNS = ['date', '_dt', 'datetime', 'time', 'birth', 'death', 'start', 'end']
+
+class HashEngine:
+    """
+    Hashes whole ID columns at once, with results identical to hash_to_int.
+
+    Each column is factorized, so every distinct value is hashed once and the
+    results are mapped back to the rows with a single take. The memo (keyed
+    by the value's string form, which is what hash_to_int hashes) is shared
+    across all columns and files of a run, so a person_id already seen in
+    measurement.csv is not hashed again for observation.csv. A file's own ID
+    column (measurement_id in measurement.csv) is hashed without being
+    remembered: one entry per row would grow with the file.
+    """
+    def __init__(self, seed, max_id, store: IdMapStore = None):
+        self.seed = seed
+        self.max_id = max_id
+        self.store = store
+        self.hasher = IdHasher(seed, max_id, store)
 
-seed = 42  # Fixed seed for reproducibility
-max_id = 99999999
+    @property
+    def memo(self) -> dict:
+        return self.hasher.memo
 
-column = ['care_site_id', 'location_id', 'person_id', 'observation_period_id', 
-                  'visit_occurrence_id', 'condition_occurrence_id', 'preceding_visit_occurrence_id', 'drug_exposure_id', 
-                  'dose_era_id', 'drug_era_id','condition_era_id', 'device_exposure_id', 'measurement_id', 'visit_detail_id', 'preceding_visit_detail_id',
-                  'procedure_occurrence_id', 'observation_id','specimen_id'
-                  ]
+    def hash_series(self, series: pd.Series, remember: bool = True) -> pd.Series:
+        # remember=False for a primary key column, see IdHasher; the series
+        # name gives the ID domain the map resolves collisions in
+        if series.empty:
+            return series.apply(lambda x: hash_to_int(x, self.seed, self.max_id))
+        # NaN stays in the uniques, hash_to_int hashes it as "nan"
+        codes, uniques = pd.factorize(series, use_na_sentinel=False)
+        hashed = np.array(self.hasher.hash_many([f"{value}" for value in uniques], remember,
+                                                   id_domain(str(series.name))), dtype=np.int64)
+        return pd.Series(hashed.take(codes), index=series.index, name=series.name)
 
-def hash_to_int(value, seed, max_id):
-    hash_object = hashlib.md5(f"{seed}_{value}".encode())
-    hash_int = int(hash_object.hexdigest(), 16)
-    return (hash_int % max_id) + 1  # Ensure it's within the range and not zero
+class DateParser:
+    """
+    Parses date columns with explicit formats instead of format='mixed'.
 
-def parse_dates_safely(df):
+    The first time a column is seen, a sample of its values is matched
+    against DATE_FORMATS and up to max_formats formats are picked, each
+    covering the sample rows the ones before it missed. Every chunk is then
+    parsed with those fixed formats; only the rows none of them match go
+    through the slow mixed-format parser. The chosen formats stay fixed for
+    the whole file, and report() logs per column which formats were used and
+    how many rows fell back.
+    """
+    def __init__(self, sample_size: int = 1000, max_formats: int = 3, min_share: float = 0.01):
+        self.sample_size = sample_size
+        self.max_formats = max_formats
+        # a format must cover this share of the sample to be picked
+        self.min_share = min_share
+        self.formats = {}
+        self.stats = {}
+
+    def infer(self, values: pd.Series) -> list:
+        sample = values.dropna()
+        if len(sample) > self.sample_size:
+            # spread over the chunk, the head of a sorted file is not representative
+            sample = sample.sample(self.sample_size, random_state=0)
+        chosen = []
+        remaining = sample
+        while len(remaining) and len(chosen) < self.max_formats:
+            matches = {
+                date_format: pd.to_datetime(remaining, format=date_format, errors='coerce').notna()
+                for date_format in DATE_FORMATS if date_format not in chosen
+            }
+            # max keeps the first of equally good formats, i.e. the day-first one
+            best = max(matches, key=lambda date_format: matches[date_format].sum())
+            if matches[best].sum() < max(1, self.min_share * len(sample)):
+                break
+            chosen.append(best)
+            remaining = remaining[~matches[best]]
+        return chosen
+
+    def parse(self, values: pd.Series) -> pd.Series:
+        col = values.name
+        if col not in self.formats:
+            if values.notna().sum() == 0:
+                # nothing to infer from yet, try again with the next chunk
+                return pd.to_datetime(values, errors='coerce')
+            self.formats[col] = self.infer(values)
+            self.stats[col] = {'rows': 0, 'fallback': 0, 'failed': 0}
+
+        parsed = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+        pending = values.notna()
+        for date_format in self.formats[col]:
+            if not pending.any():
+                break
+            parsed[pending] = pd.to_datetime(values[pending], format=date_format, errors='coerce')
+            pending &= parsed.isna()
+
+        stats = self.stats[col]
+        stats['rows'] += int(values.notna().sum())
+        if pending.any():
+            # Try parsing with dayfirst=True for DD/MM/YYYY format
+            parsed[pending] = pd.to_datetime(values[pending], dayfirst=True, errors='coerce', format='mixed')
+            stats['fallback'] += int(pending.sum())
+            stats['failed'] += int((pending & parsed.isna()).sum())
+        return parsed
+
+    def report(self, file_name: str):
+        for col, formats in self.formats.items():
+            stats = self.stats[col]
+            logger.info(
+                f"Date column '{col}' in '{file_name}': format(s) {formats or 'none matched'}, "
+                f"{stats['rows']} rows, {stats['fallback']} fell back to mixed parsing, "
+                f"{stats['failed']} unparseable"
+            )
+
+def date_columns_of(columns):
+    return [col for col in columns if any(x in col.lower() for x in DATE_COLUMN_PATTERNS)]
+
+def parse_dates_safely(df, date_columns=None, date_parser: DateParser = None):
     """
     Parse date columns with proper format handling
-    Handles both DD/MM/YYYY and YYYY-MM-DD formats
+    Handles both DD/MM/YYYY and YYYY-MM-DD formats, using one inferred format
+    per column (see DateParser). Pass the same date_parser for every chunk of
+    a file so the chunks are parsed alike.
     """
-    # Common date column patterns in medical data
-    date_columns = [col for col in df.columns if any(x in col.lower() 
-                    for x in ['date', '_dt', 'datetime', 'time', 'birth', 'death', 'start', 'end'])]
-    
+    if date_columns is None:
+        date_columns = date_columns_of(df.columns)
+    date_parser = date_parser or DateParser()
+
     for col in date_columns:
-        if col in df.columns and df[col].dtype == 'object':
+        if col in df.columns and not pd.api.types.is_numeric_dtype(df[col]):
             try:
-                # Try parsing with dayfirst=True for DD/MM/YYYY format
-                df[col] = pd.to_datetime(df[col], dayfirst=True, errors='coerce', format='mixed')
-                logger.info(f"Parsed date column '{col}' successfully")
+                df[col] = date_parser.parse(df[col])
             except Exception as e:
                 logger.warning(f"Could not parse date column '{col}': {e}")
-    
+
     return df
 
-for file in os.listdir(folder_path):
-    file_name = file.lower()
-    if file_name.endswith('.csv'):
-        file_path = os.path.join(folder_path, file_name)
-        df = pd.read_csv(file_path)
-        for col in column:
-            if col in df.columns:
-                print(f"Hashing column '{col}' in file '{file_name}'")
-                df[col] = df[col].apply(lambda x: hash_to_int(x, seed, max_id))
-
-        # Handle date columns
-        df = parse_dates_safely(df)
-        
-        # Save the modified DataFrame back to a CSV file
-        df.to_csv(file_path, index=False)
-        print(f"Finished processing file: {file_name}")
+def date_text(series: pd.Series) -> pd.Series:
+    # Written value by value, so the output doesn't depend on which other rows
+    # ended up in the same chunk: midnight as a plain date, the rest with time.
+    if not pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    text = series.dt.strftime('%Y-%m-%d %H:%M:%S')
+    midnight = series.notna() & (series == series.dt.normalize())
+    text[midnight] = series[midnight].dt.strftime('%Y-%m-%d')
+    return text
+
+def probe_dtypes(file_path: str, columns: list, chunk_rows: int) -> dict:
+    """
+    Finds the dtype a whole-file read_csv would give each column, reading
+    only those columns chunk by chunk. A chunk without gaps reads an ID as
+    int ("5") where the whole file reads it as float ("5.0"), and the two
+    hash differently, so every chunk is later read with the whole-file dtype.
+    """
+    kinds = {}
+    if not columns:
+        return kinds
+    # text beats float beats int, as it does when pandas reads the whole file
+    ranks = ['int64', 'float64', 'str']
+    for chunk in pd.read_csv(file_path, usecols=columns, chunksize=chunk_rows):
+        for col in columns:
+            dtype = chunk[col].dtype
+            if pd.api.types.is_integer_dtype(dtype):
+                kind = 'int64'
+            elif pd.api.types.is_float_dtype(dtype):
+                kind = 'float64'
+            else:
+                kind = 'str'
+            kinds[col] = max(kinds.get(col, 'int64'), kind, key=ranks.index)
+    return kinds
+
+def format_file(file_path: str, chunk_rows: int = 500000, hash_engine: HashEngine = None) -> int:
+    """
+    Pseudonymizes the ID columns and normalizes the date columns of one CSV
+    in chunks of chunk_rows rows, so memory stays bounded whatever the file
+    size. The result goes to a temp file next to the source, which replaces
+    the source only once every chunk is written. Returns the rows written.
+    """
+    hash_engine = hash_engine or HashEngine(seed, max_id)
+    file_name = os.path.basename(file_path)
+    header = list(pd.read_csv(file_path, nrows=0).columns)
+    id_columns = [col for col in column if col in header]
+    primary_key = primary_key_column(os.path.splitext(file_name)[0])
+    date_columns = date_columns_of(header)
+    probed = probe_dtypes(file_path, list(dict.fromkeys(id_columns + date_columns)), chunk_rows)
+    # every other column passes through as text, so a gap in a chunk can't
+    # turn its integers into floats
+    dtypes = {col: probed[col] if col in id_columns else str for col in header}
+    date_columns = [col for col in date_columns if probed[col] == 'str']
+    for col in id_columns:
+        print(f"Hashing column '{col}' in file '{file_name}'")
+
+    directory = os.path.dirname(os.path.abspath(file_path))
+    handle = tempfile.NamedTemporaryFile('w', dir=directory, prefix=f".{file_name}.", suffix='.tmp',
+                                         newline='', delete=False)
+    date_parser = DateParser()
+    rows = 0
+    try:
+        with handle:
+            for chunk in pd.read_csv(file_path, dtype=dtypes, chunksize=chunk_rows):
+                for col in id_columns:
+                    chunk[col] = hash_engine.hash_series(chunk[col], remember=col != primary_key)
+                chunk = parse_dates_safely(chunk, date_columns, date_parser)
+                for col in date_columns:
+                    chunk[col] = date_text(chunk[col])
+                chunk.to_csv(handle, header=rows == 0, index=False)
+                rows += len(chunk)
+            if rows == 0:
+                # header-only file
+                pd.DataFrame(columns=header).to_csv(handle, index=False)
+        os.replace(handle.name, file_path)
+    except BaseException:
+        os.remove(handle.name)
+        raise
+    date_parser.report(file_name)
+    print(f"Finished processing file: {file_name} ({rows} rows)")
+    return rows
+
+# one engine per worker process, shared by all files that worker formats
+_worker_engine = None
+
+def _init_worker(worker_seed, worker_max_id, id_map_path=None):
+    global _worker_engine
+    store = IdMapStore(id_map_path, worker_seed, worker_max_id) if id_map_path else None
+    _worker_engine = HashEngine(worker_seed, worker_max_id, store)
+
+def _format_in_worker(file_path: str, chunk_rows: int) -> int:
+    return format_file(file_path, chunk_rows, _worker_engine)
+
+def format_folder(folder_path: str, workers: int = 1, chunk_rows: int = 500000, id_map_path: str = None):
+    """
+    Formats every CSV in folder_path. With workers > 1 the files are spread
+    over a process pool, largest first. A file that fails keeps its original
+    content, the others are still formatted.
+
+    With id_map_path, IDs come from the persistent ID map in that SQLite file
+    (see IdMapStore): values it already holds keep their ID, new ones are
+    added, and hash collisions are resolved instead of silently merged.
+    """
+    files = [os.path.join(folder_path, file) for file in os.listdir(folder_path) if file.lower().endswith('.csv')]
+    # largest first; the name breaks ties, so the ID map sees the files in the same order every run
+    files.sort(key=lambda path: (-os.path.getsize(path), path))
+    failed = []
+
+    if workers <= 1:
+        store = IdMapStore(id_map_path, seed, max_id) if id_map_path else None
+        hash_engine = HashEngine(seed, max_id, store)
+        for file_path in files:
+            try:
+                format_file(file_path, chunk_rows, hash_engine)
+            except Exception as e:
+                logger.error(f"Could not format '{file_path}': {e}")
+                failed.append(file_path)
+        print(f"Hashed the ID columns, {len(hash_engine.memo)} foreign-key ID values remembered.")
+        if store:
+            store.close()
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(seed, max_id, id_map_path)) as executor:
+            futures = {executor.submit(_format_in_worker, file_path, chunk_rows): file_path for file_path in files}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Could not format '{futures[future]}': {e}")
+                    failed.append(futures[future])
+
+    if id_map_path:
+        store = IdMapStore(id_map_path, seed, max_id)
+        mapped, probed = store.stats()
+        store.close()
+        print(f"ID map '{id_map_path}' holds {mapped} values, {probed} of them moved off a colliding hash.")
+
+    if failed:
+        print(f"{len(failed)} file(s) left unchanged: {', '.join(os.path.basename(f) for f in failed)}")
+    return failed
+
+if __name__ == "__main__":
+    folder_path = os.getenv("cdmCsvFolder", "./csv_data")
+    format_folder(
+        folder_path,
+        workers=int(os.getenv("formatterWorkers", "1")),
+        chunk_rows=int(os.getenv("formatterChunkRows", "500000")),
+        id_map_path=os.getenv("idMapPath"),
+    )
@@ -2,7 +2,18 @@
 from code_base.config import Config
 from code_base.db_connector import DBConnector
 from code_base.ddl import DDL
+from code_base.permission_planner import PermissionPlanner
+from code_base.view_provisioner import ViewProvisioner
+from code_base.index_builder import IndexBuilder
+from code_base.constraint_builder import ConstraintBuilder
+from code_base.table_maintainer import TableMaintainer
+from code_base.achilles_runner import AchillesRunner
 from code_base.csv_loader import CSVLoader
+from code_base.load_manifest import LoadManifest
+from code_base.metrics import RunMetrics
+from code_base.query_profiler import QueryProfiler
+from code_base.pseudonymize import Pseudonymizer
+from code_base.id_map import IdMapStore
 
 def initialize_db_connector():
     """Loads all configurations and returns a DBConnector instance."""
@@ -11,7 +22,8 @@ def initialize_db_connector():
         **config.load_db_config(),
         **config.load_schema_config(),
         **config.load_webapi_user(),
-        **config.load_etl_user()
+        **config.load_etl_user(),
+        sessionProfiles=config.load_session_profiles()
     )
     
     if not db_connector.connect:
@@ -24,40 +36,48 @@ def setup_security_and_roles(db_conn: DBConnector, config: Config):
     role_configs = config.load_role_configs()
     etl_role = role_configs['etlrole']
     webapi_role = role_configs['webapirole']
+    # the wanted state is declared here; the planner compares it with the
+    # catalog and applies only what is missing, in one transaction
+    planner = PermissionPlanner(db_conn)
 
     # 1. Base Setup
-    db_conn.set_user_as_superuser(db_conn.dbUser)
-    db_conn.create_schemas()
-    db_conn.create_role(etl_role)
-    db_conn.create_role(webapi_role)
+    planner.superuser(db_conn.dbUser)
+    planner.schemas([db_conn.cdmDatabaseSchema, db_conn.vocabDatabaseSchema, db_conn.resultsDatabaseSchema,
+                     db_conn.scratchDatabaseSchema, db_conn.webApiSchema, db_conn.tempSchema])
+    planner.role(etl_role)
+    planner.role(webapi_role)
 
     # 2. ETL Role Permissions
-    db_conn.grant_database_role_access(etl_role, db_conn.dbName)
-    db_conn.create_read_only_role(etl_role, db_conn.vocabDatabaseSchema)
+    planner.database_connect(etl_role, db_conn.dbName)
+    planner.read_only(etl_role, db_conn.vocabDatabaseSchema)
     for schema in [db_conn.cdmDatabaseSchema, db_conn.resultsDatabaseSchema, 
                    db_conn.tempSchema, db_conn.scratchDatabaseSchema]:
-        db_conn.create_read_write_role(etl_role, schema)
+        planner.read_write(etl_role, schema)
 
     # 3. WebAPI Role Permissions
-    db_conn.grant_database_role_access(webapi_role, db_conn.dbName)
-    db_conn.create_read_only_role(webapi_role, db_conn.vocabDatabaseSchema)
-    db_conn.create_read_only_role(webapi_role, db_conn.cdmDatabaseSchema)
+    planner.database_connect(webapi_role, db_conn.dbName)
+    planner.read_only(webapi_role, db_conn.vocabDatabaseSchema)
+    planner.read_only(webapi_role, db_conn.cdmDatabaseSchema)
     for schema in [db_conn.resultsDatabaseSchema, db_conn.tempSchema, 
                    db_conn.webApiSchema, db_conn.scratchDatabaseSchema]:
-        db_conn.create_read_write_role(webapi_role, schema)
+        planner.read_write(webapi_role, schema)
 
     # 4. Finalize Users
-    db_conn.set_schema_owner(db_conn.webApiSchema, webapi_role)
-    db_conn.create_new_user(db_conn.webApiUser, db_conn.webApiPassword)
-    db_conn.create_new_user(db_conn.etlUser, db_conn.etlPassword)
-    db_conn.assign_role_to_user(db_conn.etlUser, etl_role)
-    db_conn.assign_role_to_user(db_conn.webApiUser, webapi_role)
-    print("Security and roles configured.")
-
-def run_database_ddl(db_conn: DBConnector, config: Config, create: bool = True):
+    planner.schema_owner(db_conn.webApiSchema, webapi_role)
+    planner.user(db_conn.webApiUser, db_conn.webApiPassword)
+    planner.user(db_conn.etlUser, db_conn.etlPassword)
+    planner.member(db_conn.etlUser, etl_role)
+    planner.member(db_conn.webApiUser, webapi_role)
+
+    dry_run = role_configs['permissions_dry_run']
+    if planner.apply(dry_run=dry_run) and not dry_run:
+        print("Security and roles configured.")
+
+def run_database_ddl(db_conn: DBConnector, config: Config, create: bool = True, metrics: RunMetrics = None,
+                     profiler: QueryProfiler = None):
     """Creates tables, primary keys, and indices."""
     sql_paths = config.load_sql_configs()
-    ddl = DDL(db_conn)
+    ddl = DDL(db_conn, metrics=metrics, profiler=profiler)
     
     # Create Tables
     ddl.create_cdm_tables(sql_paths['cdm_sql_path'])
@@ -67,40 +87,104 @@ def run_database_ddl(db_conn: DBConnector, config: Config, create: bool = True):
     # Add Keys and Indices
     ddl.add_primary_keys(sql_paths['cdm_primary_keys_sql_path'])
     ddl.add_primary_keys(sql_paths['vocab_primary_keys_sql_path'])
-    ddl.add_indices(sql_paths['cdm_indices_sql_path'])
-    ddl.add_indices(sql_paths['vocab_indices_sql_path'])
+    index_configs = config.load_index_configs()
+    if index_configs['index_workers'] > 1:
+        # independent tables build side by side, each with a CLUSTER after its index
+        builder = IndexBuilder(ddl, workers=index_configs['index_workers'])
+        builder.build([sql_paths['cdm_indices_sql_path'], sql_paths['vocab_indices_sql_path']])
+    else:
+        ddl.add_indices(sql_paths['cdm_indices_sql_path'])
+        ddl.add_indices(sql_paths['vocab_indices_sql_path'])
     return ddl, sql_paths
 
-def load_initial_data(db_conn: DBConnector, config: Config, ddl: DDL, sql_paths: dict):
+def load_initial_data(db_conn: DBConnector, config: Config, ddl: DDL, sql_paths: dict, metrics: RunMetrics = None):
     """Loads CSV data and applies final constraints."""
     csv_paths = config.load_csv_paths()
-    csv_loader = CSVLoader(db_connector=db_conn)
+    loader_configs = config.load_loader_configs()
+    # with the manifest on, reruns only load files that are new, changed or failed
+    manifest = LoadManifest(db_conn) if loader_configs['load_manifest'] else None
+    pseudonymizer = None
+    if loader_configs['pseudonymize']:
+        # with idMapPath the IDs come from the same ID map formatter.py uses
+        id_map_path = loader_configs['id_map_path']
+        pseudonymizer = Pseudonymizer(store=IdMapStore(id_map_path) if id_map_path else None)
+    csv_loader = CSVLoader(db_connector=db_conn, manifest=manifest,
+                           binary=loader_configs['copy_format'] == 'binary',
+                           max_rejects=loader_configs['max_rejects'],
+                           batch_rows=loader_configs['batch_rows'],
+                           metrics=metrics,
+                           pseudonymizer=pseudonymizer)
+    # Bulk-load mode drops the keys and indices of the tables being loaded
+    # (run_database_ddl built them on empty tables), makes those tables
+    # UNLOGGED for the COPY, then rebuilds everything and sets them LOGGED again.
+    bulk_load = loader_configs['bulk_load']
+    primary_key_paths = [sql_paths['cdm_primary_keys_sql_path'], sql_paths['vocab_primary_keys_sql_path']]
+    index_paths = [sql_paths['cdm_indices_sql_path'], sql_paths['vocab_indices_sql_path']]
     
     # Load Vocabulary
+    # if bulk_load:
+    #     vocab_tables = csv_loader.list_target_tables(db_conn.vocabDatabaseSchema, csv_paths['vocab_csv_folder'])
+    #     ddl.prepare_bulk_load(db_conn.vocabDatabaseSchema, vocab_tables, primary_key_paths, index_paths)
     # csv_loader.process_folder(
     #     schema=db_conn.vocabDatabaseSchema, 
     #     folder_path=csv_paths['vocab_csv_folder'], 
-    #     delimiter='\t'
+    #     delimiter='\t',
+    #     workers=loader_configs['load_workers'],
+    #     chunk_threshold_mb=loader_configs['chunk_threshold_mb'],
+    #     chunk_workers=loader_configs['chunk_workers']
     # )
+    # if bulk_load:
+    #     ddl.finish_bulk_load(db_conn.vocabDatabaseSchema, vocab_tables, primary_key_paths, index_paths)
 
     # load cdm data
+    if bulk_load:
+        cdm_tables = csv_loader.list_target_tables(db_conn.cdmDatabaseSchema, csv_paths['cdm_csv_folder'])
+        ddl.prepare_bulk_load(db_conn.cdmDatabaseSchema, cdm_tables, primary_key_paths, index_paths)
     csv_loader.process_folder(
         schema=db_conn.cdmDatabaseSchema, 
         folder_path=csv_paths['cdm_csv_folder'], 
-        delimiter=','
+        delimiter=',',
+        workers=loader_configs['load_workers'],
+        chunk_threshold_mb=loader_configs['chunk_threshold_mb'],
+        chunk_workers=loader_configs['chunk_workers']
     )
+    if bulk_load:
+        ddl.finish_bulk_load(db_conn.cdmDatabaseSchema, cdm_tables, primary_key_paths, index_paths)
     
     # Constraints (applied after data load for performance/integrity)
-    ddl.add_constraints(sql_paths['constraints_sql_path'])
+    constraint_workers = config.load_constraint_configs()['constraint_workers']
+    if constraint_workers > 1:
+        ConstraintBuilder(ddl, workers=constraint_workers).build(sql_paths['constraints_sql_path'])
+    else:
+        ddl.add_constraints(sql_paths['constraints_sql_path'])
+
+    # Statistics for the loaded tables, so the first queries aren't planned
+    # as if they were still empty
+    maintenance_configs = config.load_maintenance_configs()
+    if maintenance_configs['post_load_maintenance']:
+        maintainer = TableMaintainer(db_conn, workers=maintenance_configs['maintenance_workers'], metrics=metrics,
+                                     statistics_target=maintenance_configs['statistics_target'],
+                                     statistics_columns=maintenance_configs['statistics_columns'])
+        # maintainer.maintain(db_conn.vocabDatabaseSchema,
+        #                     csv_loader.list_target_tables(db_conn.vocabDatabaseSchema, csv_paths['vocab_csv_folder']))
+        maintainer.maintain(db_conn.cdmDatabaseSchema,
+                            csv_loader.list_target_tables(db_conn.cdmDatabaseSchema, csv_paths['cdm_csv_folder']))
     print("Data loading and constraints completed.")
 
-def run_achilles_analysis(db_conn: DBConnector, config: Config):
+def run_achilles_analysis(db_conn: DBConnector, config: Config, metrics: RunMetrics = None,
+                          profiler: QueryProfiler = None):
     """Runs Achilles analysis scripts."""
     achilles_configs = config.load_achilles_configs()
-    ddl = DDL(db_conn)
+    ddl = DDL(db_conn, metrics=metrics, profiler=profiler)
     
-    ddl.run_achilles_script(achilles_configs['achilles_result_sql'])
-    ddl.run_achilles_script(achilles_configs['achilles_count_sql'])
+    if achilles_configs['achilles_workers'] > 1 or achilles_configs['achilles_incremental']:
+        # both scripts in one dependency graph, independent statements in parallel
+        runner = AchillesRunner(ddl, workers=achilles_configs['achilles_workers'],
+                                incremental=achilles_configs['achilles_incremental'])
+        runner.run([achilles_configs['achilles_result_sql'], achilles_configs['achilles_count_sql']])
+    else:
+        ddl.run_achilles_script(achilles_configs['achilles_result_sql'])
+        ddl.run_achilles_script(achilles_configs['achilles_count_sql'])
     print("Achilles analysis completed.")
 
 # This is necessary to avoid error from packages like feature extraction. We encountered issues
@@ -110,20 +194,29 @@ def run_cdm_vocab_view(db_conn: DBConnector, config: Config):
     cdm_schemas = config.load_cdm_schemas()
     vocab_schema = config.load_schema_config()['vocabDatabaseSchema']
     vocab_tables = config.load_vocab_tables()
-    ddl = DDL(db_conn)
-    ddl._execute_view_cdm(cdm_schemas['cdm_schemas'], vocab_tables['vocab_tables'], vocab_schema)
+    # only missing or outdated views are (re)created, one connection per CDM schema
+    provisioner = ViewProvisioner(db_conn, workers=config.load_view_configs()['view_workers'])
+    provisioner.provision(cdm_schemas['cdm_schemas'], vocab_tables['vocab_tables'], vocab_schema)
 
 def main():
     db_conn = None
+    config = None
+    # throughput of every load and SQL step, written to the run report at the end
+    metrics = RunMetrics()
+    profiler = None
     try:
         # Step 1: Initialize
         db_conn, config = initialize_db_connector()
+        report_configs = config.load_report_configs()
+        if report_configs['profile_sql']:
+            # plans and timings of the DDL and Achilles statements, slowest first
+            profiler = QueryProfiler([db_conn.vocabDatabaseSchema], report_configs['profile_seq_scan_rows'])
         # Step 2: Permissions
         # setup_security_and_roles(db_conn, config)
         # Step 3: DDL
-        # ddl, sql_paths = run_database_ddl(db_conn, config, create=False)
+        # ddl, sql_paths = run_database_ddl(db_conn, config, create=False, metrics=metrics, profiler=profiler)
         # Step 4: Data
-        # load_initial_data(db_conn, config, ddl, sql_paths)
+        # load_initial_data(db_conn, config, ddl, sql_paths, metrics=metrics)
         # Step 5: Achilles Analysis
         # Please check the readme before running Achilles analysis.
         # This should be run only after confirming the database is fully set up.
@@ -131,7 +224,7 @@ def main():
         # uncomment the next line to run. 
         # Please ensure you comment step 2 - 4 if you have already run them once.
         
-        # run_achilles_analysis(db_conn, config)
+        # run_achilles_analysis(db_conn, config, metrics=metrics, profiler=profiler)
         
         # Step 6: Create CDM and Vocabulary Views
         run_cdm_vocab_view(db_conn, config)
@@ -141,6 +234,10 @@ def main():
     except Exception as e:
         print(f"An error occurred during setup: {e}")
     finally:
+        if config and metrics.entries:
+            metrics.write_report(config.load_report_configs()['run_report'])
+        if profiler and profiler.entries:
+            profiler.write_report(config.load_report_configs()['profile_report'])
         if db_conn:
             db_conn.close_connection()
             print("Database connection closed.")
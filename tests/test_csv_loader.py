@@ -0,0 +1,68 @@
+import pytest
+from psycopg import sql
+from code_base.config import Config
+from code_base.csv_loader import CSVLoader
+from code_base.csv_source import as_source
+from code_base.db_connector import DBConnector
+from code_base.load_manifest import LoadManifest
+
+TABLE = "tolerant_interrupt_probe"
+
+class Killed(BaseException):
+    """Stands in for the process being killed: no except Exception handler runs."""
+
+class KilledAfterFirstBatch(CSVLoader):
+    batches = 0
+
+    def _load_batch(self, *args, **kwargs):
+        self.batches += 1
+        if self.batches == 2:
+            raise Killed()
+        return super()._load_batch(*args, **kwargs)
+
+@pytest.fixture
+def db():
+    config = Config()
+    db_connector = DBConnector(**config.load_db_config(), **config.load_schema_config())
+    if not db_connector.connect:
+        pytest.skip("no database configured in .env")
+    yield db_connector
+    db_connector.close_connection()
+
+def execute(db, query, params=None):
+    with db.connect.cursor() as cursor:
+        cursor.execute(query, params)
+        rows = cursor.fetchall() if cursor.description else None
+    db.connect.commit()
+    return rows
+
+def test_interrupted_tolerant_load_is_marked_partial(db, tmp_path):
+    schema = db.scratchDatabaseSchema
+    table = sql.Identifier(schema, TABLE)
+    execute(db, sql.SQL("DROP TABLE IF EXISTS {}").format(table))
+    execute(db, sql.SQL("CREATE TABLE {} (id integer, name varchar(10))").format(table))
+    path = tmp_path / f"{TABLE}.csv"
+    path.write_text("id,name\n" + "".join(f"{row},name{row}\n" for row in range(1, 6)))
+    manifest = LoadManifest(db)
+    try:
+        loader = KilledAfterFirstBatch(db, manifest=manifest, max_rejects=0, batch_rows=2)
+        with pytest.raises(Killed):
+            loader.load_file_tolerant(schema, TABLE, str(path), delimiter=',')
+        # the killed process never commits or rolls back what it had open
+        db.connect.rollback()
+
+        assert execute(db, sql.SQL("SELECT count(*) FROM {}").format(table)) == [(2,)]
+        status = execute(
+            db, sql.SQL("SELECT status FROM {} WHERE schema_name = %s AND file_name = %s").format(
+                sql.Identifier(manifest.schema, manifest.table)),
+            (schema, path.name)
+        )
+        assert status == [('partial',)]
+        # the rerun truncates the table before loading the file again
+        pending, stale = LoadManifest(db).plan(schema, [(TABLE, as_source(str(path)))])
+        assert [table_name for table_name, _ in pending] == [TABLE]
+        assert stale == [TABLE]
+    finally:
+        execute(db, sql.SQL("DELETE FROM {} WHERE schema_name = %s AND file_name = %s").format(
+            sql.Identifier(manifest.schema, manifest.table)), (schema, path.name))
+        execute(db, sql.SQL("DROP TABLE IF EXISTS {}").format(table))